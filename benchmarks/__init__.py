@@ -0,0 +1,3 @@
+"""
+Throughput measurements for the ingest pipeline. Run each module with `python -m benchmarks.<name> --help`.
+"""
@@ -0,0 +1,81 @@
+"""
+Compare the cost of turning parsed articles into bulk request bodies: building action dicts and serializing them
+through the ES client, versus encoding each document once to bytes (`ingest.ndjson`)
+"""
+import argparse
+import os
+import time
+
+import elasticsearch.serializer
+
+from ingest import indexer
+from ingest import ndjson
+from ingest import parse_nxml
+from ingest import populate_es
+
+FIXTURE = os.path.join(os.path.dirname(__file__), '..', 'tests', 'ingest', 'fixtures', 'PMC3414848.nxml')
+
+
+def make_documents(n: int, body_kb: int) -> list:
+    """Copies of the test fixture, each with a distinct ID and a body of (about) the requested size"""
+    template = parse_nxml.parse_nxml(FIXTURE)
+    body = template['body']
+    repeats = max(1, body_kb * 1024 // max(len(body), 1))
+    docs = []
+    for i in range(n):
+        doc = dict(template, pmc=str(i), body=' '.join([body] * repeats))
+        docs.append(doc)
+    return docs
+
+
+def client_path(docs: list, batch_size: int) -> int:
+    """The default path: action dicts, serialized by the client's JSON serializer, then encoded by the transport"""
+    serializer = elasticsearch.serializer.JSONSerializer()
+    size = 0
+    for start in range(0, len(docs), batch_size):
+        items = [indexer.serialize_action(serializer, None, action)
+                 for action in populate_es.make_bulk_actions(docs[start:start + batch_size])]
+        body = ''.join(item.data for item in items).encode('utf-8', 'surrogatepass')
+        size += len(body)
+    return size
+
+
+def encoded_path(docs: list, batch_size: int) -> int:
+    """Each document encoded once, straight to bytes; the body is a single join"""
+    size = 0
+    for start in range(0, len(docs), batch_size):
+        items = [ndjson.encode_document(doc) for doc in docs[start:start + batch_size]]
+        body = b''.join(data for _, data in items)
+        size += len(body)
+    return size
+
+
+def measure(fn, docs: list, batch_size: int, repeat: int) -> float:
+    """Best-of-N throughput, in MB of request body per second"""
+    best = None
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        size = fn(docs, batch_size)
+        elapsed = time.perf_counter() - t1
+        best = elapsed if best is None else min(best, elapsed)
+    return size / indexer.MB / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--docs', type=int, default=200)
+    parser.add_argument('--body-kb', type=int, default=500, help='Approximate body size of each document')
+    parser.add_argument('--batch-size', type=int, default=50, help='Documents per bulk request')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    docs = make_documents(args.docs, args.body_kb)
+    print(f'Encoder: {ndjson.dumps.__module__}.{ndjson.dumps.__name__}')
+    client = measure(client_path, docs, args.batch_size, args.repeat)
+    encoded = measure(encoded_path, docs, args.batch_size, args.repeat)
+    print(f'client serializer: {client:8.1f} MB/s')
+    print(f'pre-encoded:       {encoded:8.1f} MB/s ({encoded / client:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+A local stand-in for the ES `_bulk` endpoint, for measuring the client side of ingestion without a cluster
+
+Requests are acknowledged without storing anything. A fixed delay (plus an optional delay per MB of request body)
+stands in for the time ES spends indexing, and a proportion of requests or individual items can be rejected with
+HTTP 429, as an overloaded cluster would.
+"""
+import argparse
+import http.server
+import json
+import random
+import socketserver
+import threading
+import time
+
+
+class Options:
+    def __init__(self, *, latency: float=0.0, latency_per_mb: float=0.0, reject_requests: float=0.0,
+                 reject_items: float=0.0, seed: int=None):
+        """
+        :param latency: Seconds to wait before responding to each bulk request
+        :param latency_per_mb: Additional seconds per MB of request body
+        :param reject_requests: Fraction of bulk requests to reject outright (HTTP 429)
+        :param reject_items: Fraction of items, in accepted requests, to reject with status 429
+        """
+        self.latency = latency
+        self.latency_per_mb = latency_per_mb
+        self.reject_requests = reject_requests
+        self.reject_items = reject_items
+        self.rng = random.Random(seed)
+
+
+class Stats:
+    """Totals for everything the server has received"""
+    def __init__(self):
+        self.requests = 0
+        self.rejected_requests = 0
+        self.items = 0
+        self.rejected_items = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def as_dict(self) -> dict:
+        return {k: v for k, v in vars(self).items() if not k.startswith('_')}
+
+
+class BulkHandler(http.server.BaseHTTPRequestHandler):
+    # Keep connections open between requests, as ES does
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._respond(200, None)
+
+    def do_GET(self):
+        self._respond(200, {'version': {'number': '5.2.0'}, 'tagline': 'You Know, for Search'})
+
+    def do_PUT(self):
+        self._read_body()
+        self._respond(200, {'acknowledged': True})
+
+    def do_DELETE(self):
+        self._respond(200, {'acknowledged': True})
+
+    def do_POST(self):
+        body = self._read_body()
+        if not self.path.split('?')[0].endswith('/_bulk'):
+            self._respond(200, {'acknowledged': True})
+            return
+
+        options = self.server.options
+        stats = self.server.stats
+        t1 = time.perf_counter()
+        time.sleep(options.latency + options.latency_per_mb * len(body) / (1024 * 1024))
+
+        with stats._lock:
+            stats.requests += 1
+            stats.bytes += len(body)
+            if options.rng.random() < options.reject_requests:
+                stats.rejected_requests += 1
+                self._respond(429, {'error': {'type': 'es_rejected_execution_exception'}, 'status': 429})
+                return
+
+            # Every action in the benchmark is an index action, followed by its source line
+            items = []
+            for line in body.splitlines()[::2]:
+                action, meta = next(iter(json.loads(line).items()))
+                # As in ES, each result names the document it applies to
+                result = {'_index': meta.get('_index'), '_type': meta.get('_type'), '_id': meta.get('_id')}
+                if options.rng.random() < options.reject_items:
+                    stats.rejected_items += 1
+                    result.update(status=429, error={'type': 'es_rejected_execution_exception'})
+                else:
+                    result.update(status=201, result='created')
+                items.append({action: result})
+            stats.items += len(items)
+
+        took = int((time.perf_counter() - t1) * 1000)
+        self._respond(200, {'took': took, 'errors': any(_status(i) >= 300 for i in items), 'items': items})
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _respond(self, status: int, data):
+        payload = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+
+def _status(item: dict) -> int:
+    return next(iter(item.values()))['status']
+
+
+class BulkServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, options: Options):
+        super().__init__(address, BulkHandler)
+        self.options = options
+        self.stats = Stats()
+
+    @property
+    def host(self) -> str:
+        return '{}:{}'.format(*self.server_address[:2])
+
+
+def start(host: str='127.0.0.1', port: int=0, **kwargs) -> BulkServer:
+    """
+    Run a server in a background thread (call `shutdown` to stop it)
+    :param port: 0 to pick any free port; see `BulkServer.host` for the address
+    :param kwargs: See `Options`
+    """
+    server = BulkServer((host, port), Options(**kwargs))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9200)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds per bulk request')
+    parser.add_argument('--latency-per-mb', type=float, default=0.0, help='Additional seconds per MB of request')
+    parser.add_argument('--reject-requests', type=float, default=0.0, help='Fraction of requests to reject (429)')
+    parser.add_argument('--reject-items', type=float, default=0.0, help='Fraction of items to reject (429)')
+    args = parser.parse_args()
+
+    server = BulkServer((args.host, args.port), Options(latency=args.latency,
+                                                        latency_per_mb=args.latency_per_mb,
+                                                        reject_requests=args.reject_requests,
+                                                        reject_items=args.reject_items))
+    print(f'Listening on {server.host}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.stats.as_dict()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+Generate a synthetic corpus of NXML articles, using the test fixture as a template
+
+Every article keeps the fixture's front matter layout, but gets its own identifiers, publication year, keywords,
+authors, body text, and figures. Body text is drawn from the fixture's own vocabulary. A proportion of words
+(`entity_density`) are replaced with symbols that are written as character references (eg `&#177;`), as in real
+PMC files, so that unescaping is exercised too.
+"""
+import argparse
+import copy
+import os
+import random
+import re
+
+from lxml import etree
+
+FIXTURE = os.path.join(os.path.dirname(__file__), '..', 'tests', 'ingest', 'fixtures', 'PMC3414848.nxml')
+
+# Written out as character references, since the corpus is saved as ASCII
+SYMBOLS = ['±', 'µm', 'α', 'β', '37 °C', '–', '6,6′', 'R&D', '<', '>']
+
+PARAGRAPH_CHARS = 800
+PARAGRAPHS_PER_SECTION = 6
+
+
+class Template:
+    """The parsed fixture, and the words used to fill in generated text"""
+    def __init__(self, fn: str=FIXTURE):
+        self.tree = etree.parse(fn)
+        root = self.tree.getroot()
+        text = ' '.join(root.find('body').itertext())
+        self.words = [w for w in re.findall(r'[A-Za-z][a-z]{2,}', text)]
+        self.keywords = [kwd.text for kwd in root.iterfind('front/article-meta/kwd-group/kwd')]
+        self.contrib = copy.deepcopy(root.find('front/article-meta/contrib-group/contrib[@contrib-type="author"]'))
+        self.fig = copy.deepcopy(root.find('.//fig'))
+
+
+def sentence(rng: random.Random, template: Template, n_words: int, entity_density: float) -> str:
+    words = []
+    for _ in range(n_words):
+        if rng.random() < entity_density:
+            words.append(rng.choice(SYMBOLS))
+        else:
+            words.append(rng.choice(template.words))
+    return ' '.join(words).capitalize() + '.'
+
+
+def paragraph(rng: random.Random, template: Template, n_chars: int, entity_density: float) -> str:
+    text = []
+    size = 0
+    while size < n_chars:
+        s = sentence(rng, template, rng.randint(8, 25), entity_density)
+        text.append(s)
+        size += len(s) + 1
+    return ' '.join(text)
+
+
+def make_article(template: Template, i: int, *,
+                 rng: random.Random,
+                 body_chars: int=40000,
+                 authors: int=6,
+                 figures: int=5,
+                 entity_density: float=0.02) -> etree._ElementTree:
+    tree = copy.deepcopy(template.tree)
+    root = tree.getroot()
+    meta = root.find('front/article-meta')
+
+    ids = {'pmid': str(90000000 + i), 'pmc': str(10000000 + i), 'doi': f'10.5555/synthetic.{i}'}
+    for node in meta.iterfind('article-id'):
+        node.text = ids.get(node.get('pub-id-type'), node.text)
+
+    year = str(rng.randint(1995, 2017))
+    for node in meta.iterfind('pub-date/year'):
+        node.text = year
+
+    kwd_group = meta.find('kwd-group')
+    for node in kwd_group.findall('kwd'):
+        kwd_group.remove(node)
+    for keyword in rng.sample(template.keywords + template.words, rng.randint(3, 6)):
+        etree.SubElement(kwd_group, 'kwd').text = keyword
+
+    contrib_group = meta.find('contrib-group')
+    for node in contrib_group.findall('contrib[@contrib-type="author"]'):
+        contrib_group.remove(node)
+    for _ in range(authors):
+        contrib = copy.deepcopy(template.contrib)
+        contrib.find('name/surname').text = rng.choice(template.words).capitalize()
+        contrib.find('name/given-names').text = rng.choice(template.words).capitalize()
+        contrib_group.append(contrib)
+
+    body = root.find('body')
+    body.clear()
+    size = 0
+    while size < body_chars:
+        sec = etree.SubElement(body, 'sec')
+        etree.SubElement(sec, 'title').text = sentence(rng, template, rng.randint(2, 6), 0)
+        for _ in range(PARAGRAPHS_PER_SECTION):
+            if size >= body_chars:
+                break
+            text = paragraph(rng, template, min(PARAGRAPH_CHARS, body_chars - size), entity_density)
+            etree.SubElement(sec, 'p').text = text
+            size += len(text)
+
+    for node in root.findall('.//fig'):
+        node.getparent().remove(node)
+    floats = root.find('floats-group')
+    if floats is None:
+        floats = etree.SubElement(root, 'floats-group')
+    for n in range(figures):
+        fig = copy.deepcopy(template.fig)
+        fig.set('id', f'fig{n:04d}')
+        fig.find('label').text = f'Fig. {n + 1}'
+        caption = fig.find('caption')
+        caption.clear()
+        etree.SubElement(caption, 'p').text = paragraph(rng, template, 300, entity_density)
+        floats.append(fig)
+
+    return tree
+
+
+def generate(dirname: str, articles: int, *, per_dir: int=1000, seed: int=0, **kwargs) -> int:
+    """
+    Write `articles` files, in subdirectories of `per_dir` files each (like the PMC bulk packages)
+    :param kwargs: Options for `make_article`
+    :return: The total size of the files written, in bytes
+    """
+    rng = random.Random(seed)
+    template = Template()
+    total = 0
+    for i in range(articles):
+        subdir = os.path.join(dirname, f'{i // per_dir:04d}')
+        if i % per_dir == 0:
+            os.makedirs(subdir, exist_ok=True)
+        fn = os.path.join(subdir, f'PMC{10000000 + i}.nxml')
+        make_article(template, i, rng=rng, **kwargs).write(fn, encoding='us-ascii', xml_declaration=True)
+        total += os.path.getsize(fn)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('dir', help='Directory to write the corpus to')
+    parser.add_argument('--articles', type=int, default=1000)
+    parser.add_argument('--body-chars', type=int, default=40000, help='Approximate length of each body')
+    parser.add_argument('--authors', type=int, default=6)
+    parser.add_argument('--figures', type=int, default=5)
+    parser.add_argument('--entity-density', type=float, default=0.02,
+                        help='Fraction of words written as character references')
+    parser.add_argument('--per-dir', type=int, default=1000, help='Files per subdirectory')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    total = generate(args.dir, args.articles, per_dir=args.per_dir, seed=args.seed,
+                     body_chars=args.body_chars, authors=args.authors, figures=args.figures,
+                     entity_density=args.entity_density)
+    print(f'Wrote {args.articles} articles ({total / 1024 / 1024:.1f} MB) to {args.dir}')
+
+
+if __name__ == '__main__':
+    main()
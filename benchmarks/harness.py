@@ -0,0 +1,199 @@
+"""
+Measure the throughput of each stage of ingestion: walk, parse, build actions, serialize, and submit
+
+Stages run one after another over the whole corpus (each stage's output is kept in memory for the next), so
+that each can be timed on its own. Documents are submitted to a local `_bulk` stand-in (see `bulk_server`)
+unless `--es-hosts` names a real cluster.
+
+Peak RSS is sampled from /proc while each stage runs, and covers this process only (not parse workers).
+"""
+import argparse
+import json
+import os
+import threading
+import time
+import typing
+
+import elasticsearch.serializer
+
+from benchmarks import bulk_server
+from ingest import config
+from ingest import indexer
+from ingest import manifest
+from ingest import main as ingest_main
+from ingest import ndjson
+from ingest import populate_es
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+class StageResult(typing.NamedTuple):
+    stage: str
+    seconds: float
+    docs: int
+    bytes: int  # Source XML for walk and parse; bulk request bodies after that
+    peak_rss: int
+
+    @property
+    def docs_per_sec(self) -> float:
+        return self.docs / self.seconds if self.seconds else 0.0
+
+    @property
+    def mb_per_sec(self) -> float:
+        return self.bytes / indexer.MB / self.seconds if self.seconds else 0.0
+
+
+def current_rss() -> int:
+    """Resident set size of this process, in bytes (0 where /proc is not available)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return 0
+
+
+class PeakRSS:
+    """Sample RSS in a background thread while the context is active"""
+    def __init__(self, interval: float=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+
+def timed(fn: typing.Callable, *args, **kwargs) -> typing.Tuple[object, float, int]:
+    """Run fn; return its result, the elapsed time, and peak RSS"""
+    with PeakRSS() as rss:
+        t1 = time.perf_counter()
+        result = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - t1
+    return result, elapsed, rss.peak
+
+
+def walk(dirname: str) -> typing.List[typing.Tuple[str, int]]:
+    return [(entry.path, entry.size) for entry in manifest.scan(dirname)]
+
+
+def parse(files: list, *, workers: int, parse_fn: typing.Callable) -> list:
+    return [doc for _, doc in ingest_main.parse_all((fn for fn, _ in files), workers=workers, parse_fn=parse_fn)]
+
+
+def build(docs: list) -> list:
+    return list(populate_es.make_bulk_actions(docs))
+
+
+def serialize(actions: list) -> typing.List[indexer.Item]:
+    serializer = elasticsearch.serializer.JSONSerializer()
+    return [indexer.serialize_action(serializer, None, action) for action in actions]
+
+
+def encode(docs: list) -> typing.List[indexer.Item]:
+    return [indexer.Item(None, *ndjson.encode_document(doc)) for doc in docs]
+
+
+def submit(items: list, *, client, bulk_concurrency: int, bulk_mb: float) -> indexer.IndexResult:
+    bulk = indexer.BulkIndexer(client, max_in_flight=bulk_concurrency, batch_bytes=int(bulk_mb * indexer.MB))
+    return bulk.index_encoded(items)
+
+
+def run(dirname: str, *, client, workers: int=0, extractor: str='xpath', fast_json: bool=False,
+        bulk_concurrency: int=4, bulk_mb: float=5) -> typing.List[StageResult]:
+    results = []
+
+    files, seconds, peak = timed(walk, dirname)
+    xml_bytes = sum(size for _, size in files)
+    results.append(StageResult('walk', seconds, len(files), xml_bytes, peak))
+
+    parse_fn = ingest_main.EXTRACTORS[extractor]
+    docs, seconds, peak = timed(parse, files, workers=workers, parse_fn=parse_fn)
+    results.append(StageResult('parse', seconds, len(docs), xml_bytes, peak))
+
+    if fast_json:
+        # Actions are never built as dicts; documents are encoded directly
+        items, seconds, peak = timed(encode, docs)
+        del docs
+    else:
+        actions, build_seconds, build_peak = timed(build, docs)
+        del docs
+        items, seconds, peak = timed(serialize, actions)
+        del actions
+    body_bytes = sum(indexer.item_size(item) for item in items)
+    if not fast_json:
+        results.append(StageResult('build', build_seconds, len(items), body_bytes, build_peak))
+    results.append(StageResult('serialize', seconds, len(items), body_bytes, peak))
+
+    tracked = [(item.token, item.id, item.data) for item in items]
+    del items
+    result, seconds, peak = timed(submit, tracked, client=client,
+                                  bulk_concurrency=bulk_concurrency, bulk_mb=bulk_mb)
+    results.append(StageResult('submit', seconds, result.indexed, body_bytes, peak))
+    if result.failures:
+        print(f'Warning: {len(result.failures)} documents failed to index')
+
+    return results
+
+
+def report(results: typing.List[StageResult]):
+    print(f'{"stage":<10} {"seconds":>9} {"docs":>8} {"docs/s":>10} {"MB/s":>9} {"peak RSS MB":>12}')
+    for r in results:
+        print(f'{r.stage:<10} {r.seconds:9.2f} {r.docs:8d} {r.docs_per_sec:10.1f} {r.mb_per_sec:9.1f} '
+              f'{r.peak_rss / indexer.MB:12.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--dir', required=True, help='Corpus to load (eg as written by `benchmarks.corpus`)')
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--extractor', choices=sorted(ingest_main.EXTRACTORS), default='xpath')
+    parser.add_argument('--fast-json', action='store_true')
+    parser.add_argument('--bulk-concurrency', type=int, default=4)
+    parser.add_argument('--bulk-mb', type=float, default=5)
+    parser.add_argument('--es-hosts', type=str, nargs='+',
+                        help='Submit to this cluster, instead of a local stand-in (documents go to the pubmed index!)')
+    parser.add_argument('--latency', type=float, default=0.05, help='Stand-in: seconds per bulk request')
+    parser.add_argument('--latency-per-mb', type=float, default=0.02, help='Stand-in: additional seconds per MB')
+    parser.add_argument('--reject-items', type=float, default=0.0, help='Stand-in: fraction of items to reject (429)')
+    parser.add_argument('--json-out', type=str, help='Also write the results to this file')
+    args = parser.parse_args()
+
+    server = None
+    if args.es_hosts:
+        hosts = args.es_hosts
+    else:
+        server = bulk_server.start(latency=args.latency, latency_per_mb=args.latency_per_mb,
+                                   reject_items=args.reject_items, seed=0)
+        hosts = [server.host]
+    client = config.make_client(config.from_env()._replace(hosts=hosts))
+
+    try:
+        results = run(args.dir, client=client, workers=args.workers, extractor=args.extractor,
+                      fast_json=args.fast_json, bulk_concurrency=args.bulk_concurrency, bulk_mb=args.bulk_mb)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    report(results)
+    if server is not None:
+        print('Stand-in received:', json.dumps(server.stats.as_dict()))
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump([dict(r._asdict(), docs_per_sec=r.docs_per_sec, mb_per_sec=r.mb_per_sec) for r in results],
+                      f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Compare index size and ingest rate for each mapping profile (see `populate_es.make_mapping`)
+
+The same documents are loaded into one scratch index per profile, on a real cluster. Each index is then
+force-merged to a single segment, so that store sizes are comparable, and deleted again unless `--keep` is given.
+"""
+import argparse
+import json
+import time
+import typing
+
+from ingest import config
+from ingest import indexer
+from ingest import main as ingest_main
+from ingest import ndjson
+from ingest import populate_es
+from ingest import shards
+
+
+class ProfileResult(typing.NamedTuple):
+    profile: str
+    docs: int
+    seconds: float
+    body_bytes: int  # Size of the bulk requests sent
+    store_bytes: int  # After force-merging
+    segments_memory: int  # Heap used by the index's segments (terms, norms, etc)
+
+    @property
+    def docs_per_sec(self) -> float:
+        return self.docs / self.seconds
+
+    @property
+    def bytes_per_doc(self) -> float:
+        return self.store_bytes / self.docs
+
+
+def load_documents(*, dirname: str=None, from_shards: str=None, limit: int=None, workers: int=0) -> list:
+    if from_shards:
+        parsed = shards.iter_shards(from_shards)
+    else:
+        parsed = ingest_main.parse_all(ingest_main.find_files(dirname), workers=workers)
+    docs = []
+    for _, doc in parsed:
+        docs.append(doc)
+        if limit and len(docs) >= limit:
+            break
+    return docs
+
+
+def measure(profile: str, docs: list, *, sort_by_date: bool=False, bulk_concurrency: int=4,
+            keep: bool=False) -> ProfileResult:
+    client = populate_es.client
+    index = f'{populate_es.PROJECT_INDEX}_bench_{profile}'
+    populate_es.setup_index(drop=True, profile=profile, sort_by_date=sort_by_date, index=index)
+    client.indices.put_settings(index=index, body={'index.refresh_interval': '-1'})
+
+    items = [(None, *ndjson.encode_document(doc, index=index)) for doc in docs]
+    bulk = indexer.BulkIndexer(client, max_in_flight=bulk_concurrency)
+    t1 = time.perf_counter()
+    result = bulk.index_encoded(items)
+    client.indices.refresh(index=index)
+    seconds = time.perf_counter() - t1
+
+    client.indices.forcemerge(index=index, max_num_segments=1, request_timeout=60 * 60)
+    stats = client.indices.stats(index=index, metric='store,segments')['indices'][index]['primaries']
+
+    if not keep:
+        client.indices.delete(index=index)
+
+    return ProfileResult(profile, result.indexed, seconds, sum(len(data) for _, _, data in items),
+                         stats['store']['size_in_bytes'], stats['segments']['memory_in_bytes'])
+
+
+def report(results: typing.List[ProfileResult]):
+    base = results[0]
+    print(f'{"profile":<10} {"docs":>8} {"docs/s":>9} {"store MB":>9} {"KB/doc":>8} {"seg. mem MB":>12}  '
+          f'compared to {base.profile}')
+    for r in results:
+        print(f'{r.profile:<10} {r.docs:8d} {r.docs_per_sec:9.1f} {r.store_bytes / indexer.MB:9.1f} '
+              f'{r.bytes_per_doc / 1024:8.1f} {r.segments_memory / indexer.MB:12.2f} '
+              f' {r.store_bytes / base.store_bytes:.0%} size, {r.docs_per_sec / base.docs_per_sec:.1f}x rate')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--dir', type=str, help='A directory of NXML files (eg as written by `benchmarks.corpus`)')
+    source.add_argument('--from-shards', type=str, help='Already-parsed documents, as written by --export-shards')
+    parser.add_argument('--docs', type=int, default=10000, help='Maximum number of documents to load')
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--profiles', nargs='+', choices=populate_es.MAPPING_PROFILES,
+                        default=list(populate_es.MAPPING_PROFILES))
+    parser.add_argument('--sort-by-date', action='store_true', help='Create sorted indices (ES 6.0+)')
+    parser.add_argument('--bulk-concurrency', type=int, default=4)
+    parser.add_argument('--keep', action='store_true', help="Don't delete the scratch indices afterwards")
+    parser.add_argument('--es-hosts', type=str, nargs='+', help='Elasticsearch host(s) (default: ES_HOSTS)')
+    parser.add_argument('--json-out', type=str, help='Also write the results to this file')
+    args = parser.parse_args()
+
+    es_config = config.from_env()
+    if args.es_hosts:
+        es_config = es_config._replace(hosts=args.es_hosts)
+    populate_es.connect(es_config._replace(replicas=0))
+
+    docs = load_documents(dirname=args.dir, from_shards=args.from_shards, limit=args.docs, workers=args.workers)
+    results = [measure(profile, docs, sort_by_date=args.sort_by_date, bulk_concurrency=args.bulk_concurrency,
+                       keep=args.keep)
+               for profile in args.profiles]
+
+    report(results)
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump([dict(r._asdict(), docs_per_sec=r.docs_per_sec, bytes_per_doc=r.bytes_per_doc)
+                       for r in results], f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,428 @@
+"""
+Replay the dashboard's queries (see `frontend/js/es_query.js`) at a given concurrency, and report their latency
+
+Each template is run over a sweep of years and keywords. Reports client-side latency and ES's own `took` time
+(p50/p95/p99) per template, and with `--profile`, the query and aggregation components where ES spent the most time.
+
+Responses can be recorded (`--record`) and later served by a local stand-in (`--replay`), so that the client side
+of a change can be tried without a cluster.
+"""
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import http.server
+import itertools
+import json
+import math
+import random
+import socketserver
+import threading
+import time
+import typing
+
+from ingest import config
+from ingest import populate_es
+
+
+def year_histogram() -> dict:
+    """`getYearCounts`: articles per year"""
+    return {
+        "size": 0,
+        "aggregations": {
+            "by_year": {
+                "date_histogram": {
+                    "field": "date",
+                    "interval": "year"
+                }
+            }
+        }
+    }
+
+
+def _year_range(year: int) -> dict:
+    return {"range": {"date": {"gte": str(year), "lte": str(year + 1), "format": "yyyy"}}}
+
+
+def terms_for_year(year: int) -> dict:
+    """`getTermsForYear`: significant keywords in one year"""
+    return {
+        "query": _year_range(year),
+        "aggregations": {
+            "significantKeywords": {
+                "significant_terms": {"field": "keywords"}
+            }
+        }
+    }
+
+
+def keyword_drilldown(year: int, keyword: str) -> dict:
+    """The top-rated articles in a year that mention a keyword (the dashboard's planned third step)"""
+    return {
+        "query": {
+            "bool": {
+                "must": {"multi_match": {"query": keyword, "fields": ["title", "abstract", "body"]}},
+                "filter": [_year_range(year)],
+                "should": {"term": {"keywords": keyword}}
+            }
+        },
+        "_source": ["title", "journal", "date", "pmc"],
+        "highlight": {"fields": {"body": {}}},
+        "size": 10
+    }
+
+
+def passage_drilldown(year: int, keyword: str) -> dict:
+    """The same drill-down for an index built with `--passages`: articles ranked by their best passages"""
+    return {
+        "query": {
+            "bool": {
+                "must": {
+                    "has_child": {
+                        "type": populate_es.PASSAGE_TYPE,
+                        "query": {"match": {"text": keyword}},
+                        "score_mode": "max",
+                        "inner_hits": {"size": 3, "_source": ["section", "ordinal"],
+                                       "highlight": {"fields": {"text": {}}}}
+                    }
+                },
+                "filter": [_year_range(year)],
+                "should": {"term": {"keywords": keyword}}
+            }
+        },
+        "_source": ["title", "journal", "date", "pmc"],
+        "size": 10
+    }
+
+
+# Template name -> (function, names of the parameters it takes)
+TEMPLATES = {
+    'year_histogram': (year_histogram, ()),
+    'terms_for_year': (terms_for_year, ('year',)),
+    'keyword_drilldown': (keyword_drilldown, ('year', 'keyword')),
+    'passage_drilldown': (passage_drilldown, ('year', 'keyword')),
+}
+# Run by default; passage_drilldown needs an index built with --passages
+DASHBOARD_TEMPLATES = ['year_histogram', 'terms_for_year', 'keyword_drilldown']
+
+
+class Request(typing.NamedTuple):
+    template: str
+    params: dict
+    body: dict
+
+
+class Sample(typing.NamedTuple):
+    template: str
+    latency: float  # Seconds, as seen by the client
+    took: typing.Union[int, None]  # Milliseconds, as reported by ES
+    error: typing.Union[str, None]
+    profile: typing.Union[dict, None]
+
+
+def make_requests(templates: typing.Iterable[str], *, years: typing.List[int],
+                  keywords: typing.List[str]) -> typing.List[Request]:
+    """Every combination of parameters that each template takes"""
+    values = {'year': years, 'keyword': keywords}
+    requests = []
+    for name in templates:
+        fn, param_names = TEMPLATES[name]
+        for combination in itertools.product(*(values[p] for p in param_names)):
+            params = dict(zip(param_names, combination))
+            requests.append(Request(name, params, fn(**params)))
+    return requests
+
+
+def discover_years(client, index: str) -> typing.List[int]:
+    res = client.search(index=index, body=year_histogram())
+    return [int(b['key_as_string'][:4]) for b in res['aggregations']['by_year']['buckets'] if b['doc_count']]
+
+
+def discover_keywords(client, index: str, n: int) -> typing.List[str]:
+    body = {"size": 0, "aggregations": {"keywords": {"terms": {"field": "keywords", "size": n}}}}
+    res = client.search(index=index, body=body)
+    return [b['key'] for b in res['aggregations']['keywords']['buckets']]
+
+
+def request_key(index: str, body: dict) -> str:
+    """Identifies a request, for recording and replaying responses"""
+    return hashlib.sha1(json.dumps([index, body], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def run_load(client, requests: typing.List[Request], *,
+             index: str=populate_es.PROJECT_INDEX,
+             concurrency: int=4,
+             total: int=None,
+             duration: float=None,
+             profile: bool=False,
+             request_cache: bool=None,
+             seed: int=0,
+             recorder: typing.Callable[[str, dict, float], None]=None) -> typing.Tuple[typing.List[Sample], float]:
+    """
+    Send requests (chosen at random from the sweep) from `concurrency` threads, until `total` requests have been
+    sent or `duration` seconds have passed
+    :return: (samples, elapsed seconds)
+    """
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    sent = 0
+    samples = []
+    params = {}
+    if request_cache is not None:
+        params['request_cache'] = 'true' if request_cache else 'false'
+    deadline = time.perf_counter() + duration if duration else None
+
+    def next_request() -> typing.Union[Request, None]:
+        nonlocal sent
+        with lock:
+            if total is not None and sent >= total:
+                return None
+            if deadline is not None and time.perf_counter() >= deadline:
+                return None
+            sent += 1
+            return rng.choice(requests)
+
+    def worker():
+        while True:
+            request = next_request()
+            if request is None:
+                return
+            body = dict(request.body, profile=True) if profile else request.body
+            t1 = time.perf_counter()
+            try:
+                res = client.search(index=index, body=body, params=params)
+            except Exception as e:
+                sample = Sample(request.template, time.perf_counter() - t1, None, f'{type(e).__name__}: {e}', None)
+            else:
+                latency = time.perf_counter() - t1
+                sample = Sample(request.template, latency, res.get('took'), None, res.get('profile'))
+                if recorder is not None:
+                    recorder(request_key(index, body), res, latency)
+            with lock:
+                samples.append(sample)
+
+    t0 = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return samples, time.perf_counter() - t0
+
+
+def percentile(values: typing.List[float], p: float) -> typing.Union[float, None]:
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def profile_components(profile: dict) -> typing.Iterator[typing.Tuple[str, str, int]]:
+    """(section, component, nanoseconds) for every query and aggregation node in a `profile: true` response"""
+    def walk(section, node):
+        nanos = node.get('time_in_nanos')
+        if nanos is None and isinstance(node.get('time'), str) and node['time'].endswith('ms'):
+            nanos = int(float(node['time'][:-2]) * 1e6)
+        yield section, f'{node.get("type")} {node.get("description", "")[:80]}', nanos or 0
+        for child in node.get('children', []):
+            yield from walk(section, child)
+
+    for shard in profile.get('shards', []):
+        for search in shard.get('searches', []):
+            for node in search.get('query', []):
+                yield from walk('query', node)
+        for node in shard.get('aggregations', []):
+            yield from walk('aggregation', node)
+
+
+def summarize(samples: typing.List[Sample], elapsed: float, *, top_components: int=5) -> dict:
+    by_template = collections.defaultdict(list)
+    for sample in samples:
+        by_template[sample.template].append(sample)
+
+    summary = {}
+    for template, group in sorted(by_template.items()):
+        ok = [s for s in group if s.error is None]
+        latencies = [s.latency * 1000 for s in ok]
+        took = [s.took for s in ok if s.took is not None]
+        entry = {
+            'requests': len(group),
+            'errors': len(group) - len(ok),
+            'per_sec': len(group) / elapsed if elapsed else 0.0,
+            'latency_ms': {f'p{p}': percentile(latencies, p) for p in (50, 95, 99)},
+            'took_ms': {f'p{p}': percentile(took, p) for p in (50, 95, 99)},
+        }
+        if any(s.profile for s in ok):
+            totals = collections.Counter()
+            for s in ok:
+                for section, component, nanos in profile_components(s.profile or {}):
+                    totals[(section, component)] += nanos
+            entry['slowest_components'] = [
+                {'section': section, 'component': component, 'mean_ms': nanos / len(ok) / 1e6}
+                for (section, component), nanos in totals.most_common(top_components)]
+        summary[template] = entry
+    return summary
+
+
+def report(summary: dict):
+    def fmt(value):
+        return f'{value:8.1f}' if value is not None else '       -'
+
+    print(f'{"template":<18} {"reqs":>6} {"errs":>5} {"req/s":>7}   '
+          f'{"latency ms p50/p95/p99":^26}   {"took ms p50/p95/p99":^26}')
+    for template, entry in summary.items():
+        lat = entry['latency_ms']
+        took = entry['took_ms']
+        print(f'{template:<18} {entry["requests"]:6d} {entry["errors"]:5d} {entry["per_sec"]:7.1f}   '
+              f'{fmt(lat["p50"])}{fmt(lat["p95"])}{fmt(lat["p99"])}   '
+              f'{fmt(took["p50"])}{fmt(took["p95"])}{fmt(took["p99"])}')
+    for template, entry in summary.items():
+        if entry.get('slowest_components'):
+            print(f'\nSlowest components of {template} (mean per request):')
+            for c in entry['slowest_components']:
+                print(f'  {c["mean_ms"]:9.2f} ms  {c["section"]:<11} {c["component"]}')
+
+
+class Recorder:
+    """Save responses as JSON lines, for `ReplayServer`"""
+    def __init__(self, fn: str):
+        self._file = open(fn, 'w')
+        self._lock = threading.Lock()
+        self._seen = set()
+
+    def __call__(self, key: str, response: dict, latency: float):
+        with self._lock:
+            if key not in self._seen:
+                self._seen.add(key)
+                self._file.write(json.dumps({'key': key, 'latency': latency, 'response': response}) + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+class ReplayHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this, delayed ACKs add ~40 ms to every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._search()
+
+    def do_POST(self):
+        self._search()
+
+    def _search(self):
+        path = self.path.split('?')[0]
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not path.endswith('/_search'):
+            self._respond(200, {'version': {'number': '5.2.0'}})
+            return
+        index = path.strip('/').split('/')[0]
+        recorded = self.server.responses.get(request_key(index, json.loads(data.decode('utf-8'))))
+        if recorded is None:
+            reason = 'No recorded response for this request'
+            self._respond(404, {'error': {'root_cause': [{'type': 'replay', 'reason': reason}], 'type': 'replay',
+                                          'reason': reason}, 'status': 404})
+            return
+        # Take as long as the real cluster did
+        time.sleep(recorded['latency'] if self.server.use_latency else recorded['response'].get('took', 0) / 1000)
+        self._respond(200, recorded['response'])
+
+    def _respond(self, status: int, data: dict):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class ReplayServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Serves recorded search responses, after the recorded delay"""
+    daemon_threads = True
+
+    def __init__(self, address, fn: str, *, use_latency: bool=True):
+        """
+        :param use_latency: Delay each response by the client latency that was recorded (otherwise by `took`)
+        """
+        super().__init__(address, ReplayHandler)
+        self.use_latency = use_latency
+        self.responses = {}
+        with open(fn) as f:
+            for line in f:
+                recorded = json.loads(line)
+                self.responses[recorded['key']] = recorded
+
+    @property
+    def host(self) -> str:
+        return '{}:{}'.format(*self.server_address[:2])
+
+
+def start_replay(fn: str, host: str='127.0.0.1', port: int=0, *, use_latency: bool=True) -> ReplayServer:
+    """Run a `ReplayServer` in a background thread (call `shutdown` to stop it)"""
+    server = ReplayServer((host, port), fn, use_latency=use_latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--templates', nargs='+', choices=sorted(TEMPLATES), default=DASHBOARD_TEMPLATES)
+    parser.add_argument('--years', type=int, nargs='+', help='Years to query (default: every year in the index)')
+    parser.add_argument('--keywords', nargs='+', help='Keywords to query (default: the most common in the index)')
+    parser.add_argument('--n-keywords', type=int, default=20, help='How many keywords to find, without --keywords')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=500, help='Total requests to send')
+    parser.add_argument('--duration', type=float, help='Instead of --requests, send requests for this many seconds')
+    parser.add_argument('--warmup', type=int, default=0, help='Requests to send (and ignore) first')
+    parser.add_argument('--profile', action='store_true', help='Use the profile API to break down slow requests')
+    parser.add_argument('--request-cache', choices=['true', 'false'],
+                        help="Override the index's shard request cache setting")
+    parser.add_argument('--index', default=populate_es.PROJECT_INDEX)
+    parser.add_argument('--es-hosts', type=str, nargs='+', help='Elasticsearch host(s) (default: ES_HOSTS)')
+    parser.add_argument('--record', type=str, help='Save responses to this file, for --replay')
+    parser.add_argument('--replay', type=str, help='Serve responses recorded with --record, instead of using ES')
+    parser.add_argument('--replay-delay', choices=['latency', 'took'], default='latency',
+                        help='With --replay, delay each response by the recorded client latency, or by `took`')
+    parser.add_argument('--json-out', type=str, help='Also write the summary to this file')
+    args = parser.parse_args()
+
+    server = None
+    es_config = config.from_env()._replace(maxsize=max(args.concurrency, 10))
+    if args.replay:
+        server = start_replay(args.replay, use_latency=args.replay_delay == 'latency')
+        es_config = es_config._replace(hosts=[server.host])
+    elif args.es_hosts:
+        es_config = es_config._replace(hosts=args.es_hosts)
+    client = config.make_client(es_config)
+
+    years = args.years or discover_years(client, args.index)
+    keywords = args.keywords or discover_keywords(client, args.index, args.n_keywords)
+    requests = make_requests(args.templates, years=years, keywords=keywords)
+    print(f'{len(requests)} distinct requests ({len(years)} years, {len(keywords)} keywords)')
+
+    request_cache = None if args.request_cache is None else args.request_cache == 'true'
+    options = dict(index=args.index, concurrency=args.concurrency, profile=args.profile, request_cache=request_cache)
+    recorder = Recorder(args.record) if args.record else None
+    try:
+        if args.warmup:
+            run_load(client, requests, total=args.warmup, recorder=recorder, **options)
+        samples, elapsed = run_load(client, requests, total=None if args.duration else args.requests,
+                                    duration=args.duration, recorder=recorder, **options)
+    finally:
+        if recorder is not None:
+            recorder.close()
+        if server is not None:
+            server.shutdown()
+
+    summary = summarize(samples, elapsed)
+    report(summary)
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -66,8 +66,57 @@ function getTermsForYear(date) {
     });
 }
 
+var ROLLUP_URL = 'http://localhost:9200/pubmed_rollup/summary/_search';
+
+/**
+ * Precomputed versions of the queries above, read from the rollup index (see `ingest/rollup.py`; requires loading
+ *  with `--rollup`). These read a few small documents instead of aggregating over every article.
+ */
+function getRollup(filters, sort, size) {
+    var query = {
+        size: size,
+        query: {bool: {filter: filters}},
+        sort: sort
+    };
+    return getData(query, ROLLUP_URL).then(function (res) {
+        return res.hits.hits.map(function (hit) {
+            return hit._source;
+        });
+    });
+}
+
+function getYearCountsFromRollup() {
+    return getRollup([{term: {kind: 'year'}}], [{year: 'asc'}], 10000).then(function (docs) {
+        return docs.map(function (doc) {
+            return {
+                date: new Date(String(doc.year)),
+                count: doc.count
+            };
+        });
+    });
+}
+
+/**
+ * Most frequent (rather than most significant) keywords in a year
+ * @param date
+ * @returns {*}
+ */
+function getTopTermsForYear(date) {
+    var filters = [{term: {kind: 'keyword'}}, {term: {year: date.getFullYear()}}];
+    return getRollup(filters, [{count: 'desc'}], 10).then(function (docs) {
+        return docs.map(function (doc) {
+            return {
+                key: doc.term,
+                count: doc.count
+            };
+        });
+    });
+}
+
 module.exports = {
     getData: getData,
     getYearCounts: getYearCounts,
-    getTermsForYear: getTermsForYear
+    getTermsForYear: getTermsForYear,
+    getYearCountsFromRollup: getYearCountsFromRollup,
+    getTopTermsForYear: getTopTermsForYear
 };
\ No newline at end of file
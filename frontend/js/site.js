@@ -11,18 +11,35 @@ var margin = {top: 20, right: 30, bottom: 30, left: 40},
     height = 300 - margin.top - margin.bottom;
 
 
-var histogramData = esQuery.getYearCounts();
+/**
+ * Read precomputed results from the rollup index (kept up to date by `ingest.main --rollup`), so that the dashboard
+ *  does not aggregate over the whole corpus. Only if there is no rollup index, fall back to the live aggregation.
+ */
+function fromRollup(rollupQuery, liveQuery) {
+    return rollupQuery().then(null, function (xhr) {
+        if (xhr && xhr.status === 404) {
+            return liveQuery();
+        }
+        throw xhr;
+    });
+}
+
+
+var histogramData = fromRollup(esQuery.getYearCountsFromRollup, esQuery.getYearCounts);
 var yearChart = drawCharts.yearBarChart();
 
 histogramData.then(function (data) {
     var selection = d3.select('#yearHisto');
     selection.call(yearChart, data);
-// }).then(function (bars) {
-//     bars.on('click', function (d) {
-//         var res = esQuery.getTermsForYear(d.date).then(function(res) {
-//             console.log('Significant terms are?', res)
-//         });
-//     });
+    selection.selectAll('.bars').on('click', function (d) {
+        fromRollup(function () {
+            return esQuery.getTopTermsForYear(d.date);
+        }, function () {
+            return esQuery.getTermsForYear(d.date);
+        }).then(function (res) {
+            console.log('Top terms are?', res);
+        });
+    });
 });
 
 
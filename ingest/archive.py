@@ -0,0 +1,94 @@
+"""
+Read articles directly out of the bulk `.tar.gz` packages distributed by NCBI
+https://www.ncbi.nlm.nih.gov/pmc/tools/openftlist/
+
+Archives are read as a stream: each `.nxml` member is decompressed into memory and handed to the parser, so the
+(multi-GB, millions of files) bundles never need to be extracted to disk.
+"""
+import io
+import logging
+import queue
+import tarfile
+import threading
+import typing
+
+from lxml import etree
+
+from ingest import parse_nxml
+
+logger = logging.getLogger(__name__)
+
+
+class Member(typing.NamedTuple):
+    """The contents of a single article file, read from inside an archive"""
+    name: str  # Of the form `archive.tar.gz:path/to/member.nxml`
+    data: bytes
+    size: int
+    mtime: int
+
+
+def iter_members(archive_fn: str) -> typing.Iterator[Member]:
+    """Stream every `.nxml` file out of a (possibly compressed) tar archive, in archive order"""
+    # Streaming mode (`|`) reads the archive front to back without seeking
+    with tarfile.open(archive_fn, mode='r|*') as tf:
+        for info in tf:
+            if not info.isfile() or not info.name.endswith('.nxml'):
+                continue
+            data = tf.extractfile(info).read()
+            yield Member(f'{archive_fn}:{info.name}', data, info.size, int(info.mtime))
+
+
+def iter_archives(archive_fns: typing.Iterable[str], *, prefetch: int=0) -> typing.Iterator[Member]:
+    """
+    Stream `.nxml` members out of several archives, one after another
+
+    :param archive_fns: Paths to the archives to read
+    :param prefetch: If non-zero, decompress in a background thread, keeping up to this many members read ahead.
+        This lets decompression overlap with parsing and indexing.
+    """
+    members = (member for fn in archive_fns for member in iter_members(fn))
+    if prefetch:
+        members = _read_ahead(members, prefetch)
+    return members
+
+
+def parse_member(member: Member, *,
+                 parser: etree.XMLParser=parse_nxml.parser,
+                 parse_fn: typing.Callable=parse_nxml.parse_nxml) -> dict:
+    """Parse an archive member from memory, without writing it to disk"""
+    return parse_fn(io.BytesIO(member.data), parser=parser)
+
+
+_DONE = object()
+
+
+def _read_ahead(items: typing.Iterator, maxsize: int) -> typing.Iterator:
+    """Consume an iterator in a background thread, buffering at most `maxsize` items"""
+    buffer = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def fill():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                buffer.put(item)
+        except Exception as e:
+            buffer.put(e)
+        buffer.put(_DONE)
+
+    thread = threading.Thread(target=fill, name='archive-reader', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        # Unblock the reader if it is waiting for space, so that it can notice the stop signal and exit
+        while not buffer.empty():
+            buffer.get_nowait()
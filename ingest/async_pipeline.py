@@ -0,0 +1,258 @@
+"""
+An asyncio ingestion pipeline, in which finding files, parsing, and indexing all happen at the same time
+
+Stages are connected by bounded queues:
+
+    discover files --> parse (process pool) --> build batches --> N concurrent bulk requests
+
+When ES is slow to respond, the queues fill up and the earlier stages wait, instead of buffering an unbounded
+number of parsed documents in memory.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import os
+import typing
+
+import elasticsearch
+
+from ingest import config
+from ingest import indexer
+from ingest import metrics
+from ingest import ndjson
+from ingest import parallel
+from ingest import parse_nxml
+from ingest import populate_es
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the items in a queue
+_DONE = object()
+
+
+def make_async_client(es_config: config.ESConfig):
+    """Create an ES client that uses the asyncio transport (provided by the `elasticsearch-async` package)"""
+    try:
+        import elasticsearch_async
+    except ImportError:
+        raise RuntimeError('The asyncio pipeline requires the elasticsearch-async package')
+    # No `maxsize`: the aiohttp connection ignores it. Requests in flight are limited by the pipeline instead (one
+    # per `_submit` task, so at most `bulk_concurrency`).
+    return elasticsearch_async.AsyncElasticsearch(es_config.hosts,
+                                                  timeout=es_config.timeout,
+                                                  max_retries=es_config.max_retries,
+                                                  retry_on_timeout=True,
+                                                  serializer=config.Serializer())
+
+
+def _take(items: typing.Iterator, n: int) -> list:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= n:
+            break
+    return chunk
+
+
+class Pipeline:
+    """
+    Parse and index a stream of sources
+
+    :param client: An ES client whose `bulk` method is a coroutine (see `make_async_client`)
+    :param parse_fn: The extractor to run in worker processes. If None, the sources are already-parsed
+        (name, document) pairs.
+    :param encode: Serialize each document straight to bytes (see `ndjson`), instead of with the client
+    :param stats: Receives parse times and the outcome of each bulk request
+    """
+    def __init__(self, client, *,
+                 parse_fn: typing.Union[typing.Callable, None]=parse_nxml.parse_nxml,
+                 workers: int=0,
+                 chunk_size: int=16,
+                 bulk_concurrency: int=4,
+                 batch_bytes: int=5 * indexer.MB,
+                 queue_size: int=None,
+                 encode: bool=False,
+                 stats: metrics.RunStats=metrics.NULL):
+        self.client = client
+        self.parse_fn = parse_fn
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.bulk_concurrency = bulk_concurrency
+        self.encode = encode
+        self.stats = stats
+        queue_size = queue_size or self.workers * 2
+
+        # Batch sizing and retries work as in the synchronous indexer
+        self.sizer = indexer.BatchSizer(batch_bytes)
+        self.retry = indexer.RetryPolicy()
+
+        self.sources = asyncio.Queue(maxsize=queue_size)  # Chunks of sources to parse
+        self.docs = asyncio.Queue(maxsize=queue_size)  # Chunks of (name, document) pairs
+        self.batches = asyncio.Queue(maxsize=bulk_concurrency)  # Serialized bulk requests
+
+        self.indexed = 0
+        self.types = collections.Counter()
+        self.retries = 0
+        self.requests = 0
+        self.index_failures = []
+
+    async def run(self, sources: typing.Iterable, *,
+                  on_ack: typing.Callable[[list], None]=None,
+                  on_batch: typing.Callable[[indexer.BatchOutcome], None]=None,
+                  on_document: typing.Callable[[dict], None]=None,
+                  on_item: typing.Callable[[str], None]=None,
+                  failures: list=None) -> indexer.IndexResult:
+        """
+        :param sources: File paths or archive members (or (name, document) pairs, if there is no parse_fn)
+        :param on_ack: Called with the names of the sources whose documents have been indexed
+        :param on_batch: Called with the full `indexer.BatchOutcome` each time a batch completes
+        :param on_document: Called with each parsed document, before it is sent
+        :param on_item: Called with the source name of each item (an article, part or passage), before it is sent
+        :param failures: If provided, receives a `parallel.ParseFailure` for each file that could not be parsed
+        """
+        loop = asyncio.get_event_loop()
+        pool = None
+        if self.parse_fn is not None:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=parallel.init_worker)
+        n_parsers = self.workers if pool else 1
+
+        stages = [loop.create_task(self._discover(iter(sources), n_parsers))]
+        stages.extend(loop.create_task(self._parse(pool, failures)) for _ in range(n_parsers))
+        stages.append(loop.create_task(self._batch(n_parsers, on_document, on_item)))
+        stages.extend(loop.create_task(self._submit(on_ack, on_batch)) for _ in range(self.bulk_concurrency))
+
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            for stage in stages:
+                stage.cancel()
+            if pool is not None:
+                pool.shutdown()
+
+        return indexer.IndexResult(self.indexed, self.index_failures, self.retries, self.requests, dict(self.types))
+
+    async def _discover(self, sources: typing.Iterator, n_parsers: int):
+        """Read the list of sources in a thread, so that slow directory walks (or decompression) don't block"""
+        loop = asyncio.get_event_loop()
+        while True:
+            chunk = await loop.run_in_executor(None, _take, sources, self.chunk_size)
+            if not chunk:
+                break
+            await self.sources.put(chunk)
+        for _ in range(n_parsers):
+            await self.sources.put(_DONE)
+
+    async def _parse(self, pool: concurrent.futures.Executor, failures: typing.Union[list, None]):
+        loop = asyncio.get_event_loop()
+        while True:
+            chunk = await self.sources.get()
+            if chunk is _DONE:
+                await self.docs.put(_DONE)
+                return
+            if pool is None:
+                await self.docs.put(chunk)
+                continue
+
+            parsed = []
+            for name, result, error, seconds in await loop.run_in_executor(pool, parallel.parse_chunk, chunk,
+                                                                           self.parse_fn):
+                if error is None:
+                    self.stats.file_parsed(name, seconds)
+                    parsed.extend((name, doc) for doc in parallel.as_documents(result))
+                else:
+                    logger.warning(f'Failed to parse {name}: {error}')
+                    self.stats.parse_failed(name)
+                    if failures is not None:
+                        failures.append(parallel.ParseFailure(name, error))
+            await self.docs.put(parsed)
+
+    async def _batch(self, n_parsers: int, on_document: typing.Union[typing.Callable, None],
+                     on_item: typing.Union[typing.Callable, None]):
+        """Serialize documents and group them into requests of the (adaptive) target size"""
+        serializer = self.client.transport.serializer
+        batch = []
+        size = 0
+        finished = 0
+        while finished < n_parsers:
+            chunk = await self.docs.get()
+            if chunk is _DONE:
+                finished += 1
+                continue
+            for name, doc in chunk:
+                if on_document is not None:
+                    on_document(doc)
+                # One item for the article, and one for each of its passages (if any)
+                if self.encode:
+                    items = [indexer.Item(name, _id, data) for _id, data in ndjson.encode_documents(doc)]
+                else:
+                    items = [indexer.serialize_action(serializer, name, action)
+                             for action in populate_es.make_bulk_actions([doc])]
+                for item in items:
+                    if on_item is not None:
+                        on_item(name)
+                    item_bytes = indexer.item_size(item)
+                    if batch and size + item_bytes > self.sizer.batch_bytes:
+                        await self.batches.put(batch)
+                        batch = []
+                        size = 0
+                    batch.append(item)
+                    size += item_bytes
+        if batch:
+            await self.batches.put(batch)
+        for _ in range(self.bulk_concurrency):
+            await self.batches.put(_DONE)
+
+    async def _submit(self, on_ack: typing.Union[typing.Callable, None], on_batch: typing.Union[typing.Callable, None]):
+        while True:
+            batch = await self.batches.get()
+            if batch is _DONE:
+                return
+            outcome = await self._send(batch)
+            self.indexed += len(outcome.acked)
+            self.types.update(outcome.types)
+            self.retries += outcome.retries
+            self.requests += outcome.requests
+            self.index_failures.extend(outcome.failures)
+            self.sizer.adapt(outcome)
+            self.stats.bulk_completed(outcome)
+            if on_batch is not None:
+                on_batch(outcome)
+            if on_ack is not None and outcome.acked:
+                on_ack(outcome.acked)
+
+    async def _send(self, items: list) -> indexer.BatchOutcome:
+        """Send one batch, resending any items that ES rejected as overloaded (see `indexer.BatchSend`)"""
+        loop = asyncio.get_event_loop()
+        send = indexer.BatchSend(items, self.retry)
+        while send.pending:
+            t1 = loop.time()
+            try:
+                response = await indexer.post_bulk(self.client, send.pending)
+            except elasticsearch.TransportError as e:
+                delay = send.failed(e, loop.time() - t1)
+            else:
+                delay = send.responded(response, loop.time() - t1)
+            if delay is not None:
+                await asyncio.sleep(delay)
+        return send.outcome()
+
+
+def run(sources: typing.Iterable, *, es_config: config.ESConfig, **kwargs) -> indexer.IndexResult:
+    """
+    Run the asyncio pipeline to completion, from synchronous code
+
+    :param kwargs: Options for `Pipeline` and `Pipeline.run`
+    """
+    run_kwargs = {key: kwargs.pop(key)
+                  for key in ('on_ack', 'on_batch', 'on_document', 'on_item', 'failures')
+                  if key in kwargs}
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    client = make_async_client(es_config)
+    try:
+        pipeline = Pipeline(client, **kwargs)
+        return loop.run_until_complete(pipeline.run(sources, **run_kwargs))
+    finally:
+        client.transport.close()
+        loop.close()
@@ -0,0 +1,178 @@
+"""
+Track which source files have already been indexed, so that repeat runs only process new or changed articles
+
+The manifest is a small SQLite database recording the size, mtime, and content hash of every file that ES has
+acknowledged. A file is only recorded once every document made from it (an article may be split into several) has
+been indexed successfully, so an interrupted run resumes from the last acknowledged batch rather than from the
+beginning, and a file with any failed document is tried again next time.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import typing
+
+from ingest import archive
+
+logger = logging.getLogger(__name__)
+
+
+class FileState(typing.NamedTuple):
+    size: int
+    mtime: int
+    digest: str
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+class Checkpoint:
+    """A persistent record of source files that have been indexed"""
+    def __init__(self, path: str):
+        self.path = path
+        # Files may be checked in one thread (eg while listing sources) and acknowledged in another
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS files (key TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digest TEXT)')
+        self._conn.commit()
+
+        # Files that have been seen in this run but not yet acknowledged by ES
+        self._pending = {}  # type: typing.Dict[str, FileState]
+        # For files whose documents are counted by `expect`: [documents sent, documents acknowledged]
+        self._counts = {}  # type: typing.Dict[str, typing.List[int]]
+        # The file whose documents are still being sent (so its count is not final)
+        self._open = None
+
+    def close(self):
+        self._conn.close()
+
+    def reset(self):
+        """Forget every file (eg because the index is being rebuilt from scratch)"""
+        self._conn.execute('DELETE FROM files')
+        self._conn.commit()
+
+    def lookup(self, key: str) -> typing.Union[FileState, None]:
+        with self._lock:
+            row = self._conn.execute('SELECT size, mtime, digest FROM files WHERE key = ?', (key,)).fetchone()
+        return FileState(*row) if row else None
+
+    def needs_indexing(self, key: str, size: int, mtime: int, read: typing.Callable[[], bytes]) -> bool:
+        """
+        Decide whether a file must be (re)indexed. Size and mtime are checked first, so that unchanged files are
+        skipped without reading them; a file whose contents are identical despite a new mtime is also skipped.
+
+        :param key: A unique name for the file
+        :param read: Called to get the file contents, only if a content hash is needed
+        """
+        known = self.lookup(key)
+        if known is not None and (known.size, known.mtime) == (size, mtime):
+            return False
+
+        state = FileState(size, mtime, content_hash(read()))
+        if known is not None and known.digest == state.digest:
+            # Touched but not modified; remember the new mtime so that next time the cheap check is enough
+            self._save([(key, state)])
+            return False
+
+        with self._lock:
+            self._pending[key] = state
+        return True
+
+    def filter_changed(self, sources: typing.Iterable) -> typing.Iterator:
+        """Yield only the sources (file paths or archive members) that are new or have changed"""
+        skipped = 0
+        for source in sources:
+            if isinstance(source, archive.Member):
+                changed = self.needs_indexing(source.name, source.size, source.mtime, lambda: source.data)
+            else:
+                stat = os.stat(source)
+                changed = self.needs_indexing(source, stat.st_size, int(stat.st_mtime), lambda: _read(source))
+
+            if changed:
+                yield source
+            else:
+                skipped += 1
+        logger.info(f'Skipped {skipped} unchanged files')
+
+    def expect(self, key: str):
+        """
+        Count a document that is about to be sent for a file. All documents from one file must be sent before any
+        from the next, so that a file's count is final once another file's documents start.
+        """
+        with self._lock:
+            if key != self._open:
+                self._close()
+                self._open = key
+            self._counts.setdefault(key, [0, 0])[0] += 1
+
+    def track(self, tracked: typing.Iterable[tuple]) -> typing.Iterator[tuple]:
+        """Pass along (source key, ...) tuples, calling `expect` for each"""
+        for item in tracked:
+            self.expect(item[0])
+            yield item
+        self.finish()
+
+    def finish(self):
+        """Call once every document has been sent (`track` does this itself)"""
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        key, self._open = self._open, None
+        if key is not None:
+            self._save(self._complete([key]))
+
+    def acknowledge(self, keys: typing.Iterable[str]):
+        """
+        Record that documents from these files have been indexed (one key per document). Files counted by
+        `expect` are saved once all of their documents are acknowledged; others are saved immediately.
+        """
+        with self._lock:
+            acked = []
+            for key in keys:
+                counts = self._counts.get(key)
+                if counts is not None:
+                    counts[1] += 1
+                acked.append(key)
+            self._save(self._complete(acked))
+
+    def failed(self, keys: typing.Iterable[str]):
+        """Documents from these files could not be indexed; leave the files to be processed again next run"""
+        with self._lock:
+            for key in keys:
+                self._pending.pop(key, None)
+                self._counts.pop(key, None)
+
+    def completed(self, outcome):
+        """Record the result of one batch (an `indexer.BatchOutcome`); for use as an `on_batch` callback"""
+        self.failed(failure.token for failure in outcome.failures)
+        self.acknowledge(outcome.acked)
+
+    def _complete(self, keys: typing.Iterable[str]) -> typing.List[typing.Tuple[str, FileState]]:
+        """Take the files among these that have had all of their documents acknowledged, to be saved"""
+        entries = []
+        for key in keys:
+            counts = self._counts.get(key)
+            if counts is not None:
+                if key == self._open or counts[1] < counts[0]:
+                    continue
+                del self._counts[key]
+            if key in self._pending:
+                entries.append((key, self._pending.pop(key)))
+        return entries
+
+    def _save(self, entries: typing.List[typing.Tuple[str, FileState]]):
+        if not entries:
+            return
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO files (key, size, mtime, digest) VALUES (?, ?, ?, ?)',
+                                   [(key, *state) for key, state in entries])
+            self._conn.commit()
+
+
+def _read(fn: str) -> bytes:
+    with open(fn, 'rb') as f:
+        return f.read()
@@ -0,0 +1,50 @@
+"""
+Connection and index settings for the elasticsearch cluster
+
+Values are read from environment variables, and can be overridden from the command line. The defaults describe a
+single local node (as used for development).
+"""
+import os
+import typing
+
+import elasticsearch
+import elasticsearch.serializer
+
+
+class ESConfig(typing.NamedTuple):
+    hosts: typing.List[str]
+    timeout: float  # Seconds to wait for a response (bulk requests to a busy cluster can be slow)
+    maxsize: int  # Connections per host; should be at least the number of concurrent bulk requests
+    max_retries: int  # Retries for failed connections (in addition to any bulk item retries)
+
+    # "Production" settings for the index, restored after a bulk load
+    replicas: int
+    refresh_interval: str
+
+
+def from_env(environ: typing.Mapping[str, str]=os.environ) -> ESConfig:
+    return ESConfig(
+        hosts=environ.get('ES_HOSTS', 'localhost:9200').split(','),
+        timeout=float(environ.get('ES_TIMEOUT', 60)),
+        maxsize=int(environ.get('ES_MAXSIZE', 10)),
+        max_retries=int(environ.get('ES_MAX_RETRIES', 3)),
+        replicas=int(environ.get('ES_REPLICAS', 1)),
+        refresh_interval=environ.get('ES_REFRESH_INTERVAL', '1s'),
+    )
+
+
+class Serializer(elasticsearch.serializer.JSONSerializer):
+    """The client's usual JSON serializer, except that an already-encoded (bytes) body is sent unchanged"""
+    def dumps(self, data):
+        if isinstance(data, bytes):
+            return data
+        return super().dumps(data)
+
+
+def make_client(config: ESConfig) -> elasticsearch.Elasticsearch:
+    return elasticsearch.Elasticsearch(config.hosts,
+                                       timeout=config.timeout,
+                                       maxsize=config.maxsize,
+                                       max_retries=config.max_retries,
+                                       retry_on_timeout=True,
+                                       serializer=Serializer())
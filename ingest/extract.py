@@ -0,0 +1,453 @@
+"""
+Single-pass extraction of article fields from NXML
+
+`parse_nxml.parse_nxml` evaluates a separate XPath expression for each field, and several of these scan the entire
+document. This module produces the same output from one traversal of the tree: lxml yields only the elements of
+interest (in document order), and we dispatch on each element's tag to decide which field it belongs to. Large
+blocks of text (eg the body) are gathered with `itertext`, which avoids building an XPath "smart string" for every
+text node.
+"""
+import html
+import typing
+
+from lxml import etree
+
+from ingest import parse_nxml
+from ingest import passages
+
+
+def _unescape(text: str) -> str:
+    # Most text contains no entities at all; skip the unescape call for it
+    return html.unescape(text) if '&' in text else text
+
+
+def _first(texts: list) -> typing.Union[str, None]:
+    """Equivalent to `parse_nxml.one_or_none`"""
+    return _unescape(texts[0]) if texts else None
+
+
+def _all_text(node) -> str:
+    """Equivalent to `unescape_text(x_node_text(node))`"""
+    return _unescape(' '.join(node.itertext()))
+
+
+def _direct_text(node) -> typing.List[str]:
+    """The text nodes that are direct children of this node; equivalent to `path/text()`"""
+    texts = [] if node.text is None else [node.text]
+    texts.extend(child.tail for child in node if child.tail is not None)
+    return texts
+
+
+def _has_path(node, path: typing.Tuple[str, ...]) -> bool:
+    """Check that a node is at the specified absolute path, eg ('article', 'body')"""
+    for tag in reversed(path):
+        if node is None or node.tag != tag:
+            return False
+        node = node.getparent()
+    return node is None
+
+
+class _Fields:
+    """Accumulates every field of an article as the relevant elements are encountered"""
+    def __init__(self, as_passages: bool=False):
+        self.as_passages = as_passages
+        self.journal = []
+        self.article_meta = None
+        self.body = []
+        self.body_node = None
+        self.captions = []
+        self.acknowledgments = []
+
+    ###
+    # Handlers, by element tag
+    ###
+    def on_journal_title(self, node):
+        if _has_path(node, ('article', 'front', 'journal-meta', 'journal-title-group', 'journal-title')):
+            self.journal.extend(_direct_text(node))
+
+    def on_article_meta(self, node):
+        # Like `x_article_meta(doc)[0]`, only the first article-meta is used
+        if self.article_meta is None and _has_path(node, ('article', 'front', 'article-meta')):
+            self.article_meta = node
+
+    def on_body(self, node):
+        if _has_path(node, ('article', 'body')):
+            if self.as_passages:
+                # Split up when the result is assembled; only the first body is used, as for the flattened text
+                if self.body_node is None:
+                    self.body_node = node
+            else:
+                self.body.extend(node.itertext())
+
+    def on_fig(self, node):
+        for child in node:
+            if child.tag == 'caption':
+                self.captions.append(_all_text(child))
+
+    def on_ack(self, node):
+        if _has_path(node, ('article', 'back', 'ack')):
+            for child in node:
+                if child.tag == 'p':
+                    self.acknowledgments.extend(_direct_text(child))
+
+    def result(self) -> dict:
+        if self.article_meta is None:
+            raise ValueError('Document has no /article/front/article-meta')
+        meta = _article_meta_fields(self.article_meta)
+        result = {
+            # `one_text` unescapes this twice; preserve that so that both extractors agree exactly
+            "journal": _unescape(_first(self.journal)) if self.journal else None,
+
+            "title": meta["title"],
+            "authors": meta["authors"],
+
+            "abstract": meta["abstract"],
+            "keywords": meta["keywords"],
+
+            "body": _unescape(' '.join(self.body)),
+            "figure_captions": self.captions,
+            "acknowledgments": _unescape(' '.join(self.acknowledgments)),
+
+            "date": meta["date"],
+            "volume": meta["volume"],
+            "issue": meta["issue"],
+            "fpage": meta["fpage"],
+
+            "pmid": meta["pmid"],
+            "pmc": meta["pmc"],
+            "doi": meta["doi"]
+        }
+        if self.as_passages:
+            passages.attach(result, self.body_node)
+        return result
+
+
+_HANDLERS = {
+    'journal-title': _Fields.on_journal_title,
+    'article-meta': _Fields.on_article_meta,
+    'body': _Fields.on_body,
+    'fig': _Fields.on_fig,
+    'ack': _Fields.on_ack,
+}
+
+
+def _article_meta_fields(article_meta) -> dict:
+    """Fields that come from the (small) article-meta section; one pass over its direct children"""
+    title = []
+    authors = []
+    abstracts = []
+    keywords = []
+    pub_date = None
+    meta = {'volume': [], 'issue': [], 'fpage': []}
+    ids = {'pmid': [], 'pmc': [], 'doi': []}
+
+    for node in article_meta:
+        tag = node.tag
+        if tag == 'title-group':
+            for child in node:
+                if child.tag == 'article-title':
+                    title.extend(_direct_text(child))
+        elif tag == 'contrib-group':
+            for child in node:
+                if child.tag == 'contrib' and child.get('contrib-type') == 'author':
+                    authors.append(parse_nxml.contrib_node_to_names(child))
+        elif tag == 'abstract':
+            abstracts.append(_all_text(node))
+        elif tag == 'kwd-group':
+            for child in node:
+                if child.tag == 'kwd':
+                    keywords.extend(_unescape(s) for s in _direct_text(child))
+        elif tag == 'pub-date':
+            if pub_date is None:
+                pub_date = node
+        elif tag in meta:
+            meta[tag].extend(_direct_text(node))
+        elif tag == 'article-id':
+            id_type = node.get('pub-id-type')
+            if id_type in ids:
+                ids[id_type].extend(_direct_text(node))
+
+    return {
+        "title": _unescape(_first(title)) if title else None,
+        "authors": authors,
+        # Each article can have multiple abstracts (eg graphical vs regular)
+        "abstract": abstracts,
+        "keywords": keywords,
+        "date": parse_nxml.pub_date_to_iso(pub_date),
+        "volume": _first(meta['volume']),
+        "issue": _first(meta['issue']),
+        "fpage": _first(meta['fpage']),
+        "pmid": _first(ids['pmid']),
+        "pmc": _first(ids['pmc']),
+        "doi": _first(ids['doi'])
+    }
+
+
+def extract_fields(doc: etree._ElementTree, *, as_passages: bool=False) -> dict:
+    """Extract all fields of an article from a parsed document, in a single traversal"""
+    fields = _Fields(as_passages)
+    for node in doc.getroot().iter(*_HANDLERS):
+        _HANDLERS[node.tag](fields, node)
+    return fields.result()
+
+
+def parse(fn, *, parser: etree.XMLParser=parse_nxml.parser, as_passages: bool=False) -> dict:
+    """A drop-in replacement for `parse_nxml.parse_nxml`, using single-pass extraction"""
+    return extract_fields(etree.parse(fn, parser=parser), as_passages=as_passages)
+
+
+###
+# Streaming extraction, for articles too large to hold in memory as a tree
+###
+class _Frame(typing.NamedTuple):
+    """Where an open element's text should go (see `_StreamState.enter`)"""
+    mode: typing.Union[str, None]  # A name for the context the element appears in
+    direct: typing.Union[list, None]  # Collects text nodes that are direct children of the element
+    deep: tuple  # Collectors for all descendant text
+    keep: bool  # Whether the subtree is kept intact until the element ends (rather than discarded as it streams)
+
+
+class _BodyText:
+    """
+    Accumulates body text, up to a maximum size
+
+    Once the limit is reached, further text is either discarded (truncate), or the text collected so far is set
+    aside as completed parts and a new part is started (split). Each text node is unescaped as it arrives (which
+    gives the same result as unescaping the joined text, since entities never contain the joining space), so
+    that text carried over from one part to the next is never unescaped twice.
+    """
+    def __init__(self, max_chars: typing.Union[int, None], split: bool):
+        self.max_chars = max_chars
+        self.split = split
+        self.parts = []  # Completed parts that have not been taken yet (see `take_parts`)
+        self.current = []
+        self.size = 0
+        self.truncated = False
+
+    def append(self, text: str):
+        if self.truncated:
+            return
+        text = _unescape(text)
+        self.current.append(text)
+        self.size += len(text) + 1
+        if self.max_chars is not None and self.size > self.max_chars:
+            if self.split:
+                self._flush_full_parts()
+            else:
+                self.truncated = True
+
+    def _flush_full_parts(self):
+        text = ' '.join(self.current)
+        while len(text) > self.max_chars:
+            self.parts.append(text[:self.max_chars])
+            text = text[self.max_chars:]
+        self.current = [text]
+        self.size = len(text)
+
+    def take_parts(self) -> typing.List[str]:
+        parts = self.parts
+        self.parts = []
+        return parts
+
+    def result(self) -> typing.List[str]:
+        """The remaining parts (the only part, when not splitting)"""
+        text = ' '.join(self.current)
+        if self.max_chars is not None:
+            text = text[:self.max_chars]
+        return self.take_parts() + [text]
+
+
+class _StreamState:
+    def __init__(self, body: _BodyText):
+        self.journal = []
+        self.meta = None
+        self.body = body
+        self.captions = []
+        self.acknowledgments = []
+
+        # (parent mode, tag) -> handler returning the frame for a child element
+        self._handlers = {
+            ('article', 'front'): self._mode('front'),
+            ('front', 'journal-meta'): self._mode('journal-meta'),
+            ('journal-meta', 'journal-title-group'): self._mode('journal-title-group'),
+            ('journal-title-group', 'journal-title'): self._direct(self.journal),
+            ('front', 'article-meta'): self._enter_article_meta,
+            ('article', 'body'): self._enter_body,
+            ('article', 'back'): self._mode('back'),
+            ('back', 'ack'): self._mode('ack'),
+            ('ack', 'p'): self._direct(self.acknowledgments),
+            ('fig', 'caption'): self._enter_caption,
+        }
+
+    @staticmethod
+    def _mode(mode: str):
+        return lambda parent: _Frame(mode, None, parent.deep, False)
+
+    @staticmethod
+    def _direct(texts: list):
+        return lambda parent: _Frame(None, texts, parent.deep, False)
+
+    def _enter_article_meta(self, parent: _Frame) -> _Frame:
+        # Front matter is small: keep the whole subtree, and extract from it when it ends. Only the first is used.
+        if self.meta is not None:
+            return _Frame(None, None, parent.deep, False)
+        self.meta = {}
+        return _Frame('article-meta', None, parent.deep, True)
+
+    def _enter_body(self, parent: _Frame) -> _Frame:
+        return _Frame(None, None, parent.deep + (self.body,), False)
+
+    def _enter_caption(self, parent: _Frame) -> _Frame:
+        texts = []
+        self.captions.append(texts)
+        return _Frame(None, None, parent.deep + (texts,), False)
+
+    def enter(self, node, parent: _Frame) -> _Frame:
+        tag = node.tag
+        if parent.keep:
+            # Inside the front matter, just keep track of figures (eg graphical abstracts)
+            if tag == 'fig':
+                return _Frame('fig', None, (), True)
+            return _Frame('caption' if parent.mode == 'fig' and tag == 'caption' else None, None, (), True)
+
+        handler = self._handlers.get((parent.mode, tag))
+        if handler is not None:
+            return handler(parent)
+        if tag == 'fig':
+            return _Frame('fig', None, parent.deep, False)
+        return _Frame(None, None, parent.deep, False)
+
+    def exit(self, node, frame: _Frame):
+        if frame.mode == 'article-meta' and frame.keep:
+            self.meta = _article_meta_fields(node)
+        elif frame.mode == 'caption':
+            self.captions.append(list(node.itertext()))
+
+    def document(self, body: str, part: int, *, last: bool) -> dict:
+        if not self.meta:
+            raise ValueError('Document has no /article/front/article-meta')
+        meta = self.meta
+        doc = {
+            "journal": _unescape(_first(self.journal)) if self.journal else None,
+
+            "title": meta["title"],
+            "authors": meta["authors"],
+
+            "abstract": meta["abstract"],
+            "keywords": meta["keywords"],
+
+            "body": body,
+            # Only stored with the last part of a split article (by which point they have all been seen), so that
+            #   they aren't counted repeatedly
+            "figure_captions": [_unescape(' '.join(texts)) for texts in self.captions] if last else [],
+            "acknowledgments": _unescape(' '.join(self.acknowledgments)) if last else '',
+
+            "date": meta["date"],
+            "volume": meta["volume"],
+            "issue": meta["issue"],
+            "fpage": meta["fpage"],
+
+            "pmid": meta["pmid"],
+            "pmc": meta["pmc"],
+            "doi": meta["doi"]
+        }
+        if self.body.split:
+            doc['part'] = part
+        return doc
+
+
+def _emit(text: typing.Union[str, None], frame: _Frame):
+    if text is not None:
+        if frame.direct is not None:
+            frame.direct.append(text)
+        for collector in frame.deep:
+            collector.append(text)
+
+
+def iterparse(fn, *,
+              parser: etree.XMLParser=None,
+              max_body_chars: int=None,
+              overflow: str='truncate') -> typing.Union[dict, typing.Iterator[dict]]:
+    """
+    Extract the same fields as `parse`, without ever holding the whole document tree in memory
+
+    Elements are discarded as soon as their text has been collected, so memory use depends on the size of the
+    extracted text rather than the size of the tree. With `max_body_chars`, it is bounded regardless of input size.
+
+    :param parser: Ignored (iterparse creates its own parser); accepted so this can be used as an extractor
+    :param max_body_chars: Limit on the size of the body text
+    :param overflow: What to do with body text beyond the limit: 'truncate' it (memory stays flat), or 'split' the
+        article into several documents, each with a `part` number. In split mode, an iterator is returned, which
+        yields each part as soon as it is full (and reads the file as it is consumed).
+    """
+    if overflow not in ('truncate', 'split'):
+        raise ValueError(f'Unknown overflow mode: {overflow}')
+    state = _StreamState(_BodyText(max_body_chars, overflow == 'split'))
+    if overflow == 'split':
+        return _iter_parts(fn, state)
+
+    for _ in _stream(fn, state):
+        pass
+    return state.document(state.body.result()[0], 0, last=True)
+
+
+def _iter_parts(fn, state: _StreamState) -> typing.Iterator[dict]:
+    part = 0
+    for _ in _stream(fn, state):
+        for body in state.body.take_parts():
+            yield state.document(body, part, last=False)
+            part += 1
+    remaining = state.body.result()
+    for i, body in enumerate(remaining):
+        yield state.document(body, part, last=i == len(remaining) - 1)
+        part += 1
+
+
+def _stream(fn, state: _StreamState) -> typing.Iterator[None]:
+    """Feed the document to `state`, pausing whenever complete body parts are ready (after the front matter)"""
+    frames = []
+    nodes = []
+    # huge_tree lifts libxml2's safety limits on the size of individual text nodes
+    for event, node in etree.iterparse(fn, events=('start', 'end'), remove_blank_text=True, huge_tree=True):
+        if event == 'start':
+            if not frames:
+                frames.append(_Frame('article' if node.tag == 'article' else None, None, (), False))
+                nodes.append(node)
+                continue
+
+            parent = frames[-1]
+            if not parent.keep:
+                # Everything before this element's start tag is complete: collect that text and then discard it,
+                #   along with all preceding siblings (which have already been processed)
+                parent_node = nodes[-1]
+                if parent_node.text is not None:
+                    _emit(parent_node.text, parent)
+                    parent_node.text = None
+                sibling = node.getprevious()
+                if sibling is not None:
+                    preceding = []
+                    while sibling is not None:
+                        preceding.append(sibling)
+                        sibling = sibling.getprevious()
+                    for sibling in reversed(preceding):
+                        _emit(sibling.tail, parent)
+                        parent_node.remove(sibling)
+            frames.append(state.enter(node, parent))
+            nodes.append(node)
+        else:
+            frame = frames.pop()
+            nodes.pop()
+            if frame.mode is not None:
+                state.exit(node, frame)
+            if frame.keep:
+                if frames and frames[-1].keep:
+                    # Part of the front matter; wait until the whole section ends
+                    continue
+            else:
+                _emit(node.text, frame)
+                for child in node:
+                    _emit(child.tail, frame)
+            node.clear(keep_tail=True)
+
+        if state.body.parts and state.meta:
+            yield
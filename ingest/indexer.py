@@ -0,0 +1,350 @@
+"""
+Send documents to elasticsearch using several concurrent bulk requests
+
+Article sizes vary from a few KB to several MB, so batches are sized by serialized bytes rather than by document
+count. The batch size adapts to how quickly ES is responding, and items that ES rejects because it is overloaded
+(HTTP 429) are retried with exponential backoff.
+"""
+import collections
+import concurrent.futures
+import logging
+import random
+import time
+import typing
+
+import elasticsearch
+import elasticsearch.helpers
+
+from ingest import metrics
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Request-level errors that indicate a busy (rather than broken) cluster
+RETRY_STATUSES = (429, 503)
+
+
+class ItemFailure(typing.NamedTuple):
+    """A document that could not be indexed"""
+    token: object  # Whatever was passed in alongside the action (eg the source file name)
+    id: typing.Union[str, None]
+    status: typing.Union[int, str]
+    error: object
+
+
+class IndexResult(typing.NamedTuple):
+    indexed: int
+    failures: typing.List[ItemFailure]
+    retries: int  # Number of individual item resends
+    requests: int
+    types: typing.Dict[str, int]  # Number of indexed items of each mapping type (eg articles and passages)
+
+
+class Item(typing.NamedTuple):
+    token: object
+    id: typing.Union[str, None]
+    # Action metadata + source lines, ready to send: text from the client's serializer, or bytes from `ndjson`
+    data: typing.Union[str, bytes]
+
+
+class BatchOutcome(typing.NamedTuple):
+    """The result of sending one batch (including any resends)"""
+    acked: list
+    failures: typing.List[ItemFailure]
+    retries: int
+    requests: int
+    latency: float  # Of the first attempt
+    throttled: bool
+    # IDs of indexed documents that were new, and that replaced an existing document
+    created: list
+    updated: list
+    types: typing.Dict[str, int]  # Number of indexed items of each mapping type
+
+
+class SplitResponse(typing.NamedTuple):
+    acked: list  # Tokens of indexed items
+    created: list  # IDs of indexed items that were new
+    updated: list  # IDs of indexed items that replaced an existing document
+    types: typing.Counter[str]  # Number of indexed items of each mapping type
+    rejected: typing.List[Item]  # Rejected as overloaded; worth resending
+    failures: typing.List[ItemFailure]
+
+
+def serialize_action(serializer, token, action: dict) -> Item:
+    """Convert an action to the lines of a bulk request body"""
+    meta, source = elasticsearch.helpers.expand_action(action)
+    lines = [serializer.dumps(meta)]
+    if source is not None:
+        lines.append(serializer.dumps(source))
+    _id = next(iter(meta.values())).get('_id')
+    return Item(token, _id, '\n'.join(lines) + '\n')
+
+
+def item_size(item: Item) -> int:
+    """Size of an item in a request body, in bytes (text is sent as UTF-8)"""
+    return len(item.data) if isinstance(item.data, bytes) else len(item.data.encode('utf-8'))
+
+
+def post_bulk(client, items: typing.List[Item]):
+    """
+    Send items in one bulk request. Returns the response (or, with an asyncio client, a coroutine).
+
+    Pre-encoded items are joined and sent without going through the client's serializer again; this needs a
+    client created with `config.Serializer` (see `config.make_client`).
+    """
+    if items and isinstance(items[0].data, bytes):
+        return client.transport.perform_request('POST', '/_bulk', body=b''.join(item.data for item in items))
+    return client.bulk(body=''.join(item.data for item in items))
+
+
+def split_response(pending: typing.List[Item], response: dict) -> SplitResponse:
+    """Sort the items of a bulk request by outcome"""
+    split = SplitResponse([], [], [], collections.Counter(), [], [])
+    for item, result in zip(pending, response['items']):
+        info = next(iter(result.values()))
+        status = info.get('status', 500)
+        if status < 300:
+            split.acked.append(item.token)
+            # ES responds 201 for a new document, and 200 when replacing one with the same ID
+            (split.created if status == 201 else split.updated).append(item.id or info.get('_id'))
+            split.types[info.get('_type')] += 1
+        elif status == 429:
+            split.rejected.append(item)
+        else:
+            split.failures.append(ItemFailure(item.token, item.id or info.get('_id'), status, info.get('error')))
+    return split
+
+
+def backoff_delay(attempt: int, backoff: float, max_backoff: float) -> float:
+    """Exponential backoff, with jitter so that concurrent requests don't all retry at once"""
+    return min(max_backoff, backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+class RetryPolicy(typing.NamedTuple):
+    max_retries: int = 6  # Give up on a rejected item after this many resends
+    backoff: float = 0.5  # Initial delay (seconds) before resending; doubles on each attempt
+    max_backoff: float = 60.0
+
+
+class BatchSizer:
+    """The target size of bulk requests: grows while ES keeps up, and backs off quickly when it is slow"""
+    def __init__(self, batch_bytes: int=5 * MB, *,
+                 min_batch_bytes: int=MB // 4,
+                 max_batch_bytes: int=50 * MB,
+                 target_latency: float=2.0):
+        self.batch_bytes = batch_bytes
+        self.min_batch_bytes = min_batch_bytes
+        self.max_batch_bytes = max_batch_bytes
+        self.target_latency = target_latency
+
+    def adapt(self, outcome: BatchOutcome):
+        if outcome.throttled or outcome.latency > self.target_latency:
+            self.batch_bytes = max(self.min_batch_bytes, self.batch_bytes // 2)
+        else:
+            self.batch_bytes = min(self.max_batch_bytes, int(self.batch_bytes * 1.25))
+
+
+class BatchSend:
+    """
+    Sending one batch, including any resends. The caller makes each request (with threads or asyncio), for the
+    items in `pending`, and reports how it went with `responded` or `failed`; these decide what to resend, and how
+    long to wait first. Once `pending` is empty, `outcome` sums up the batch.
+    """
+    def __init__(self, items: typing.List[Item], policy: RetryPolicy):
+        self.pending = items
+        self.policy = policy
+
+        self._acked = []
+        self._created = []
+        self._updated = []
+        self._types = collections.Counter()
+        self._failures = []
+        self._retries = 0
+        self._requests = 0
+        self._latency = None
+        self._throttled = False
+        self._attempt = 0
+
+    def _timed(self, seconds: float):
+        self._requests += 1
+        if self._latency is None:
+            self._latency = seconds
+
+    def _retry(self, items: typing.List[Item]) -> typing.Union[float, None]:
+        """Resend items if there are attempts left; returns the delay before resending them"""
+        self._throttled = True
+        if self._attempt >= self.policy.max_retries:
+            return None
+        delay = backoff_delay(self._attempt, self.policy.backoff, self.policy.max_backoff)
+        self._attempt += 1
+        self._retries += len(items)
+        self.pending = items
+        return delay
+
+    def responded(self, response: dict, seconds: float) -> typing.Union[float, None]:
+        """Record the response to a request that took `seconds`; returns the delay before resending any items"""
+        self._timed(seconds)
+        split = split_response(self.pending, response)
+        self._acked.extend(split.acked)
+        self._created.extend(split.created)
+        self._updated.extend(split.updated)
+        self._types.update(split.types)
+        self._failures.extend(split.failures)
+        self.pending = []
+        if not split.rejected:
+            return None
+
+        delay = self._retry(split.rejected)
+        if delay is None:
+            self._failures.extend(ItemFailure(item.token, item.id, 429, 'Rejected; retries exhausted')
+                                  for item in split.rejected)
+        return delay
+
+    def failed(self, error: elasticsearch.TransportError, seconds: float) -> typing.Union[float, None]:
+        """Record a request that failed as a whole; returns the delay before resending it"""
+        self._timed(seconds)
+        items, self.pending = self.pending, []
+        retryable = isinstance(error, elasticsearch.ConnectionError) or error.status_code in RETRY_STATUSES
+        delay = self._retry(items) if retryable else None
+        if delay is None:
+            self._throttled = True
+            self._failures.extend(ItemFailure(item.token, item.id, error.status_code, str(error)) for item in items)
+        else:
+            logger.warning(f'Bulk request failed ({error}); retrying {len(items)} items')
+        return delay
+
+    def outcome(self) -> BatchOutcome:
+        return BatchOutcome(self._acked, self._failures, self._retries, self._requests, self._latency or 0.0,
+                            self._throttled, self._created, self._updated, dict(self._types))
+
+
+class BulkIndexer:
+    """
+    Index a stream of ES bulk actions with several requests in flight at once
+
+    Results are processed in the calling thread, so `on_ack` and `on_batch` callbacks do not need to be thread-safe.
+    """
+    def __init__(self, client: elasticsearch.Elasticsearch, *,
+                 max_in_flight: int=4,
+                 batch_bytes: int=5 * MB,
+                 min_batch_bytes: int=MB // 4,
+                 max_batch_bytes: int=50 * MB,
+                 target_latency: float=2.0,
+                 max_retries: int=6,
+                 backoff: float=0.5,
+                 max_backoff: float=60.0,
+                 stats: metrics.RunStats=metrics.NULL):
+        """
+        :param max_in_flight: Number of bulk requests that may be outstanding at once
+        :param batch_bytes: Initial size of each request body. Adjusted as requests complete.
+        :param max_batch_bytes: Hard upper limit on request size; keep this under the cluster's
+            `http.max_content_length` (100MB by default)
+        :param target_latency: Batches grow while requests complete faster than this (seconds), and shrink otherwise
+        :param max_retries: Give up on a rejected item after this many resends
+        :param backoff: Initial delay (seconds) before resending rejected items; doubles on each attempt
+        :param stats: Receives the outcome of each bulk request
+        """
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self.sizer = BatchSizer(batch_bytes, min_batch_bytes=min_batch_bytes, max_batch_bytes=max_batch_bytes,
+                                target_latency=target_latency)
+        self.retry = RetryPolicy(max_retries, backoff, max_backoff)
+        self.stats = stats
+
+        self._serializer = client.transport.serializer
+
+    def index(self, actions: typing.Iterable[dict]) -> IndexResult:
+        """Index a series of actions (as accepted by `elasticsearch.helpers.bulk`)"""
+        return self.index_tracked(((None, action) for action in actions))
+
+    def index_tracked(self, tracked_actions: typing.Iterable[typing.Tuple[object, dict]], *,
+                      on_ack: typing.Callable[[list], None]=None,
+                      on_batch: typing.Callable[[BatchOutcome], None]=None) -> IndexResult:
+        """
+        Index (token, action) pairs
+
+        :param tracked_actions: Each action is paired with an arbitrary token (eg the name of the source file)
+        :param on_ack: Called with the tokens of successfully indexed actions, each time a batch completes
+        :param on_batch: Called with the full `BatchOutcome` each time a batch completes
+        """
+        items = (serialize_action(self._serializer, token, action) for token, action in tracked_actions)
+        return self._index_items(items, on_ack, on_batch)
+
+    def index_encoded(self, tracked_items: typing.Iterable[typing.Tuple[object, typing.Union[str, None], bytes]], *,
+                      on_ack: typing.Callable[[list], None]=None,
+                      on_batch: typing.Callable[[BatchOutcome], None]=None) -> IndexResult:
+        """
+        Index (token, document ID, bulk lines) triples that were already serialized (see `ndjson.encode_document`)
+        """
+        return self._index_items((Item(*item) for item in tracked_items), on_ack, on_batch)
+
+    def _index_items(self, items: typing.Iterable[Item],
+                     on_ack: typing.Union[typing.Callable, None],
+                     on_batch: typing.Union[typing.Callable, None]) -> IndexResult:
+        indexed = 0
+        failures = []
+        retries = 0
+        requests = 0
+        types = collections.Counter()
+
+        def handle(future: concurrent.futures.Future):
+            nonlocal indexed, retries, requests
+            outcome = future.result()
+            indexed += len(outcome.acked)
+            types.update(outcome.types)
+            failures.extend(outcome.failures)
+            retries += outcome.retries
+            requests += outcome.requests
+            self.sizer.adapt(outcome)
+            self.stats.bulk_completed(outcome)
+            if on_batch is not None:
+                on_batch(outcome)
+            if on_ack is not None and outcome.acked:
+                on_ack(outcome.acked)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            in_flight = set()
+            for batch in self._batches(items):
+                if len(in_flight) >= self.max_in_flight:
+                    # Backpressure: don't read (or parse) any more documents until a request slot frees up
+                    done, in_flight = concurrent.futures.wait(in_flight,
+                                                              return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        handle(future)
+                in_flight.add(pool.submit(self._send, batch))
+
+            for future in concurrent.futures.as_completed(in_flight):
+                handle(future)
+
+        return IndexResult(indexed, failures, retries, requests, dict(types))
+
+    def _batches(self, items: typing.Iterable[Item]) -> typing.Iterator[typing.List[Item]]:
+        """Group serialized actions into batches of (approximately) the current target size"""
+        batch = []
+        size = 0
+        for item in items:
+            item_bytes = item_size(item)
+            if batch and size + item_bytes > self.sizer.batch_bytes:
+                yield batch
+                batch = []
+                size = 0
+            batch.append(item)
+            size += item_bytes
+        if batch:
+            yield batch
+
+    def _send(self, items: typing.List[Item]) -> BatchOutcome:
+        """Send one batch (runs in a worker thread), resending any items that ES rejected as overloaded"""
+        send = BatchSend(items, self.retry)
+        while send.pending:
+            t1 = time.perf_counter()
+            try:
+                response = post_bulk(self.client, send.pending)
+            except elasticsearch.TransportError as e:
+                delay = send.failed(e, time.perf_counter() - t1)
+            else:
+                delay = send.responded(response, time.perf_counter() - t1)
+            if delay is not None:
+                time.sleep(delay)
+        return send.outcome()
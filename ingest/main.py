@@ -1,61 +1,370 @@
 import argparse
+import concurrent.futures
+import contextlib
+import functools
 import os
 from pprint import pprint as pp
 import time
+import typing
 
+from ingest import archive
+from ingest import async_pipeline
+from ingest import checkpoint
+from ingest import config
+from ingest import extract
+from ingest import indexer
+from ingest import manifest
+from ingest import metrics
+from ingest import ndjson
+from ingest import parallel
 from ingest import parse_nxml
 from ingest import populate_es
+from ingest import rollup
+from ingest import shards
+
+# Interchangeable ways of extracting fields from a document; they produce identical output
+EXTRACTORS = {
+    'xpath': parse_nxml.parse_nxml,
+    'single-pass': extract.parse,
+    # Memory-bounded; see --max-body-chars
+    'streaming': extract.iterparse,
+}
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Process a directory of files')
     parser.add_argument('--dry', help='Process as dry run?')
     parser.add_argument('--drop', action='store_true', help='Drop all data there and refill from scratch')
+    parser.add_argument('--mapping', choices=populate_es.MAPPING_PROFILES, default='default',
+                        help='Index mapping to use, with --drop. lean builds a smaller index, faster.')
+    parser.add_argument('--sort-by-date', action='store_true',
+                        help='With --drop, create an index sorted by date (ES 6.0+)')
+    parser.add_argument('--rollup', action='store_true',
+                        help='Also keep per-year article counts and keyword/journal frequencies up to date in a '
+                             'summary index, for the dashboard')
+    parser.add_argument('--extractor', choices=sorted(EXTRACTORS), default='xpath',
+                        help='How to extract fields from each document. single-pass is faster on large articles.')
+    parser.add_argument('--max-body-chars', type=int,
+                        help='With --extractor streaming, limit the size of the body text of each document')
+    parser.add_argument('--body-overflow', choices=['truncate', 'split'],
+                        help='What to do with body text beyond --max-body-chars: drop it (the default), or index the '
+                             'article as several documents (only without --workers or --async)')
+    parser.add_argument('--passages', action='store_true',
+                        help='Index the body of each article as section/paragraph passages: child documents of the '
+                             'article, which keeps only its front matter. Needs --drop, unless the index was created '
+                             'with --passages.')
+    parser.add_argument('--export-shards', type=str,
+                        help='Instead of indexing, write parsed documents to this directory, for use with '
+                             '--from-shards')
+    parser.add_argument('--checkpoint', type=str,
+                        help='Incremental mode: a file recording what has been indexed. Unchanged files are '
+                             'skipped, and an interrupted run resumes where it left off.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Parse files in a pool of N worker processes (default: parse in this process)')
+    parser.add_argument('--shard', type=manifest.parse_shard,
+                        help='i/N: process only this host\'s share (numbered from 0) of the files in --dir (or of the '
+                             '--archive files), when N hosts load the same corpus. Shares are balanced by size.')
+    parser.add_argument('--manifest', type=str,
+                        help='List of the files in --dir, as written by `python -m ingest.manifest`, to use instead '
+                             'of scanning the directory (so that every host divides up the same list)')
+
+    parser.add_argument('--bulk-concurrency', type=int, default=4, help='Number of bulk requests to run at once')
+    parser.add_argument('--bulk-mb', type=float, default=5,
+                        help='Initial size of each bulk request (MB); adjusted according to how fast ES responds')
+    parser.add_argument('--fast-json', action='store_true',
+                        help='Serialize each document once, straight to bytes (using orjson, if installed), '
+                             'instead of through the ES client')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Run discovery, parsing and indexing as concurrent asyncio stages')
+    parser.add_argument('--bulk-load', action='store_true',
+                        help='Disable refreshes and replicas while loading, and restore them afterwards')
+    parser.add_argument('--force-merge', action='store_true', help='Force-merge the index after a --bulk-load')
+
+    parser.add_argument('--stats-out', type=str,
+                        help='Record per-stage statistics, and save them to <STATS_OUT>.json and <STATS_OUT>.prom '
+                             '(Prometheus textfile format)')
+    parser.add_argument('--progress', type=float, default=0,
+                        help='Print a progress line every N seconds (also records statistics)')
+
+    # Cluster connection settings (defaults are taken from ES_* environment variables)
+    env = config.from_env()
+    parser.add_argument('--es-hosts', type=str, nargs='+', default=env.hosts, help='Elasticsearch host(s)')
+    parser.add_argument('--es-timeout', type=float, default=env.timeout, help='Request timeout (seconds)')
+    parser.add_argument('--es-maxsize', type=int, default=env.maxsize,
+                        help='Connections per host (ignored with --async, which uses at most --bulk-concurrency)')
 
     # Can specify a single file, or recursively crawl a directory
     source = parser.add_mutually_exclusive_group(required=True)
     source.add_argument('--file', type=str, help='A single file to process')
     source.add_argument('--dir', type=str, help='A directory of files to process. Will index all xml contents recursively')
+    source.add_argument('--archive', type=str, nargs='+',
+                        help='One or more PMC bulk .tar.gz packages. Articles are streamed out without extracting')
+    source.add_argument('--from-shards', type=str,
+                        help='A directory of already-parsed documents, as written by --export-shards')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.shard and not (args.dir or args.archive):
+        parser.error('--shard only applies to --dir or --archive')
+    if args.manifest and not args.dir:
+        parser.error('--manifest only applies to --dir')
+    if args.passages and args.extractor == 'streaming':
+        parser.error('--passages needs the xpath or single-pass extractor')
+    if (args.max_body_chars or args.body_overflow) and args.extractor != 'streaming':
+        parser.error('--max-body-chars and --body-overflow need --extractor streaming')
+    if args.body_overflow and not args.max_body_chars:
+        parser.error('--body-overflow needs --max-body-chars')
+    if args.body_overflow == 'split' and (args.workers or args.use_async):
+        # Worker processes would have to hold every part of an article at once, to send them back together
+        parser.error('--body-overflow split needs parsing in this process (no --workers or --async)')
+    args.body_overflow = args.body_overflow or 'truncate'
 
+    # Connect now, so that options can be checked against the existing index
+    populate_es.connect(config.from_env()._replace(hosts=args.es_hosts, timeout=args.es_timeout,
+                                                   maxsize=args.es_maxsize))
+    if not (args.drop or args.dry or args.export_shards):
+        # These only take effect when the index is created, so would be silently ignored
+        if args.mapping != 'default':
+            parser.error(f'--mapping {args.mapping} needs --drop')
+        if args.sort_by_date:
+            parser.error('--sort-by-date needs --drop')
+        if args.passages and not populate_es.has_passages():
+            parser.error('--passages needs --drop, unless the index was created with --passages')
+    return args
 
-def process_directory(dirname:str):
-    # Process entire directory
-    for root, dirs, files in os.walk(dirname):
-        for fn in files:
-            # TODO: In future we may need safeguards to check for nxml extension
-            yield parse_nxml.parse_nxml(os.path.join(root, fn))
 
+def find_files(dirname: str, *, shard: typing.Tuple[int, int]=None, manifest_fn: str=None) -> typing.Iterator[str]:
+    """Recursively list all `.nxml` files in a directory (or this host's share of them)"""
+    if not (shard or manifest_fn):
+        # Start parsing as soon as the first file is found, rather than after listing the whole corpus
+        for item, _ in manifest.walk(dirname):
+            yield item.path
+        return
 
-def main(*, filename=None, dirname=None, drop=False, dry=False):
-    """Extract data from XML files and load into elasticsearch"""
+    entries = manifest.read(manifest_fn, dirname) if manifest_fn else manifest.scan(dirname)
+    if shard:
+        entries = manifest.select(entries, shard)
+    for entry in entries:
+        yield entry.path
+
+
+def iter_sources(*, filename: str=None, dirname: str=None, archives: typing.List[str]=None,
+                 prefetch: int=0, shard: typing.Tuple[int, int]=None,
+                 manifest_fn: str=None) -> typing.Iterator[parallel.Source]:
+    """List everything to be parsed: file paths, or article contents streamed from archives"""
     if filename:
-        contents = [parse_nxml.parse_nxml(filename)]
+        yield os.path.abspath(filename)
     elif dirname:
-        contents = process_directory(dirname)
+        yield from find_files(os.path.abspath(dirname), shard=shard, manifest_fn=manifest_fn)
+    elif archives:
+        archives = [os.path.abspath(fn) for fn in archives]
+        if shard:
+            # Whole archives are divided between hosts
+            entries = [manifest.Entry(fn, os.path.basename(fn), os.path.getsize(fn)) for fn in archives]
+            archives = [entry.path for entry in manifest.select(entries, shard)]
+        yield from archive.iter_archives(archives, prefetch=prefetch)
+
+
+def parse_all(sources: typing.Iterable[parallel.Source], *, workers: int=0, failures: list=None,
+              parse_fn: typing.Callable=parse_nxml.parse_nxml, stats: metrics.RunStats=metrics.NULL):
+    """Parse every source, yielding (source name, document) pairs"""
+    if workers:
+        yield from parallel.parse_sources(sources, workers=workers, failures=failures, parse_fn=parse_fn, stats=stats)
     else:
+        for source in sources:
+            name = parallel.source_name(source)
+            t1 = time.perf_counter()
+            result = parallel.parse_source(source, parse_fn=parse_fn)
+            stats.file_parsed(name, time.perf_counter() - t1)
+            for doc in parallel.as_documents(result):
+                yield name, doc
+
+
+def _call_all(callbacks: typing.List[typing.Callable]) -> typing.Union[typing.Callable, None]:
+    """Combine several callbacks into one (or None, if there are none)"""
+    if not callbacks:
+        return None
+
+    def call(arg):
+        for callback in callbacks:
+            callback(arg)
+    return call
+
+
+def report_parse_failures(failures: typing.List[parallel.ParseFailure]):
+    if failures:
+        print('Files that could not be parsed:', len(failures))
+        for failure in failures:
+            print(f'  {failure.source}: {failure.error}')
+
+
+def report_stats(run_stats: metrics.RunStats, stats_out: typing.Union[str, None]):
+    if not run_stats.enabled:
         return
+    run_stats.progress()
+    print('Slowest files:')
+    for source, seconds in run_stats.slowest_files():
+        print(f'  {seconds:.2f}s {source}')
+    if stats_out:
+        run_stats.write(stats_out)
+        print(f'Statistics saved to {stats_out}.json and {stats_out}.prom')
+
+
+def main(*, filename=None, dirname=None, archives=None, drop=False, dry=False, workers=0, extractor='xpath',
+         max_body_chars=None, body_overflow='truncate', checkpoint_fn=None,
+         bulk_concurrency=4, bulk_mb=5, bulk_load=False, force_merge=False,
+         from_shards=None, export_shards=None, use_async=False, fast_json=False, stats_out=None, progress=0,
+         mapping='default', sort_by_date=False, use_rollup=False, shard=None, manifest_fn=None, use_passages=False):
+    """Extract data from XML files and load into elasticsearch"""
+    if not any([filename, dirname, archives, from_shards]):
+        return
+
+    if stats_out or progress:
+        run_stats = metrics.RunStats(progress_interval=progress)
+    else:
+        run_stats = metrics.NULL
+
+    failures = []
+    checkpoints = None
+    if from_shards:
+        # Documents were already parsed by a previous run; no need to touch the XML again
+        sources = parsed = shards.iter_shards(from_shards)
+        parse_fn = None
+    else:
+        # When parsing in parallel, decompress archives in a background thread so that reading overlaps with parsing
+        sources = iter_sources(filename=filename, dirname=dirname, archives=archives, prefetch=workers * 16,
+                               shard=shard, manifest_fn=manifest_fn)
+
+        if checkpoint_fn and not dry and not export_shards:
+            # Incremental mode: skip any files that were indexed (unchanged) by a previous run
+            checkpoints = checkpoint.Checkpoint(checkpoint_fn)
+            if drop:
+                checkpoints.reset()
+            sources = checkpoints.filter_changed(sources)
+        sources = run_stats.track_sources(sources)
+
+        parse_fn = EXTRACTORS[extractor]
+        if extractor == 'streaming':
+            parse_fn = functools.partial(parse_fn, max_body_chars=max_body_chars, overflow=body_overflow)
+        elif use_passages:
+            parse_fn = functools.partial(parse_fn, as_passages=True)
+        parsed = parse_all(sources, workers=workers, failures=failures, parse_fn=parse_fn, stats=run_stats)
 
     if dry:
         # Option to only display content without indexing it
-        for article in contents:
+        for _, article in parsed:
             pp(article)
         return
 
-    populate_es.setup_index(drop=drop)
+    if export_shards:
+        count = shards.write_shards((doc for _, doc in parsed), export_shards)
+        print('Export complete!')
+        print('Documents written:', count)
+        report_parse_failures(failures)
+        report_stats(run_stats, stats_out)
+        return
+
+    populate_es.setup_index(drop=drop, profile=mapping, sort_by_date=sort_by_date, passages=use_passages)
+
+    on_batch = []
+    on_document = []
+    on_item = None
+    if checkpoints is not None:
+        # In incremental mode, record each file in the checkpoint only once ES has acknowledged all of its documents
+        on_batch.append(checkpoints.completed)
+        on_item = checkpoints.expect
+
+    with contextlib.ExitStack() as stack:
+        if bulk_load:
+            stack.enter_context(populate_es.bulk_load(force_merge=force_merge))
+
+        executor = None
+        if use_async:
+            # Send requests made along the way (rollup updates, stale part deletions) from a thread, rather than
+            # blocking the event loop
+            executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=1))
+
+        stale = None
+        if not drop:
+            # Remove parts of articles that were split into more parts last time they were indexed
+            stale = populate_es.StaleDocuments(populate_es.client, executor=executor)
+            on_document.append(stale.add)
+            parsed = stale.track(parsed)
+
+        if use_rollup:
+            # Count new articles into the summary index as their batches are acknowledged
+            rollup.setup_rollup_index(drop=drop)
+            summary = rollup.Rollup(populate_es.client, executor=executor)
+            # Runs first on the way out (even if indexing fails), then the executor waits for it
+            stack.callback(summary.flush)
+            on_batch.append(summary.completed)
+            on_document.append(summary.add)
+            parsed = summary.track(parsed)
+
+        if use_async:
+            # Parse and index in separate asyncio stages (the `parsed` generator is not used)
+            result = async_pipeline.run(sources,
+                                        es_config=populate_es.settings,
+                                        parse_fn=parse_fn,
+                                        workers=workers,
+                                        bulk_concurrency=bulk_concurrency,
+                                        batch_bytes=int(bulk_mb * indexer.MB),
+                                        encode=fast_json,
+                                        stats=run_stats,
+                                        on_batch=_call_all(on_batch),
+                                        on_document=_call_all(on_document),
+                                        on_item=on_item,
+                                        failures=failures)
+            if stale is not None:
+                stale.finish()
+        else:
+            bulk = indexer.BulkIndexer(populate_es.client,
+                                       max_in_flight=bulk_concurrency,
+                                       batch_bytes=int(bulk_mb * indexer.MB),
+                                       stats=run_stats)
+            if fast_json:
+                items = ((name, _id, data)
+                         for name, doc in parsed
+                         for _id, data in ndjson.encode_documents(doc))
+                if checkpoints is not None:
+                    items = checkpoints.track(items)
+                result = bulk.index_encoded(items, on_batch=_call_all(on_batch))
+            else:
+                tracked_actions = ((name, action)
+                                   for (name, doc) in parsed
+                                   for action in populate_es.make_bulk_actions([doc]))
+                if checkpoints is not None:
+                    tracked_actions = checkpoints.track(tracked_actions)
+                result = bulk.index_tracked(tracked_actions, on_batch=_call_all(on_batch))
 
-    actions = populate_es.make_bulk_actions(contents)
-    index_count, errors = populate_es.process_documents(actions)
+    if checkpoints is not None:
+        checkpoints.finish()
+        checkpoints.close()
 
     print('Indexing complete!')
-    print('Documents indexed:', index_count)
-    print('Errors encountered:', errors)
+    passages = result.types.get(populate_es.PASSAGE_TYPE, 0)
+    print('Documents indexed:', result.indexed - passages)
+    if use_passages:
+        print('Passages indexed:', passages)
+    print('Bulk requests:', result.requests, 'Items retried:', result.retries)
+    print('Errors encountered:', len(result.failures))
+    for failure in result.failures:
+        print(f'  {failure.token} (id: {failure.id}): {failure.status} {failure.error}')
+    report_parse_failures(failures)
+    report_stats(run_stats, stats_out)
 
 
 if __name__ == '__main__':
     args = parse_args()
 
     t1 = time.time()
-    main(filename=args.file, dirname=args.dir, drop=args.drop, dry=args.dry)
+    main(filename=args.file, dirname=args.dir, archives=args.archive,
+         drop=args.drop, dry=args.dry, workers=args.workers, extractor=args.extractor,
+         max_body_chars=args.max_body_chars, body_overflow=args.body_overflow,
+         checkpoint_fn=args.checkpoint, bulk_concurrency=args.bulk_concurrency, bulk_mb=args.bulk_mb,
+         bulk_load=args.bulk_load, force_merge=args.force_merge,
+         from_shards=args.from_shards, export_shards=args.export_shards,
+         use_async=args.use_async, fast_json=args.fast_json,
+         stats_out=args.stats_out, progress=args.progress,
+         mapping=args.mapping, sort_by_date=args.sort_by_date, use_rollup=args.rollup,
+         shard=args.shard, manifest_fn=args.manifest, use_passages=args.passages)
     print(f"Analysis complete. Runtime: {time.time() - t1:.0f} seconds")
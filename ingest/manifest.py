@@ -0,0 +1,123 @@
+"""
+List the articles in a corpus directory, and divide them between several ingest hosts
+
+`walk` goes through the tree with `os.scandir` (which gets file types from the directory listing, without a `stat`
+call per entry) and yields `.nxml` files as it finds them. `scan` lists them all, in order, with their sizes.
+
+`select` picks one host's share of the corpus (`--shard i/N`) without any coordination between hosts: files are
+ordered by a hash of their path relative to the corpus root, and that order is cut into N contiguous runs of
+(nearly) equal total size. Every host that lists the same corpus computes the same split, so hosts never overlap
+and no file is missed. Adding files moves only a few files near each cut to a different host.
+
+Hosts that may see the corpus at different moments (eg while it is still being synced) should share a manifest
+file instead, written once with `python -m ingest.manifest`.
+"""
+import argparse
+import hashlib
+import os
+import typing
+
+EXTENSION = '.nxml'
+
+
+class Entry(typing.NamedTuple):
+    path: str  # As found under the directory that was scanned
+    relpath: str  # Relative to that directory, with `/` separators; the same on every host
+    size: int
+
+
+def walk(dirname: str) -> typing.Iterator[typing.Tuple[os.DirEntry, str]]:
+    """Recursively find every `.nxml` file in a directory, in no particular order; yields (entry, relative path)"""
+    stack = [(dirname, '')]
+    while stack:
+        path, prefix = stack.pop()
+        with os.scandir(path) as it:
+            for item in it:
+                if item.is_dir(follow_symlinks=False):
+                    stack.append((item.path, f'{prefix}{item.name}/'))
+                elif item.name.endswith(EXTENSION) and item.is_file():
+                    yield item, prefix + item.name
+
+
+def scan(dirname: str) -> typing.List[Entry]:
+    """List every `.nxml` file in a directory, with its size, sorted by relative path"""
+    entries = [Entry(item.path, relpath, item.stat().st_size) for item, relpath in walk(dirname)]
+    entries.sort(key=lambda entry: entry.relpath)
+    return entries
+
+
+def shard_key(relpath: str) -> bytes:
+    """A position for the file that does not depend on the host, the Python version, or the rest of the corpus"""
+    return hashlib.sha1(relpath.encode('utf-8')).digest()
+
+
+def assign(entries: typing.List[Entry], count: int) -> typing.List[typing.List[Entry]]:
+    """
+    Divide entries into `count` shards of about equal total size
+
+    Entries are taken in hash order, and each goes to the shard that the middle of its byte range falls in; so
+    every shard is within one file's size of an equal share.
+    """
+    ordered = sorted(entries, key=lambda entry: (shard_key(entry.relpath), entry.relpath))
+    total = sum(entry.size for entry in ordered)
+    shards = [[] for _ in range(count)]
+    offset = 0
+    for entry in ordered:
+        middle = offset + entry.size / 2
+        index = min(int(middle * count / total), count - 1) if total else 0
+        shards[index].append(entry)
+        offset += entry.size
+    return shards
+
+
+def select(entries: typing.List[Entry], shard: typing.Tuple[int, int]) -> typing.List[Entry]:
+    """This host's share of the entries, in path order"""
+    index, count = shard
+    return sorted(assign(entries, count)[index], key=lambda entry: entry.relpath)
+
+
+def parse_shard(value: str) -> typing.Tuple[int, int]:
+    """Parse `i/N` (0 <= i < N), for use as an argparse type"""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected i/N, eg 0/4, not {value!r}')
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'shard number must be from 0 to {count - 1}, not {index}')
+    return index, count
+
+
+def write(entries: typing.List[Entry], fn: str):
+    """Save a manifest as tab-separated (size, relative path) lines"""
+    with open(fn, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(f'{entry.size}\t{entry.relpath}\n')
+
+
+def read(fn: str, dirname: str) -> typing.List[Entry]:
+    """Load a manifest saved by `write`, for the corpus found at `dirname` on this host"""
+    entries = []
+    with open(fn, encoding='utf-8') as f:
+        for line in f:
+            size, relpath = line.rstrip('\n').split('\t', 1)
+            entries.append(Entry(os.path.join(dirname, *relpath.split('/')), relpath, int(size)))
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a manifest of a corpus directory, for --manifest')
+    parser.add_argument('dir', help='A directory of .nxml files')
+    parser.add_argument('out', help='Manifest file to write')
+    parser.add_argument('--shards', type=int, help='Also show how the corpus would be split between N hosts')
+    args = parser.parse_args()
+
+    entries = scan(args.dir)
+    write(entries, args.out)
+    print(f'{len(entries)} files, {sum(entry.size for entry in entries) / 1024 / 1024:.1f} MB')
+    if args.shards:
+        for i, shard in enumerate(assign(entries, args.shards)):
+            print(f'  shard {i}/{args.shards}: {len(shard)} files, {sum(e.size for e in shard) / 1024 / 1024:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
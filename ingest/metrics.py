@@ -0,0 +1,213 @@
+"""
+Counters and timings for an ingestion run, to show which stage (reading, parsing, or ES) is holding a load back
+
+Instrumentation is off unless requested: code on the hot path is given `NULL`, whose methods do nothing. When on,
+`RunStats` keeps running totals, histograms of per-file parse time and bulk request latency, and the slowest
+files, prints a progress line every so often, and can save a summary as JSON and as a Prometheus textfile (for
+node_exporter's textfile collector).
+"""
+import bisect
+import collections
+import heapq
+import json
+import os
+import time
+import typing
+
+from ingest import archive
+from ingest import populate_es
+
+# Upper bounds of histogram buckets, in seconds
+PARSE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+
+# Descriptions of every counter, for the Prometheus textfile
+COUNTERS = {
+    'files_seen': 'Source files (or archive members) sent to be parsed',
+    'bytes_read': 'Size of the source files sent to be parsed',
+    'files_parsed': 'Source files parsed successfully',
+    'parse_failures': 'Source files that could not be parsed',
+    'docs_indexed': 'Article documents (or parts of articles) acknowledged by ES',
+    'passages_indexed': 'Passages (child documents of articles, with --passages) acknowledged by ES',
+    'docs_rejected': 'Documents that ES did not index, after any retries',
+    'bulk_requests': 'Bulk requests sent, including resends',
+    'items_retried': 'Individual documents resent after ES rejected them as overloaded',
+}
+
+
+class Histogram:
+    def __init__(self, buckets: typing.Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last bucket is everything above the largest bound
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> typing.List[typing.Tuple[str, int]]:
+        """(upper bound, number of observations <= bound) pairs, as used by Prometheus"""
+        total = 0
+        pairs = []
+        for bound, count in zip([str(b) for b in self.buckets] + ['+Inf'], self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def as_dict(self) -> dict:
+        return {'buckets': dict(self.cumulative()), 'sum': self.sum, 'count': self.count}
+
+
+class RunStats:
+    """
+    Statistics for one run
+
+    :param top_n: How many of the slowest files to remember
+    :param progress_interval: Seconds between progress lines (0 for none)
+    :param report: Called with each progress line
+    """
+    enabled = True
+
+    def __init__(self, *, top_n: int=10, progress_interval: float=60.0,
+                 report: typing.Callable[[str], None]=print):
+        self.top_n = top_n
+        self.progress_interval = progress_interval
+        self.report = report
+
+        self.counters = collections.Counter({name: 0 for name in COUNTERS})
+        self.histograms = {
+            'parse_seconds': Histogram(PARSE_BUCKETS),
+            'bulk_latency_seconds': Histogram(LATENCY_BUCKETS),
+        }
+        self._slowest = []  # Min-heap of (seconds, source name)
+
+        self.started = time.time()
+        self._t0 = time.perf_counter()
+        self._next_progress = self._t0 + progress_interval
+
+    def track_sources(self, sources: typing.Iterable) -> typing.Iterator:
+        """Count file paths or archive members as they are passed along to be parsed"""
+        for source in sources:
+            self.counters['files_seen'] += 1
+            if isinstance(source, archive.Member):
+                self.counters['bytes_read'] += source.size
+            else:
+                self.counters['bytes_read'] += os.stat(source).st_size
+            yield source
+
+    def file_parsed(self, source: str, seconds: float):
+        self.counters['files_parsed'] += 1
+        self.histograms['parse_seconds'].observe(seconds)
+        if len(self._slowest) < self.top_n:
+            heapq.heappush(self._slowest, (seconds, source))
+        elif seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, (seconds, source))
+        self._maybe_report()
+
+    def parse_failed(self, source: str):
+        self.counters['parse_failures'] += 1
+
+    def bulk_completed(self, outcome):
+        """Record the result of one batch (an `indexer.BatchOutcome`)"""
+        passages = outcome.types.get(populate_es.PASSAGE_TYPE, 0)
+        self.counters['docs_indexed'] += len(outcome.acked) - passages
+        self.counters['passages_indexed'] += passages
+        self.counters['docs_rejected'] += len(outcome.failures)
+        self.counters['bulk_requests'] += outcome.requests
+        self.counters['items_retried'] += outcome.retries
+        self.histograms['bulk_latency_seconds'].observe(outcome.latency)
+        self._maybe_report()
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._t0
+
+    def slowest_files(self) -> typing.List[typing.Tuple[str, float]]:
+        return [(source, seconds) for seconds, source in sorted(self._slowest, reverse=True)]
+
+    def _maybe_report(self):
+        if self.progress_interval and time.perf_counter() >= self._next_progress:
+            self._next_progress = time.perf_counter() + self.progress_interval
+            self.progress()
+
+    def progress(self):
+        c = self.counters
+        elapsed = self.elapsed
+        parse = self.histograms['parse_seconds']
+        bulk = self.histograms['bulk_latency_seconds']
+        passages = f' + {c["passages_indexed"]} passages' if c['passages_indexed'] else ''
+        self.report(f'[{elapsed:.0f}s] '
+                    f'files {c["files_seen"]} ({c["bytes_read"] / 1024 / 1024:.1f} MB), '
+                    f'parsed {c["files_parsed"]} (avg {_mean(parse) * 1000:.1f} ms, {c["parse_failures"]} failed), '
+                    f'indexed {c["docs_indexed"]}{passages} ({c["docs_indexed"] / elapsed:.1f} docs/s, '
+                    f'avg bulk {_mean(bulk):.2f} s, {c["items_retried"]} retried, {c["docs_rejected"]} rejected)')
+
+    def summary(self) -> dict:
+        elapsed = self.elapsed
+        return {
+            'started': self.started,
+            'elapsed_seconds': elapsed,
+            'counters': dict(self.counters),
+            'rates': {
+                'files_per_sec': self.counters['files_parsed'] / elapsed,
+                'docs_per_sec': self.counters['docs_indexed'] / elapsed,
+                'passages_per_sec': self.counters['passages_indexed'] / elapsed,
+                'mb_per_sec': self.counters['bytes_read'] / 1024 / 1024 / elapsed,
+            },
+            'histograms': {name: hist.as_dict() for name, hist in self.histograms.items()},
+            'slowest_files': [{'source': source, 'seconds': seconds} for source, seconds in self.slowest_files()],
+        }
+
+    def prometheus(self, prefix: str='ingest') -> str:
+        lines = []
+        for name, value in self.counters.items():
+            lines.append(f'# HELP {prefix}_{name}_total {COUNTERS.get(name, name)}')
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            lines.append(f'{prefix}_{name}_total {value}')
+        for name, hist in self.histograms.items():
+            lines.append(f'# TYPE {prefix}_{name} histogram')
+            for bound, count in hist.cumulative():
+                lines.append(f'{prefix}_{name}_bucket{{le="{bound}"}} {count}')
+            lines.append(f'{prefix}_{name}_sum {hist.sum}')
+            lines.append(f'{prefix}_{name}_count {hist.count}')
+        lines.append(f'# TYPE {prefix}_run_seconds gauge')
+        lines.append(f'{prefix}_run_seconds {self.elapsed}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        """Save the summary as `<path>.json`, and the same figures in Prometheus text format as `<path>.prom`"""
+        with open(f'{path}.json', 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        # Write then rename, so that a collector never reads a half-written file
+        with open(f'{path}.prom.tmp', 'w') as f:
+            f.write(self.prometheus())
+        os.replace(f'{path}.prom.tmp', f'{path}.prom')
+
+
+def _mean(hist: Histogram) -> float:
+    return hist.sum / hist.count if hist.count else 0.0
+
+
+class NullStats:
+    """Stands in for `RunStats` when instrumentation is off; does as little as possible"""
+    enabled = False
+
+    def track_sources(self, sources):
+        return sources
+
+    def file_parsed(self, source, seconds):
+        pass
+
+    def parse_failed(self, source):
+        pass
+
+    def bulk_completed(self, outcome):
+        pass
+
+    def progress(self):
+        pass
+
+
+NULL = NullStats()
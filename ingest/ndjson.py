@@ -0,0 +1,49 @@
+"""
+Serialize documents directly to the bytes of an ES bulk request body
+
+Each document is encoded exactly once, with orjson if it is installed (much faster than the standard library on
+long strings such as article bodies), and the result is kept as bytes. Bulk requests are assembled by joining
+these pieces, and resent as-is if ES asks for a retry.
+"""
+import json
+import typing
+
+from ingest import populate_es
+
+try:
+    import orjson
+    dumps = orjson.dumps
+except ImportError:
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def action_line(_id: typing.Union[str, None], *,
+                index: str=populate_es.PROJECT_INDEX,
+                doc_type: str=populate_es.CONTENT_TYPE,
+                parent: str=None) -> bytes:
+    meta = {'_index': index, '_type': doc_type}
+    if _id is not None:
+        meta['_id'] = _id
+    if parent is not None:
+        meta['_parent'] = parent
+    return dumps({'index': meta}) + b'\n'
+
+
+def encode_document(doc: dict, **kwargs) -> typing.Tuple[typing.Union[str, None], bytes]:
+    """
+    Encode the index action for one document (as created by `populate_es.make_bulk_actions`)
+    :return: (document ID, action and source lines)
+    """
+    _id = populate_es.doc_id(doc)
+    return _id, b''.join([action_line(_id, **kwargs), dumps(doc), b'\n'])
+
+
+def encode_documents(doc: dict, *, index: str=populate_es.PROJECT_INDEX) -> typing.List[typing.Tuple[str, bytes]]:
+    """Like `encode_document`, but also encode the passages of an article extracted in passage mode"""
+    article, passages = populate_es.split_passages(doc)
+    items = [encode_document(article, index=index)]
+    for _id, passage in passages:
+        line = action_line(_id, index=index, doc_type=populate_es.PASSAGE_TYPE, parent=passage['article'])
+        items.append((_id, b''.join([line, dumps(passage), b'\n'])))
+    return items
@@ -0,0 +1,141 @@
+"""
+Fan NXML parsing out over a pool of worker processes
+
+Parsing (lxml + unescaping of full article bodies) is CPU-bound, so a large load benefits from using every core.
+Work is sent to the pool in chunks, and only a limited number of chunks are in flight at once, so that memory
+stays bounded no matter how large the corpus is.
+"""
+import collections
+import concurrent.futures
+import logging
+import os
+import time
+import typing
+
+from lxml import etree
+
+from ingest import archive
+from ingest import metrics
+from ingest import parse_nxml
+
+logger = logging.getLogger(__name__)
+
+# Each worker process builds its own parser (see `init_worker`)
+_worker_parser = None
+
+
+# Work items may be file paths, or article contents already read into memory from an archive
+Source = typing.Union[str, archive.Member]
+
+
+class ParseFailure(typing.NamedTuple):
+    """A file that could not be parsed; reported rather than aborting the whole run"""
+    source: str
+    error: str
+
+
+def source_name(source: Source) -> str:
+    return source.name if isinstance(source, archive.Member) else source
+
+
+def parse_source(source: Source, *,
+                 parser: etree.XMLParser=parse_nxml.parser,
+                 parse_fn: typing.Callable=parse_nxml.parse_nxml) -> dict:
+    """
+    Parse a single work item, whether it lives on disk or in memory
+
+    :param parse_fn: The extractor to use, eg `parse_nxml.parse_nxml` or `extract.parse`
+    """
+    if isinstance(source, archive.Member):
+        return archive.parse_member(source, parser=parser, parse_fn=parse_fn)
+    return parse_fn(source, parser=parser)
+
+
+def as_documents(result: typing.Union[dict, typing.Iterable[dict]]) -> typing.Iterable[dict]:
+    """
+    Extractors normally return one document per file, but may split a large article into several (as a list, or
+    an iterator that reads the article as the parts are consumed)
+    """
+    return [result] if isinstance(result, dict) else result
+
+
+def init_worker():
+    global _worker_parser
+    _worker_parser = etree.XMLParser(remove_blank_text=True)
+
+
+def parse_chunk(sources: typing.List[Source], parse_fn: typing.Callable) -> typing.List[tuple]:
+    """
+    Parse a batch of files inside a worker. Returns (source, doc, error, seconds taken) for every input, in order.
+    Archive members are returned by name only, so that their contents aren't shipped back to the parent process.
+    """
+    results = []
+    for source in sources:
+        name = source_name(source)
+        t1 = time.perf_counter()
+        try:
+            doc = parse_source(source, parser=_worker_parser, parse_fn=parse_fn)
+            if not isinstance(doc, dict):
+                # The parts of a split article have to be collected here, to be sent back to the parent process (so
+                # `ingest.main` only splits articles when parsing in that process, where they are read as needed)
+                doc = list(doc)
+            results.append((name, doc, None, time.perf_counter() - t1))
+        except Exception as e:
+            results.append((name, None, f'{type(e).__name__}: {e}', time.perf_counter() - t1))
+    return results
+
+
+def _chunked(items: typing.Iterable, size: int) -> typing.Iterator[list]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_sources(sources: typing.Iterable[Source], *,
+                  workers: int=None,
+                  chunk_size: int=16,
+                  max_chunks_in_flight: int=None,
+                  failures: list=None,
+                  parse_fn: typing.Callable=parse_nxml.parse_nxml,
+                  stats: metrics.RunStats=metrics.NULL) -> typing.Iterator[typing.Tuple[str, dict]]:
+    """
+    Parse many files in parallel, yielding (source name, parsed document) pairs in input order
+
+    :param sources: An iterable of file paths or archive members to parse. This is consumed lazily.
+    :param workers: Number of worker processes (default: one per CPU)
+    :param chunk_size: How many files to send to a worker in each task
+    :param max_chunks_in_flight: Limit on submitted-but-unconsumed chunks; bounds memory used by parsed results
+    :param failures: If provided, a list that will receive a `ParseFailure` for each file that could not be parsed
+    :param parse_fn: The extractor to use. Must be a module-level function, so that it can be sent to workers.
+    :param stats: Receives the time taken to parse each file
+    """
+    workers = workers or os.cpu_count() or 1
+    max_chunks_in_flight = max_chunks_in_flight or workers * 2
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+        in_flight = collections.deque()
+        for chunk in _chunked(sources, chunk_size):
+            in_flight.append(pool.submit(parse_chunk, chunk, parse_fn))
+            if len(in_flight) >= max_chunks_in_flight:
+                yield from _collect(in_flight.popleft(), failures, stats)
+
+        while in_flight:
+            yield from _collect(in_flight.popleft(), failures, stats)
+
+
+def _collect(future: concurrent.futures.Future, failures: typing.Union[list, None], stats: metrics.RunStats):
+    for source, result, error, seconds in future.result():
+        if error is None:
+            stats.file_parsed(source, seconds)
+            for doc in as_documents(result):
+                yield source, doc
+        else:
+            logger.warning(f'Failed to parse {source}: {error}')
+            stats.parse_failed(source)
+            if failures is not None:
+                failures.append(ParseFailure(source, error))
@@ -13,6 +13,8 @@ from typing import Union
 
 from lxml import etree
 
+from ingest import passages
+
 
 logger = logging.getLogger(__name__)
 
@@ -119,23 +121,27 @@ x_article_editors = etree.XPath('contrib-group/contrib[@contrib-type="editor"]')
 
 ## These get a list of individual string segments; user can join into one string as needed
 x_body_text = etree.XPath('/article/body/descendant-or-self::*/text()')
+x_body = etree.XPath('/article/body')
 # Figures are allowed to appear many places in the document
-## TODO: this gloms together every figure caption into one long list, which is not the desired behavior
+# One caption node per figure; each is converted to a separate string (see `parse_nxml`)
 x_figure_captions = etree.XPath('//fig/caption')
 
 x_acknowledgements = etree.XPath('/article/back/ack/p/text()')
 
 
-def parse_nxml(fn: str):
+def parse_nxml(fn: str, *, parser: etree.XMLParser=parser, as_passages: bool=False):
     """
     Parse xml contents and return (SOMETHING)
     :param fn:
+    :param parser: lxml parser instance to use. Parsers are not safe to share across processes/threads, so each
+        worker should supply its own.
+    :param as_passages: Return the body as a list of passages (see `passages.split_body`), instead of one string
     :return:
     """
     doc = etree.parse(fn, parser=parser)
     article_meta = x_article_meta(doc)[0]
 
-    return {
+    result = {
         "journal": one_text(x_journal(doc)),
 
         "title": one_text(x_article_title(article_meta)),
@@ -146,7 +152,7 @@ def parse_nxml(fn: str):
                      for n in x_article_abstract(article_meta)],
         "keywords": [unescape_text(s) for s in x_article_keywords(article_meta)],
 
-        "body": unescape_text(x_body_text(doc)),
+        "body": None if as_passages else unescape_text(x_body_text(doc)),
         "figure_captions": [unescape_text(x_node_text(n))
                             for n in x_figure_captions(doc)],
         "acknowledgments": unescape_text(x_acknowledgements(doc)),
@@ -160,4 +166,8 @@ def parse_nxml(fn: str):
         "pmc": one_or_none(x_article_pmc(article_meta)),
         "doi": one_or_none(x_article_doi(article_meta))
     }
+    if as_passages:
+        body = x_body(doc)
+        passages.attach(result, body[0] if body else None)
+    return result
 
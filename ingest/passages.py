@@ -0,0 +1,69 @@
+"""
+Split the body of an article into passages (paragraphs, grouped by section), to be indexed as separate documents
+
+Full-text searches otherwise score, and highlight, the whole body of an article as one field: each hit loads and
+highlights megabytes of `_source`, and a match in one paragraph is diluted by the length of the paper. In passage
+mode (`--passages`), the article document keeps its front matter, and each passage is indexed as a small child
+document of it (see `populate_es.split_passages`), so the cost of highlighting depends on the size of a passage.
+
+Each passage records the titles of the sections that contain it (outermost first), and its position in the article.
+Figures are left out, since their captions are already indexed with the article (`figure_captions`).
+"""
+import html
+import typing
+
+# Longer paragraphs are split (at a space) into passages of at most this many characters
+MAX_CHARS = 5000
+
+# Children of a section that are not passages in their own right
+_SKIP = {'title', 'label', 'fig', 'fig-group'}
+
+
+def _text(node) -> str:
+    # Same conversion as the flattened body (`parse_nxml.unescape_text` of every text node)
+    text = ' '.join(node.itertext())
+    return html.unescape(text) if '&' in text else text
+
+
+def _chunks(text: str, max_chars: int) -> typing.Iterator[str]:
+    while len(text) > max_chars:
+        cut = text.rfind(' ', 0, max_chars)
+        if cut <= 0:
+            cut = max_chars
+        yield text[:cut]
+        text = text[cut:].lstrip()
+    if text.strip():
+        yield text
+
+
+def split_body(body, *, max_chars: int=MAX_CHARS) -> typing.List[dict]:
+    """
+    Passages of an article's `/article/body` element, in document order
+    :return: A list of {"section": [titles], "ordinal": position, "text": text}
+    """
+    passages = []
+    if body is None:
+        return passages
+
+    def visit(node, titles: typing.List[str]):
+        for child in node:
+            tag = child.tag
+            if not isinstance(tag, str) or tag in _SKIP:
+                # Comments and processing instructions, section headings, and figures
+                continue
+            if tag == 'sec':
+                title = child.find('title')
+                visit(child, titles + [_text(title)] if title is not None else titles)
+                continue
+            for text in _chunks(_text(child), max_chars):
+                passages.append({"section": titles, "ordinal": len(passages), "text": text})
+
+    visit(body, [])
+    return passages
+
+
+def attach(doc: dict, body) -> dict:
+    """Replace the flattened body of an extracted article with its passages"""
+    doc.pop("body", None)
+    doc["passages"] = split_body(body)
+    return doc
@@ -1,23 +1,181 @@
 """
 Populate data into elasticsearch
 """
+import concurrent.futures
+import contextlib
 import logging
 import typing
 
-import elasticsearch.helpers
+from ingest import config
 
 logger = logging.getLogger(__name__)
 
-# TODO: Initially this will just populate a local ES instance at port 9200; may want to make configurable
-client = elasticsearch.Elasticsearch()
+settings = config.from_env()
+client = config.make_client(settings)
 PROJECT_INDEX = 'pubmed'
 CONTENT_TYPE = 'article'
+# Child documents of articles, in passage mode (see `passages`)
+PASSAGE_TYPE = 'passage'
 
+# Index settings that trade durability and search visibility for write throughput during a large load
+BULK_LOAD_SETTINGS = {
+    'index.refresh_interval': '-1',
+    'index.number_of_replicas': 0,
+    'index.translog.durability': 'async',
+}
+
+
+def connect(es_config: config.ESConfig):
+    """Point this module at a different cluster (eg using settings from the command line)"""
+    global client, settings
+    settings = es_config
+    client = config.make_client(es_config)
+
+
+# Selectable mappings (see `make_mapping`)
+MAPPING_PROFILES = ('default', 'lean')
+
+
+def make_mapping(profile: str='default') -> dict:
+    """
+    The field mapping for articles
+
+    The `lean` profile indexes less, for a smaller index and faster loads: identifiers and other exact values are
+    keywords (with doc values, so that aggregations on them are cheap); phrase shingles are only built for the title
+    and abstract, in a `shingles` subfield; fields that are never used for scoring skip norms and positions; and
+    the `_all` field is disabled, so searches must name the fields to search.
+    """
+    if profile not in MAPPING_PROFILES:
+        raise ValueError(f'Unknown mapping profile: {profile}')
+
+    # Reused field types
+    basic_text = {"type": "text", "analyzer": "standard"}
+    ngram_text = {
+        "type": "text",
+        "analyzer": "sci_text"
+    }
+    authors = {
+        "type": "nested",
+        "properties": {
+            "surname": {"type": "keyword"},
+            "given-names": {"type": "keyword"},
+            "full-name": {"type": "keyword"}
+        }
+    }
+
+    if profile == 'lean':
+        keyword = {"type": "keyword"}
+        phrase_text = dict(basic_text, fields={"shingles": ngram_text})
+        return {
+            "_all": {"enabled": False},
+            "properties": {
+                "journal": {"type": "text", "fields": {"raw": keyword}},
+                "title": phrase_text,
+                "authors": authors,
+                "abstract": phrase_text,
+                "keywords": keyword,
+
+                "body": basic_text,
+                "figure_captions": basic_text,
+                # Searchable, but not worth scoring by term position or field length
+                "acknowledgments": dict(basic_text, norms=False, index_options="freqs"),
+
+                "date": {"type": "date"},
+                # Not always numeric (eg "e1003426" for online-only articles)
+                "volume": keyword,
+                "issue": keyword,
+                "fpage": keyword,
+                "part": {"type": "integer"},
+
+                "pmid": keyword,
+                "pmc": keyword,
+                "doi": keyword
+            }
+        }
+
+    identifier = {"type": "text", "index": "not_analyzed"}
+    return {
+        "properties": {
+            "journal": {
+                "type": "text",
+                "fields": {
+                    "raw": {
+                        "type": "text",
+                        "index": "not_analyzed"
+                    }
+                }
+            },
+            "title": ngram_text,
+            "authors": authors,
+            "abstract": ngram_text,
+            "keywords": {"type": "keyword"},
+
+            "body": ngram_text,
+            "figure_captions": ngram_text,
+            "acknowledgments": basic_text,
+
+            "date": {"type": "date"},
+            ## TODO : Can we safely change these over to numeric fields in future?
+            "volume": basic_text,
+            "issue": basic_text,
+            "fpage": basic_text,
+            # Only present for articles that were split into several documents
+            "part": {"type": "integer"},
+
+            "pmid": identifier,
+            "pmc": identifier,
+            "doi": identifier
+        }
+    }
+
+
+def make_passage_mapping(profile: str='default') -> dict:
+    """
+    The mapping for passages: children of an article, each holding part of its body text
+
+    Passage text stores offsets, so that ES can highlight it from the postings list without re-analyzing it.
+    """
+    if profile not in MAPPING_PROFILES:
+        raise ValueError(f'Unknown mapping profile: {profile}')
+    analyzer = 'standard' if profile == 'lean' else 'sci_text'
+    return {
+        "_parent": {"type": CONTENT_TYPE},
+        "_all": {"enabled": False},
+        "properties": {
+            "article": {"type": "keyword"},
+            "section": {"type": "text", "analyzer": "standard", "fields": {"raw": {"type": "keyword"}}},
+            "ordinal": {"type": "integer"},
+            "text": {"type": "text", "analyzer": analyzer, "index_options": "offsets"},
+            # Copied from the article, so that passages can be filtered by year without a parent query
+            "date": {"type": "date"}
+        }
+    }
+
+
+def supports_index_sorting() -> bool:
+    """Index sorting was added in ES 6.0"""
+    version = client.info()['version']['number']
+    return int(version.split('.')[0]) >= 6
+
+
+def setup_index(*, drop: bool=False, profile: str='default', sort_by_date: bool=False, index: str=PROJECT_INDEX,
+                passages: bool=False):
+    """
+    Set up indices for this project in ES, optionally deleting any data already there
+
+    :param profile: Which mapping to use (see `make_mapping`)
+    :param sort_by_date: When creating the index, store documents sorted by date (newest first). This makes
+        date-ordered and date-filtered queries faster, at some cost to indexing speed. Requires ES 6.0+.
+    :param index: Name of the index (eg to compare profiles side by side)
+    :param passages: Also map the passage type. A parent type can only be declared before it has any documents,
+        so an existing index without passages must be recreated (with `drop`).
+    """
+    index_mapping = {CONTENT_TYPE: make_mapping(profile)}
+    if passages:
+        index_mapping[PASSAGE_TYPE] = make_passage_mapping(profile)
 
-def setup_index(*, drop: bool=False):
-    """Set up indices for this project in ES, optionally deleting any data already there"""
     if drop is True:
-        client.indices.delete(index=PROJECT_INDEX, ignore=[400, 404])
+        client.indices.delete(index=index, ignore=[400, 404])
         # Predefined analyzers that can be applied to fields
         analysis_settings = {
             "analyzer": {
@@ -39,80 +197,228 @@ def setup_index(*, drop: bool=False):
 
         body = {
             "settings": {
+                "number_of_replicas": settings.replicas,
                 "analysis": analysis_settings
-            }
+            },
+            # The sort field must be mapped when the index is created
+            "mappings": index_mapping
         }
-        ret = client.indices.create(index=PROJECT_INDEX,
+        if sort_by_date:
+            if supports_index_sorting():
+                body["settings"]["sort"] = {"field": "date", "order": "desc"}
+            else:
+                logger.warning('Index sorting requires ES 6.0 or later; creating an unsorted index')
+
+        ret = client.indices.create(index=index,
                                     body=body,
                                     ignore=400)
 
         logger.warning('Index create/update result (may include suppressed errors): {}'.format(ret))
 
-    # Reused field types
-    basic_text = {"type": "text", "analyzer": "standard"}
-    ngram_text = {
-        "type": "text",
-        "analyzer": "sci_text"
-    }
-    identifier = {"type": "text", "index": "not_analyzed"}
+    for doc_type, mapping in index_mapping.items():
+        client.indices.put_mapping(index=index, doc_type=doc_type, body={doc_type: mapping})
 
-    # Mappings
-    index_mapping = {
-        CONTENT_TYPE: {
-            "properties": {
-                "journal": {
-                    "type": "text",
-                    "fields": {
-                        "raw": {
-                            "type": "text",
-                            "index": "not_analyzed"
-                        }
-                    }
-                },
-                "title": ngram_text,
-                "authors": {
-                    "type": "nested",
-                    "properties": {
-                        "surname": {"type": "keyword"},
-                        "given-names": {"type": "keyword"},
-                        "full-name": {"type": "keyword"}
-                    }
-                },
-                "abstract": ngram_text,
-                "keywords": {"type": "keyword"},
 
-                "body": ngram_text,
-                "figure_captions": ngram_text,
-                "acknowledgments": basic_text,
+def has_passages(index: str=PROJECT_INDEX) -> bool:
+    """Whether the index exists, and was created with the passage type (see `setup_index`)"""
+    mappings = client.indices.get_mapping(index=index, ignore=404)
+    return PASSAGE_TYPE in mappings.get(index, {}).get('mappings', {})
 
-                "date": {"type": "date"},
-                ## TODO : Can we safely change these over to numeric fields in future?
-                "volume": basic_text,
-                "issue": basic_text,
-                "fpage": basic_text,
-
-                "pmid": identifier,
-                "pmc": identifier,
-                "doi": identifier
-            }
-        }
+
+def _production_settings() -> dict:
+    """
+    Settings to restore after a bulk load: whatever the index had before, or else the configured defaults. A value
+    that matches the bulk load settings is assumed to be left over from an earlier load that was killed before it
+    could restore them, so is replaced by the default.
+    """
+    defaults = {
+        'index.refresh_interval': settings.refresh_interval,
+        'index.number_of_replicas': settings.replicas,
+        'index.translog.durability': 'request',
     }
+    current = client.indices.get_settings(index=PROJECT_INDEX, flat_settings=True)
+    current = current.get(PROJECT_INDEX, {}).get('settings', {})
+    production = {}
+    for key, default in defaults.items():
+        value = current.get(key)
+        if value is None or str(value) == str(BULK_LOAD_SETTINGS[key]):
+            value = default
+        production[key] = value
+    return production
+
+
+@contextlib.contextmanager
+def bulk_load(*, force_merge: bool=False, max_num_segments: int=1):
+    """
+    Tune the index for a large load, and restore the previous settings afterwards (even if the load fails).
+
+    During the load, the index is not refreshed, has no replicas, and fsyncs the translog asynchronously.
+    :param force_merge: After a successful load, merge segments down to `max_num_segments`. This is expensive,
+        but makes searches faster on an index that will not change much.
+    """
+    production = _production_settings()
+    logger.info(f'Applying bulk load settings; will restore {production}')
+    client.indices.put_settings(index=PROJECT_INDEX, body=BULK_LOAD_SETTINGS)
+    try:
+        yield
+    finally:
+        client.indices.put_settings(index=PROJECT_INDEX, body=production)
+        client.indices.refresh(index=PROJECT_INDEX)
+
+    if force_merge:
+        client.indices.forcemerge(index=PROJECT_INDEX, max_num_segments=max_num_segments,
+                                  request_timeout=60 * 60)
+
 
-    client.indices.put_mapping(index=PROJECT_INDEX, doc_type=CONTENT_TYPE, body=index_mapping)
+def doc_id(doc: dict) -> typing.Union[str, None]:
+    """
+    A stable ID for an article, taken from its identifiers (in order of preference). Indexing the same article
+    twice will replace the existing document instead of creating a duplicate.
+
+    Articles that were split into several parts (see `extract.iterparse`) get one ID per part.
+    """
+    for field in ('pmc', 'pmid', 'doi'):
+        if doc.get(field):
+            _id = f'{field}:{doc[field]}'
+            return f'{_id}/{doc["part"]}' if doc.get('part') else _id
+    return None
+
+
+def _current_client():
+    """The module's client (for defaults of parameters that are themselves named `client`)"""
+    return client
+
+
+class StaleDocuments:
+    """
+    Delete documents left over from an earlier, longer version of an article: when an article is split into fewer
+    parts than last time it was indexed, its old higher-numbered parts are removed, and when it has fewer passages,
+    so are its passages beyond the new last one.
+
+    Call `add` (or `track`) with each document, in order, and `finish` at the end of the run. Deletions are sent
+    in batches, with one delete-by-query request for many articles.
+    """
+    def __init__(self, client=None, *, batch_size: int=500, executor: concurrent.futures.Executor=None):
+        """
+        :param batch_size: Articles per delete-by-query request (each adds a clause to its query)
+        :param executor: If given, send requests in the background with this (eg so as not to block an event loop)
+        """
+        self.client = client or _current_client()
+        self.batch_size = batch_size
+        self.executor = executor
+
+        self._clauses = []
+        self._article = None  # ID of the article whose parts are being seen, and how many so far
+        self._parts = 0
+
+    def add(self, doc: dict):
+        if 'passages' in doc:
+            parent_id = doc_id(doc)
+            if parent_id is not None:
+                # Passages are numbered from 0, so the new ones are exactly those below the new count
+                self._add_clause({"bool": {"filter": [
+                    {"term": {"article": parent_id}},
+                    {"range": {"ordinal": {"gte": len(doc['passages'])}}}
+                ]}})
+        if 'part' in doc:
+            # Parts of one article arrive together, so its part count is final when another article starts
+            base = doc_id(dict(doc, part=0))
+            if base != self._article:
+                self._close()
+                self._article = base
+            self._parts += 1
+
+    def track(self, parsed: typing.Iterable[typing.Tuple[str, dict]]) -> typing.Iterator[typing.Tuple[str, dict]]:
+        """Pass along (name, document) pairs, calling `add` for each, then `finish`"""
+        for name, doc in parsed:
+            self.add(doc)
+            yield name, doc
+        self.finish()
+
+    def finish(self):
+        self._close()
+        self.flush()
+
+    def _close(self):
+        base, parts = self._article, self._parts
+        self._article, self._parts = None, 0
+        if base is None:
+            return
+        # IDs are not indexed in ES 5, but `_uid` (type#id) is, and supports prefix queries. Part 0 has no suffix.
+        self._add_clause({"bool": {
+            "filter": {"prefix": {"_uid": f'{CONTENT_TYPE}#{base}/'}},
+            "must_not": {"ids": {"values": [f'{base}/{i}' for i in range(1, parts)]}}
+        }})
+
+    def _add_clause(self, clause: dict):
+        self._clauses.append(clause)
+        if len(self._clauses) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._clauses:
+            return
+        body = {"query": {"bool": {"should": self._clauses, "minimum_should_match": 1}}}
+        self._clauses = []
+        if self.executor is not None:
+            self.executor.submit(self._delete, body)
+        else:
+            self._delete(body)
+
+    def _delete(self, body: dict):
+        res = self.client.delete_by_query(index=PROJECT_INDEX, body=body, conflicts='proceed')
+        if res.get('deleted'):
+            logger.info(f'Deleted {res["deleted"]} parts or passages left over from earlier versions of articles')
+        if res.get('failures'):
+            logger.warning(f'Could not delete some stale parts or passages: {res["failures"][:1]}')
+
+
+def passage_id(parent_id: str, ordinal: int) -> str:
+    return f'{parent_id}#{ordinal}'
+
+
+def split_passages(doc: dict) -> typing.Tuple[dict, typing.List[typing.Tuple[str, dict]]]:
+    """
+    Separate an article extracted in passage mode from its passages
+    :return: The article's own document, and (ID, document) pairs for its passages (empty for other articles)
+
+    Passages are stored under their article, so an article without an ID keeps its body text instead. Passages
+    beyond the end of a shortened article are removed by `StaleDocuments` when it is indexed again.
+    """
+    if 'passages' not in doc:
+        return doc, []
+    article = {key: value for key, value in doc.items() if key != 'passages'}
+    parent_id = doc_id(article)
+    if parent_id is None:
+        article['body'] = ' '.join(passage['text'] for passage in doc['passages'])
+        return article, []
+    return article, [(passage_id(parent_id, passage['ordinal']),
+                      dict(passage, article=parent_id, date=article.get('date')))
+                     for passage in doc['passages']]
 
 
 def make_bulk_actions(docs: typing.Iterator[object]) -> typing.Iterator[object]:
-    """Convert an iterator of documents to an iterator of ES index actions"""
+    """Convert an iterator of documents to an iterator of ES index actions (followed by any passages)"""
     for doc in docs:
-        yield {
+        doc, passages = split_passages(doc)
+        action = {
             '_index': PROJECT_INDEX,
             '_type': CONTENT_TYPE,
             '_source': doc
         }
-
-
-def process_documents(actions):
-    return elasticsearch.helpers.bulk(client, actions)
+        _id = doc_id(doc)
+        if _id is not None:
+            action['_id'] = _id
+        yield action
+        for child_id, passage in passages:
+            yield {
+                '_index': PROJECT_INDEX,
+                '_type': PASSAGE_TYPE,
+                '_id': child_id,
+                # Stored in the same shard as the article
+                '_parent': _id,
+                '_source': passage
+            }
 
 
 if __name__ == '__main__':
@@ -0,0 +1,310 @@
+"""
+A small summary index, kept up to date during ingestion, that answers the dashboard's aggregations
+
+The dashboard's year histogram and per-year keyword chart would otherwise aggregate over every article on each page
+load. Instead, as batches of new articles are indexed, per-year document counts and keyword/journal frequencies
+are added to a separate rollup index (one small document per year and term, updated with a scripted upsert).
+`RollupQueries` reads these back, and caches results until the rollup next changes.
+
+Only newly created articles are counted, so that re-indexing an article does not count it twice. (An article whose
+keywords change keeps its old counts, until the rollup is rebuilt with `--drop`.)
+"""
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import threading
+import time
+import typing
+
+import elasticsearch
+import elasticsearch.helpers
+
+from ingest import populate_es
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_INDEX = 'pubmed_rollup'
+ROLLUP_TYPE = 'summary'
+
+# Incremented every time the rollup changes, so that readers know when to discard cached results
+GENERATION_ID = 'generation'
+
+ROLLUP_MAPPING = {
+    ROLLUP_TYPE: {
+        "_all": {"enabled": False},
+        "properties": {
+            "kind": {"type": "keyword"},  # year, keyword, journal, or generation
+            "year": {"type": "integer"},
+            "term": {"type": "keyword"},
+            "count": {"type": "long"},
+            "generation": {"type": "long"}
+        }
+    }
+}
+
+
+class Summary(typing.NamedTuple):
+    """What an article contributes to the rollup"""
+    year: int
+    journal: typing.Union[str, None]
+    keywords: typing.List[str]
+
+
+def summarize(doc: dict) -> typing.Union[Summary, None]:
+    """Articles without a date don't appear in the year histogram, so they are not counted"""
+    if doc.get('part') or not doc.get('date'):
+        # Articles that were split into parts are counted once, for part 0
+        return None
+    return Summary(int(doc['date'][:4]), doc.get('journal'), sorted(set(doc.get('keywords') or [])))
+
+
+def setup_rollup_index(*, drop: bool=False):
+    client = populate_es.client
+    if drop is True:
+        client.indices.delete(index=ROLLUP_INDEX, ignore=[400, 404])
+    body = {
+        "settings": {
+            "number_of_shards": 1,
+            "number_of_replicas": populate_es.settings.replicas
+        },
+        "mappings": ROLLUP_MAPPING
+    }
+    client.indices.create(index=ROLLUP_INDEX, body=body, ignore=400)
+
+
+def _rollup_id(kind: str, year: int, term: str=None) -> str:
+    _id = f'{kind}:{year}' if term is None else f'{kind}:{year}:{term}'
+    # IDs are limited to 512 bytes; keywords are occasionally whole sentences
+    if len(_id.encode('utf-8')) > 500:
+        _id = f'{kind}:{year}:sha1:{hashlib.sha1(term.encode("utf-8")).hexdigest()}'
+    return _id
+
+
+def _increment(_id: str, source: dict, field: str, n: int) -> dict:
+    """A bulk action that adds n to a counter, creating the document if it doesn't exist yet"""
+    return {
+        '_op_type': 'update',
+        '_index': ROLLUP_INDEX,
+        '_type': ROLLUP_TYPE,
+        '_id': _id,
+        # Several ingest hosts may update the same counters at once
+        '_retry_on_conflict': 5,
+        'script': {'lang': 'painless', 'inline': f'ctx._source.{field} += params.n', 'params': {'n': n}},
+        'upsert': dict(source, **{field: n}),
+    }
+
+
+class Rollup:
+    """
+    Count new articles as their batches are acknowledged, and add the counts to the rollup index
+
+    Call `add` (or `track`) with each document before it is sent, pass `completed` as the indexer's `on_batch`
+    callback, and `flush` at the end of the run (even if it fails, since the articles counted so far are indexed).
+    """
+    def __init__(self, client=None, *, flush_docs: int=1000, executor: concurrent.futures.Executor=None):
+        """
+        :param flush_docs: Update the rollup index each time this many new articles have been counted
+        :param executor: If given, send updates in the background with this (eg a thread, so as not to block an
+            asyncio event loop); shut it down after the final `flush` to wait for them
+        """
+        self.client = client or populate_es.client
+        self.flush_docs = flush_docs
+        self.executor = executor
+
+        self._pending = {}  # type: typing.Dict[str, Summary]  # By document ID, until ES acknowledges the document
+        self._counts = collections.Counter()  # (kind, year, term) -> count
+        self._docs = 0  # Counted since the last flush
+        # Updates that fail are added back to the counts (possibly from the executor's thread)
+        self._lock = threading.Lock()
+
+    def add(self, doc: dict):
+        summary = summarize(doc)
+        _id = populate_es.doc_id(doc)
+        if summary is not None and _id is not None:
+            self._pending[_id] = summary
+
+    def track(self, parsed: typing.Iterable[typing.Tuple[str, dict]]) -> typing.Iterator[typing.Tuple[str, dict]]:
+        """Pass along (name, document) pairs, calling `add` for each"""
+        for name, doc in parsed:
+            self.add(doc)
+            yield name, doc
+
+    def completed(self, outcome):
+        """Count the new articles in a batch (an `indexer.BatchOutcome`)"""
+        with self._lock:
+            for _id in outcome.created:
+                summary = self._pending.pop(_id, None)
+                if summary is None:
+                    continue
+                self._counts[('year', summary.year, None)] += 1
+                if summary.journal:
+                    self._counts[('journal', summary.year, summary.journal)] += 1
+                for keyword in summary.keywords:
+                    self._counts[('keyword', summary.year, keyword)] += 1
+                self._docs += 1
+
+        for _id in outcome.updated:
+            self._pending.pop(_id, None)
+        for failure in outcome.failures:
+            self._pending.pop(failure.id, None)
+
+        if self._docs >= self.flush_docs:
+            self.flush()
+
+    def flush(self):
+        """Add the counts so far to the rollup index"""
+        with self._lock:
+            counts = self._counts
+            self._counts = collections.Counter()
+            self._docs = 0
+        if not counts:
+            return
+        if self.executor is not None:
+            self.executor.submit(self._send, counts)
+        else:
+            self._send(counts)
+
+    def _send(self, counts: typing.Dict[tuple, int]):
+        by_id = {_rollup_id(kind, year, term): (kind, year, term) for kind, year, term in counts}
+        actions = [_increment(_id, {'kind': kind, 'year': year, 'term': term}, 'count', counts[kind, year, term])
+                   for _id, (kind, year, term) in by_id.items()]
+        actions.append(_increment(GENERATION_ID, {'kind': 'generation'}, 'generation', 1))
+        try:
+            _, errors = elasticsearch.helpers.bulk(self.client, actions, raise_on_error=False)
+        except elasticsearch.TransportError as e:
+            errors = [{'update': {'_id': _id, 'error': str(e)}} for _id in by_id]
+        if errors:
+            # Keep the counts that were not added, to be sent again with the next flush
+            failed = [next(iter(error.values())).get('_id') for error in errors]
+            with self._lock:
+                for _id in failed:
+                    if _id in by_id:
+                        self._counts[by_id[_id]] += counts[by_id[_id]]
+            logger.warning(f'{len(errors)} rollup updates failed; their counts are kept for the next flush. '
+                           f'First error: {errors[0]}')
+
+
+class RollupQueries:
+    """
+    Read precomputed aggregations from the rollup index
+
+    Results are kept in an LRU cache, which is emptied whenever the rollup's generation changes (ie when an ingest
+    run has added to it).
+    """
+    def __init__(self, client=None, *, cache_size: int=256, check_interval: float=1.0):
+        """
+        :param check_interval: Seconds between checks of the generation number; results may be up to this stale
+        """
+        self.client = client or populate_es.client
+        self.cache_size = cache_size
+        self.check_interval = check_interval
+
+        self._cache = collections.OrderedDict()
+        self._generation = None
+        self._next_check = 0.0
+
+    def generation(self) -> int:
+        doc = self.client.get(index=ROLLUP_INDEX, doc_type=ROLLUP_TYPE, id=GENERATION_ID, ignore=404)
+        return doc['_source']['generation'] if doc.get('found') else 0
+
+    def _cached(self, key: tuple, compute: typing.Callable[[], object]):
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            generation = self.generation()
+            if generation != self._generation:
+                self._cache.clear()
+                self._generation = generation
+
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        value = compute()
+        self._cache[key] = value
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return value
+
+    def _search(self, filters: typing.List[dict], *, size: int, sort: list) -> typing.List[dict]:
+        body = {
+            'query': {'bool': {'filter': filters}},
+            'size': size,
+            'sort': sort,
+        }
+        res = self.client.search(index=ROLLUP_INDEX, doc_type=ROLLUP_TYPE, body=body)
+        return [hit['_source'] for hit in res['hits']['hits']]
+
+    def year_counts(self) -> typing.List[dict]:
+        """The number of articles published in each year (replaces the dashboard's date histogram)"""
+        def compute():
+            hits = self._search([{'term': {'kind': 'year'}}], size=10000, sort=[{'year': 'asc'}])
+            return [{'year': hit['year'], 'count': hit['count']} for hit in hits]
+        return self._cached(('years',), compute)
+
+    def top_terms(self, year: int, *, kind: str='keyword', size: int=10) -> typing.List[dict]:
+        """The most frequent keywords (or journals) among articles published in a year"""
+        def compute():
+            hits = self._search([{'term': {'kind': kind}}, {'term': {'year': year}}],
+                                size=size, sort=[{'count': 'desc'}, {'term': 'asc'}])
+            return [{'key': hit['term'], 'count': hit['count']} for hit in hits]
+        return self._cached(('top', kind, year, size), compute)
+
+    def significant_terms(self, year: int, *, size: int=10, candidates: int=200) -> typing.List[dict]:
+        """
+        Keywords that are unusually common in a year, compared with all years. Scored like the `jlh` heuristic of
+        ES's `significant_terms` aggregation, but over the most frequent `candidates` keywords of the year only.
+        """
+        def compute():
+            foreground = self.top_terms(year, size=candidates)
+            if not foreground:
+                return []
+            totals = {item['year']: item['count'] for item in self.year_counts()}
+            fg_total = totals.get(year, 0)
+            bg_total = sum(totals.values())
+
+            body = {
+                'query': {'bool': {'filter': [{'term': {'kind': 'keyword'}},
+                                              {'terms': {'term': [item['key'] for item in foreground]}}]}},
+                'size': 0,
+                'aggregations': {'terms': {'terms': {'field': 'term', 'size': candidates},
+                                           'aggregations': {'count': {'sum': {'field': 'count'}}}}}
+            }
+            res = self.client.search(index=ROLLUP_INDEX, doc_type=ROLLUP_TYPE, body=body)
+            background = {b['key']: b['count']['value'] for b in res['aggregations']['terms']['buckets']}
+
+            scored = []
+            for item in foreground:
+                fg = item['count'] / fg_total if fg_total else 0.0
+                bg = background.get(item['key'], 0) / bg_total if bg_total else 0.0
+                score = (fg - bg) * (fg / bg) if bg and fg > bg else 0.0
+                scored.append(dict(item, score=score))
+            scored.sort(key=lambda item: (-item['score'], -item['count']))
+            return scored[:size]
+        return self._cached(('significant', year, size, candidates), compute)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the rollup index')
+    parser.add_argument('query', choices=['years', 'keywords', 'journals', 'significant'])
+    parser.add_argument('year', type=int, nargs='?')
+    parser.add_argument('--size', type=int, default=10)
+    args = parser.parse_args()
+
+    queries = RollupQueries()
+    if args.query == 'years':
+        result = queries.year_counts()
+    elif args.year is None:
+        parser.error(f'{args.query} needs a year')
+    elif args.query == 'significant':
+        result = queries.significant_terms(args.year, size=args.size)
+    else:
+        result = queries.top_terms(args.year, kind=args.query[:-1], size=args.size)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
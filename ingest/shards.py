@@ -0,0 +1,122 @@
+"""
+Store parsed articles in compressed shard files, so that the index can be rebuilt without re-parsing any XML
+
+Each shard is a series of independently gzipped blocks of line-delimited JSON (so the file as a whole is still a
+valid `.gz`). A small `index.json` records the offset, length, and document count of every block; readers
+memory-map each shard and decompress one block at a time. The index is only written once every document has been,
+so a directory without one holds an incomplete (or failed) export.
+"""
+import gzip
+import json
+import mmap
+import os
+import typing
+import zlib
+
+INDEX_FILENAME = 'index.json'
+
+
+class ShardWriter:
+    """
+    Write documents to a directory of shards. Use as a context manager, so that the index is written at the end (if
+    there was no error).
+    """
+    def __init__(self, dirname: str, *,
+                 docs_per_shard: int=100000,
+                 docs_per_block: int=500,
+                 compresslevel: int=6):
+        self.dirname = dirname
+        self.docs_per_shard = docs_per_shard
+        self.docs_per_block = docs_per_block
+        self.compresslevel = compresslevel
+
+        self.shards = []
+        self.count = 0
+
+        self._file = None
+        self._block = []
+
+    def __enter__(self):
+        os.makedirs(self.dirname, exist_ok=True)
+        # Any existing index describes shard files that are about to be overwritten
+        try:
+            os.remove(os.path.join(self.dirname, INDEX_FILENAME))
+        except FileNotFoundError:
+            pass
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(complete=exc_type is None)
+
+    def write(self, doc: dict):
+        if self._file is None or self.shards[-1]['count'] >= self.docs_per_shard:
+            self._next_shard()
+        self._block.append(json.dumps(doc, ensure_ascii=False))
+        self.shards[-1]['count'] += 1
+        self.count += 1
+        if len(self._block) >= self.docs_per_block:
+            self._flush_block()
+
+    def close(self, *, complete: bool=True):
+        """
+        :param complete: Write the index. If False (eg because the export failed), the shards are left without one,
+            so that they can't be mistaken for a complete export.
+        """
+        if self._file is not None:
+            self._flush_block()
+            self._file.close()
+            self._file = None
+        if complete:
+            # Written under a temporary name first, so that a reader never sees a partial index
+            fn = os.path.join(self.dirname, INDEX_FILENAME)
+            with open(fn + '.tmp', 'w') as f:
+                json.dump({'count': self.count, 'shards': self.shards}, f)
+            os.replace(fn + '.tmp', fn)
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._flush_block()
+            self._file.close()
+        fn = f'shard-{len(self.shards):05d}.jsonl.gz'
+        self._file = open(os.path.join(self.dirname, fn), 'wb')
+        self.shards.append({'file': fn, 'count': 0, 'blocks': []})
+
+    def _flush_block(self):
+        if not self._block:
+            return
+        data = gzip.compress(('\n'.join(self._block) + '\n').encode('utf-8'), compresslevel=self.compresslevel)
+        offset = self._file.tell()
+        self._file.write(data)
+        self.shards[-1]['blocks'].append([offset, len(data), len(self._block)])
+        self._block = []
+
+
+def write_shards(docs: typing.Iterable[dict], dirname: str, **kwargs) -> int:
+    """Write every document to shards; returns the number of documents written"""
+    with ShardWriter(dirname, **kwargs) as writer:
+        for doc in docs:
+            writer.write(doc)
+    return writer.count
+
+
+def read_index(dirname: str) -> dict:
+    with open(os.path.join(dirname, INDEX_FILENAME)) as f:
+        return json.load(f)
+
+
+def iter_shard(fn: str, blocks: typing.List[typing.List[int]]) -> typing.Iterator[dict]:
+    """Read the documents in one shard file"""
+    with open(fn, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for offset, length, _ in blocks:
+            # wbits=31: expect a gzip header
+            block = zlib.decompress(data[offset:offset + length], wbits=31)
+            for line in block.splitlines():
+                yield json.loads(line)
+
+
+def iter_shards(dirname: str) -> typing.Iterator[typing.Tuple[str, dict]]:
+    """Read back every document in a directory of shards, yielding (location, document) pairs"""
+    for shard in read_index(dirname)['shards']:
+        fn = os.path.join(dirname, shard['file'])
+        for i, doc in enumerate(iter_shard(fn, shard['blocks'])):
+            yield f'{fn}#{i}', doc
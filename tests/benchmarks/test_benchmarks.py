@@ -0,0 +1,131 @@
+"""
+Check that the benchmark tools produce valid input and a realistic stand-in for ES
+"""
+import glob
+import os
+import random
+
+from benchmarks import bulk_server
+from benchmarks import corpus
+from benchmarks import query_load
+from ingest import config
+from ingest import extract
+from ingest import indexer
+from ingest import parse_nxml
+from ingest import populate_es
+
+
+def test_generated_articles_have_requested_shape(tmpdir):
+    corpus.generate(str(tmpdir), 3, per_dir=2, body_chars=5000, authors=3, figures=2, entity_density=0.1)
+    fns = sorted(glob.glob(os.path.join(str(tmpdir), '*', '*.nxml')))
+    assert len(fns) == 3
+
+    doc = parse_nxml.parse_nxml(fns[1])
+    assert doc == extract.parse(fns[1])
+    assert doc['pmc'] == '10000001'
+    assert len(doc['authors']) == 3
+    assert len(doc['figure_captions']) == 2
+    assert 5000 <= len(doc['body']) < 7000
+    assert '±' in doc['body'] or 'µm' in doc['body'] or 'α' in doc['body']
+
+
+def test_indexer_retries_items_rejected_by_stand_in():
+    server = bulk_server.start(reject_items=0.2, seed=1)
+    try:
+        client = config.make_client(config.from_env()._replace(hosts=[server.host]))
+        bulk = indexer.BulkIndexer(client, batch_bytes=2000, backoff=0)
+        rng = random.Random(0)
+        items = [(i, str(i), f'{{"index":{{"_id":"{i}"}}}}\n{{"body":"{"x" * rng.randint(10, 500)}"}}\n'.encode())
+                 for i in range(100)]
+
+        result = bulk.index_encoded(items)
+    finally:
+        server.shutdown()
+
+    assert result.indexed == 100
+    assert result.retries == server.stats.rejected_items > 0
+
+
+def test_stand_in_reports_document_types():
+    server = bulk_server.start(seed=1)
+    try:
+        client = config.make_client(config.from_env()._replace(hosts=[server.host]))
+        bulk = indexer.BulkIndexer(client, batch_bytes=2000)
+        passages = [{'section': [], 'ordinal': i, 'text': 'x' * 100} for i in range(3)]
+        docs = [{'pmc': str(i), 'date': '2010-01-01', 'passages': passages} for i in range(10)]
+
+        result = bulk.index(populate_es.make_bulk_actions(docs))
+    finally:
+        server.shutdown()
+
+    assert result.types == {populate_es.CONTENT_TYPE: 10, populate_es.PASSAGE_TYPE: 30}
+
+
+class FakeSearchClient:
+    def __init__(self):
+        self.calls = []
+
+    def search(self, index=None, body=None, params=None):
+        self.calls.append((index, body, params))
+        response = {'took': 3 if 'aggregations' in body else 7, 'hits': {'total': 1, 'hits': []}}
+        if body.get('profile'):
+            response['profile'] = {'shards': [{
+                'searches': [{'query': [{'type': 'TermQuery', 'description': 'keywords:x', 'time_in_nanos': 2000000,
+                                         'children': []}]}],
+                'aggregations': [{'type': 'SignificantTermsAggregator', 'description': 'significantKeywords',
+                                  'time_in_nanos': 5000000, 'children': []}],
+            }]}
+        return response
+
+
+def test_query_load_sweeps_and_summarizes(tmpdir):
+    requests = query_load.make_requests(sorted(query_load.TEMPLATES), years=[2001, 2002], keywords=['a', 'b', 'c'])
+    assert [r.template for r in requests].count('year_histogram') == 1
+    assert [r.template for r in requests].count('terms_for_year') == 2
+    assert [r.template for r in requests].count('keyword_drilldown') == 6
+
+    client = FakeSearchClient()
+    recorder = query_load.Recorder(str(tmpdir.join('responses.jsonl')))
+    samples, elapsed = query_load.run_load(client, requests, concurrency=3, total=50, profile=True,
+                                           request_cache=False, recorder=recorder)
+    recorder.close()
+
+    assert len(samples) == len(client.calls) == 50
+    assert all(body['profile'] is True and params == {'request_cache': 'false'} for _, body, params in client.calls)
+    summary = query_load.summarize(samples, elapsed)
+    assert sum(entry['requests'] for entry in summary.values()) == 50
+    drilldown = summary['keyword_drilldown']
+    assert drilldown['errors'] == 0
+    assert drilldown['took_ms'] == {'p50': 7, 'p95': 7, 'p99': 7}
+    assert drilldown['slowest_components'][0]['mean_ms'] == 5.0
+    assert drilldown['slowest_components'][0]['section'] == 'aggregation'
+
+
+def test_query_load_replays_recorded_responses(tmpdir):
+    fn = str(tmpdir.join('responses.jsonl'))
+    requests = query_load.make_requests(['terms_for_year'], years=[2001, 2002], keywords=[])
+    recorder = query_load.Recorder(fn)
+    query_load.run_load(FakeSearchClient(), requests, total=20, recorder=recorder)
+    recorder.close()
+    assert len(open(fn).readlines()) == 2
+
+    server = query_load.start_replay(fn, use_latency=False)
+    try:
+        client = config.make_client(config.from_env()._replace(hosts=[server.host]))
+        samples, _ = query_load.run_load(client, requests, total=10, concurrency=2)
+        missing = query_load.make_requests(['terms_for_year'], years=[1999], keywords=[])
+        unrecorded, _ = query_load.run_load(client, missing, total=2)
+    finally:
+        server.shutdown()
+
+    assert len(samples) == 10
+    assert all(s.error is None and s.took == 3 for s in samples)
+    assert all(s.error.startswith('NotFoundError') for s in unrecorded)
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert query_load.percentile(values, 50) == 50
+    assert query_load.percentile(values, 99) == 99
+    assert query_load.percentile([5], 95) == 5
+    assert query_load.percentile([], 50) is None
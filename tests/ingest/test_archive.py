@@ -0,0 +1,28 @@
+"""
+Test streaming articles out of bulk tar archives
+"""
+import os
+import tarfile
+
+from ingest import archive
+
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures/PMC3414848.nxml')
+
+
+def test_iter_members_reads_only_nxml(tmpdir):
+    readme = tmpdir.join('README.txt')
+    readme.write('not an article')
+
+    archive_fn = str(tmpdir.join('bundle.tar.gz'))
+    with tarfile.open(archive_fn, 'w:gz') as tf:
+        tf.add(FIXTURE, arcname='Carbohydr_Polym/PMC3414848.nxml')
+        tf.add(str(readme), arcname='README.txt')
+
+    members = list(archive.iter_archives([archive_fn], prefetch=1))
+    assert [m.name for m in members] == [f'{archive_fn}:Carbohydr_Polym/PMC3414848.nxml']
+    assert members[0].size == os.path.getsize(FIXTURE)
+
+    doc = archive.parse_member(members[0])
+    assert doc['pmc'] == '3414848'
+    assert doc['journal'] == 'Carbohydrate Polymers'
@@ -0,0 +1,74 @@
+"""
+Test the asyncio pipeline against a stand-in async ES client
+"""
+import asyncio
+import json
+import os
+import shutil
+
+import elasticsearch.serializer
+
+from ingest import async_pipeline
+
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures/PMC3414848.nxml')
+
+
+class FakeTransport:
+    serializer = elasticsearch.serializer.JSONSerializer()
+
+
+class FakeAsyncClient:
+    """Accepts everything, except that the first request is rejected (429) in its entirety"""
+    transport = FakeTransport()
+
+    def __init__(self):
+        self.bodies = []
+
+    async def bulk(self, body):
+        await asyncio.sleep(0)
+        self.bodies.append(body)
+        status = 429 if len(self.bodies) == 1 else 201
+        items = [{'index': {'_id': json.loads(line)['index'].get('_id'), 'status': status}}
+                 for line in body.splitlines()[::2]]
+        return {'errors': status != 201, 'items': items}
+
+
+def run_pipeline(sources, **kwargs):
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        client = FakeAsyncClient()
+        pipeline = async_pipeline.Pipeline(client, **kwargs)
+        acked = []
+        failures = []
+        result = loop.run_until_complete(pipeline.run(sources, on_ack=acked.extend, failures=failures))
+        return result, acked, failures
+    finally:
+        loop.close()
+
+
+def test_parse_and_index(tmpdir):
+    sources = []
+    for i in range(4):
+        fn = str(tmpdir.join(f'{i}.nxml'))
+        shutil.copy(FIXTURE, fn)
+        sources.append(fn)
+    bad = str(tmpdir.join('bad.nxml'))
+    tmpdir.join('bad.nxml').write('<article')
+
+    result, acked, failures = run_pipeline(sources + [bad], workers=2, chunk_size=1)
+
+    assert result.indexed == 4
+    assert result.retries >= 1
+    assert sorted(acked) == sorted(sources)
+    assert [failure.source for failure in failures] == [bad]
+
+
+def test_already_parsed_documents():
+    docs = [(f'doc{i}', {'pmc': str(i)}) for i in range(10)]
+    result, acked, failures = run_pipeline(docs, parse_fn=None, batch_bytes=100)
+
+    assert result.indexed == 10
+    assert result.failures == []
+    assert sorted(acked) == sorted(name for name, _ in docs)
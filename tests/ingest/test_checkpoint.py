@@ -0,0 +1,51 @@
+"""
+Test the incremental-indexing manifest
+"""
+from ingest import checkpoint
+from ingest import indexer
+
+
+def test_unchanged_files_are_skipped_once_acknowledged(tmpdir):
+    article = tmpdir.join('a.nxml')
+    article.write('<article/>')
+    manifest = checkpoint.Checkpoint(str(tmpdir.join('manifest.sqlite')))
+
+    assert list(manifest.filter_changed([str(article)])) == [str(article)]
+    # Not yet acknowledged by ES, so a restarted run must process it again
+    assert list(manifest.filter_changed([str(article)])) == [str(article)]
+
+    manifest.acknowledge([str(article)])
+    assert list(manifest.filter_changed([str(article)])) == []
+
+
+def test_touched_but_identical_file_is_skipped(tmpdir):
+    manifest = checkpoint.Checkpoint(str(tmpdir.join('manifest.sqlite')))
+    data = b'<article/>'
+
+    assert manifest.needs_indexing('a.nxml', len(data), 1, lambda: data)
+    manifest.acknowledge(['a.nxml'])
+
+    assert not manifest.needs_indexing('a.nxml', len(data), 2, lambda: data)
+    assert manifest.lookup('a.nxml').mtime == 2
+    assert manifest.needs_indexing('a.nxml', len(data), 3, lambda: b'<article></article>')
+
+
+def outcome(acked, failed=()):
+    failures = [indexer.ItemFailure(token, None, 500, 'error') for token in failed]
+    return indexer.BatchOutcome(acked, failures, 0, 1, 0.0, False, [], [], {})
+
+
+def test_split_file_is_recorded_once_all_parts_are_acknowledged(tmpdir):
+    manifest = checkpoint.Checkpoint(str(tmpdir.join('manifest.sqlite')))
+    for key in ['a.nxml', 'b.nxml']:
+        assert manifest.needs_indexing(key, 1, 1, lambda: b'x')
+
+    sent = list(manifest.track([('a.nxml', 0), ('a.nxml', 1), ('a.nxml', 2), ('b.nxml', 0), ('b.nxml', 1)]))
+    assert len(sent) == 5
+
+    manifest.completed(outcome(['a.nxml', 'a.nxml', 'b.nxml']))
+    assert manifest.lookup('a.nxml') is None
+    manifest.completed(outcome(['a.nxml'], failed=['b.nxml']))
+    assert manifest.lookup('a.nxml') is not None
+    # One part of b was rejected, so it must be indexed again next run
+    assert manifest.lookup('b.nxml') is None
@@ -0,0 +1,151 @@
+"""
+Test that single-pass and streaming extraction produce exactly the same output as the XPath-based parser, and
+that articles are split into passages
+"""
+import glob
+import io
+import os
+
+from lxml import etree
+import pytest
+
+from ingest import extract
+from ingest import parse_nxml
+from ingest import passages
+
+
+FIXTURES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), 'fixtures', '*.nxml')))
+
+# Exercises edge cases: entities, comments, mixed content, multiple figures (in and out of the body), and
+#   elements that match a tag name but not the full path used by the XPath expressions
+EDGE_CASES = b'''<article>
+  <front>
+    <journal-meta><journal-title-group><journal-title>Fish &amp;amp; Chips</journal-title></journal-title-group></journal-meta>
+    <article-meta>
+      <article-id pub-id-type="pmc">123</article-id>
+      <article-id pub-id-type="other">abc</article-id>
+      <title-group><article-title>A <italic>very</italic> &amp;lt;long&amp;gt; title</article-title></title-group>
+      <contrib-group>
+        <contrib contrib-type="author"><name><surname>Smith</surname><given-names>Jo</given-names></name></contrib>
+        <contrib contrib-type="editor"><name><surname>Jones</surname><given-names>Al</given-names></name></contrib>
+      </contrib-group>
+      <pub-date><year>2015</year><month>2</month><day>3</day></pub-date>
+      <pub-date><year>2016</year></pub-date>
+      <volume>12</volume>
+      <abstract><p>First <!-- hidden --> abstract</p></abstract>
+      <abstract abstract-type="graphical"><p>Second</p></abstract>
+      <kwd-group><kwd>alpha</kwd><kwd>be<sub>2</sub>ta</kwd></kwd-group>
+    </article-meta>
+    <article-meta><volume>99</volume></article-meta>
+  </front>
+  <body>
+    <sec><title>Intro</title><p>Text with <xref>1</xref> a ref &amp;amp; entity<?pi x?> tail</p>
+      <fig id="f1"><label>Fig. 1</label><caption><title>First</title><p>caption <bold>one</bold></p></caption></fig>
+      <fig id="f2"><label>Fig. 2</label></fig>
+    </sec>
+  </body>
+  <back>
+    <ack><title>Thanks</title><p>To <italic>everyone</italic> involved</p><p>and more</p></ack>
+    <sec><ack><p>not this one</p></ack></sec>
+  </back>
+  <floats-group><fig id="f3"><caption><p>Floating caption</p></caption></fig></floats-group>
+</article>
+'''
+
+
+@pytest.mark.parametrize('extractor', [extract.parse, extract.iterparse])
+@pytest.mark.parametrize('fn', FIXTURES)
+def test_same_output_as_xpath(extractor, fn):
+    assert extractor(fn) == parse_nxml.parse_nxml(fn)
+
+
+@pytest.mark.parametrize('extractor', [extract.parse, extract.iterparse])
+def test_same_output_as_xpath_edge_cases(extractor):
+    expected = parse_nxml.parse_nxml(io.BytesIO(EDGE_CASES))
+    actual = extractor(io.BytesIO(EDGE_CASES))
+    assert actual == expected
+
+
+@pytest.mark.parametrize('extractor', [parse_nxml.parse_nxml, extract.parse])
+def test_one_caption_per_figure(extractor):
+    actual = extractor(io.BytesIO(EDGE_CASES))
+    assert actual['figure_captions'] == ['First caption  one', 'Floating caption']
+
+
+def test_iterparse_truncates_body():
+    full = extract.iterparse(FIXTURES[0])
+    actual = extract.iterparse(FIXTURES[0], max_body_chars=1000)
+    assert actual['body'] == full['body'][:1000]
+    assert actual['title'] == full['title']
+
+
+def test_iterparse_splits_body():
+    full = extract.iterparse(FIXTURES[0])
+    parts = extract.iterparse(FIXTURES[0], max_body_chars=10000, overflow='split')
+    assert not isinstance(parts, list)
+    parts = list(parts)
+
+    assert len(parts) > 1
+    assert [doc['part'] for doc in parts] == list(range(len(parts)))
+    assert all(len(doc['body']) <= 10000 for doc in parts)
+    assert ''.join(doc['body'] for doc in parts) == full['body']
+    assert all(doc['pmc'] == full['pmc'] for doc in parts)
+    assert parts[-1]['figure_captions'] == full['figure_captions']
+    assert parts[0]['figure_captions'] == []
+
+
+# Doubly-escaped entities, which are unescaped once more after parsing (as by `parse_nxml.unescape_text`)
+ENTITIES = b'''<article><front><article-meta><article-id pub-id-type="pmc">1</article-id></article-meta></front>
+<body><p>aaaa &amp;amp;lt;b&amp;amp;gt; zz</p><p>c &amp;amp;amp;</p><p>dd</p></body></article>'''
+
+
+@pytest.mark.parametrize('max_body_chars', [3, 5, 8, 17, 100])
+def test_iterparse_split_unescapes_once(max_body_chars):
+    full = parse_nxml.parse_nxml(io.BytesIO(ENTITIES))['body']
+    assert full == 'aaaa &lt;b&gt; zz c &amp; dd'
+    parts = list(extract.iterparse(io.BytesIO(ENTITIES), max_body_chars=max_body_chars, overflow='split'))
+    assert ''.join(doc['body'] for doc in parts) == full
+    assert all(len(doc['body']) <= max_body_chars for doc in parts)
+    truncated = extract.iterparse(io.BytesIO(ENTITIES), max_body_chars=max_body_chars)
+    assert truncated['body'] == full[:max_body_chars]
+
+
+PASSAGES = b'''<article>
+  <front><article-meta><article-id pub-id-type="pmc">9</article-id></article-meta></front>
+  <body>
+    <p>Unsectioned lead</p>
+    <sec><label>1</label><title>Methods</title>
+      <p>Overview</p>
+      <sec><title>Cell culture</title><p>Cells <italic>were</italic> grown</p>
+        <fig><caption><p>Not a passage</p></caption></fig>
+        <p>''' + b'word ' * 30 + b'''</p>
+      </sec>
+    </sec>
+  </body>
+</article>
+'''
+
+
+@pytest.mark.parametrize('extractor', [extract.parse, parse_nxml.parse_nxml])
+def test_passages_keep_sections_and_order(extractor):
+    doc = extractor(io.BytesIO(PASSAGES), as_passages=True)
+    assert 'body' not in doc
+    assert [(p['ordinal'], p['section']) for p in doc['passages']] == [
+        (0, []), (1, ['Methods']), (2, ['Methods', 'Cell culture']), (3, ['Methods', 'Cell culture'])]
+    assert doc['passages'][2]['text'] == 'Cells  were  grown'
+
+
+def test_long_paragraphs_are_split_between_words():
+    body = etree.fromstring(PASSAGES).find('body')
+    split = passages.split_body(body, max_chars=100)
+    assert [p['ordinal'] for p in split] == list(range(5))
+    assert all(len(p['text']) <= 100 for p in split)
+    assert ' '.join(p['text'] for p in split[3:]).split() == ['word'] * 30
+
+
+@pytest.mark.parametrize('fn', FIXTURES)
+def test_passages_same_from_both_extractors(fn):
+    expected = parse_nxml.parse_nxml(fn, as_passages=True)
+    assert extract.parse(fn, as_passages=True) == expected
+    flat = parse_nxml.parse_nxml(fn)
+    assert {k: v for k, v in expected.items() if k != 'passages'} == {k: v for k, v in flat.items() if k != 'body'}
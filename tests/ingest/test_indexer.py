@@ -0,0 +1,125 @@
+"""
+Test the concurrent bulk indexer against a stand-in ES client
+"""
+import json
+import threading
+
+import elasticsearch.serializer
+
+from ingest import checkpoint
+from ingest import indexer
+from ingest import populate_es
+
+
+class FakeTransport:
+    serializer = elasticsearch.serializer.JSONSerializer()
+
+    def __init__(self, client):
+        self.client = client
+
+    def perform_request(self, method, url, body):
+        assert (method, url) == ('POST', '/_bulk')
+        self.client.raw_bodies.append(body)
+        return self.client.bulk(body.decode('utf-8'))
+
+
+class FakeClient:
+    """Responds to bulk requests, rejecting (429) each listed document ID the first time it is seen"""
+    def __init__(self, reject_once=(), fail=()):
+        self.transport = FakeTransport(self)
+        self.raw_bodies = []
+        self.reject_once = set(reject_once)
+        self.fail = set(fail)
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def bulk(self, body):
+        lines = body.splitlines()
+        items = []
+        with self._lock:
+            self.requests.append(body)
+            for meta_line in lines[::2]:
+                meta = json.loads(meta_line)['index']
+                _id = meta['_id']
+                if _id in self.reject_once:
+                    self.reject_once.remove(_id)
+                    status = 429
+                elif _id in self.fail:
+                    status = 400
+                else:
+                    status = 201
+                items.append({'index': {'_id': _id, '_type': meta.get('_type'), 'status': status}})
+        return {'errors': True, 'items': items}
+
+
+def make_actions(n):
+    return [(f'file{i}', {'_index': 'pubmed', '_type': 'article', '_id': str(i), '_source': {'title': 'x' * 100}})
+            for i in range(n)]
+
+
+def test_rejected_items_are_retried_and_failures_reported():
+    client = FakeClient(reject_once=['3', '7'], fail=['5'])
+    bulk = indexer.BulkIndexer(client, max_in_flight=3, batch_bytes=500, min_batch_bytes=100, backoff=0)
+
+    acked = []
+    result = bulk.index_tracked(make_actions(20), on_ack=acked.extend)
+
+    assert result.indexed == 19
+    assert result.retries == 2
+    assert sorted(acked) == sorted(f'file{i}' for i in range(20) if i != 5)
+    assert result.failures == [indexer.ItemFailure('file5', '5', 400, None)]
+
+
+def test_batches_are_sized_by_bytes():
+    client = FakeClient()
+    bulk = indexer.BulkIndexer(client, max_in_flight=1, batch_bytes=1000, target_latency=-1, min_batch_bytes=1000)
+
+    result = bulk.index_tracked(make_actions(20))
+
+    assert result.indexed == 20
+    assert all(len(body) <= 1000 for body in client.requests)
+
+
+def test_batch_size_counts_bytes_of_non_ascii_text():
+    client = FakeClient()
+    bulk = indexer.BulkIndexer(client, max_in_flight=1, batch_bytes=1000, target_latency=-1, min_batch_bytes=1000)
+    actions = [(f'file{i}', {'_index': 'pubmed', '_type': 'article', '_id': str(i), '_source': {'title': 'é' * 150}})
+               for i in range(20)]
+
+    result = bulk.index_tracked(actions)
+
+    assert result.indexed == 20
+    assert all(len(body.encode('utf-8')) <= 1000 for body in client.requests)
+
+
+def test_pre_encoded_items_are_sent_as_bytes():
+    client = FakeClient(reject_once=['3'])
+    bulk = indexer.BulkIndexer(client, max_in_flight=2, batch_bytes=500, backoff=0)
+    items = [(f'file{i}', str(i), json.dumps({'index': {'_id': str(i)}}).encode() + b'\n{"title":"x"}\n')
+             for i in range(10)]
+
+    result = bulk.index_encoded(items)
+
+    assert result.indexed == 10
+    assert result.retries == 1
+    assert len(client.raw_bodies) == len(client.requests)
+    assert all(isinstance(body, bytes) for body in client.raw_bodies)
+
+
+def test_file_is_checkpointed_only_if_all_its_passages_are_indexed(tmpdir):
+    manifest = checkpoint.Checkpoint(str(tmpdir.join('manifest.sqlite')))
+    passages = [{'section': [], 'ordinal': i, 'text': 'x'} for i in range(3)]
+    docs = {name: {'pmc': pmc, 'date': '2010-01-01', 'passages': passages}
+            for name, pmc in [('a.nxml', '1'), ('b.nxml', '2')]}
+    for name in docs:
+        manifest.needs_indexing(name, 1, 1, lambda: name.encode())
+    client = FakeClient(fail=['pmc:2#1'])
+    bulk = indexer.BulkIndexer(client, max_in_flight=2, batch_bytes=300, backoff=0)
+
+    tracked_actions = ((name, action) for name, doc in docs.items()
+                       for action in populate_es.make_bulk_actions([doc]))
+    result = bulk.index_tracked(manifest.track(tracked_actions), on_batch=manifest.completed)
+
+    assert result.types == {populate_es.CONTENT_TYPE: 2, populate_es.PASSAGE_TYPE: 5}
+    assert manifest.lookup('a.nxml') is not None
+    assert manifest.lookup('b.nxml') is None
@@ -0,0 +1,74 @@
+"""
+Test listing a corpus, and dividing it between hosts
+"""
+import argparse
+import os
+import random
+
+import pytest
+
+from ingest import main
+from ingest import manifest
+
+
+def make_tree(root):
+    for relpath, size in [('a/1.nxml', 10), ('a/b/2.nxml', 20), ('3.nxml', 30), ('a/readme.txt', 5),
+                          ('a/b/c/4.nxml', 40)]:
+        fn = os.path.join(str(root), *relpath.split('/'))
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, 'wb') as f:
+            f.write(b'x' * size)
+
+
+def test_scan_lists_nxml_files_with_sizes(tmpdir):
+    make_tree(tmpdir)
+    entries = manifest.scan(str(tmpdir))
+    assert [(e.relpath, e.size) for e in entries] == [('3.nxml', 30), ('a/1.nxml', 10), ('a/b/2.nxml', 20),
+                                                     ('a/b/c/4.nxml', 40)]
+    assert all(os.path.isfile(e.path) for e in entries)
+    assert sorted(main.find_files(str(tmpdir))) == sorted(e.path for e in entries)
+    assert list(main.find_files(str(tmpdir), shard=(0, 1))) == [e.path for e in entries]
+
+
+def test_find_files_is_lazy_without_shard_or_manifest(tmpdir, monkeypatch):
+    make_tree(tmpdir)
+
+    def scan(dirname):
+        raise AssertionError('listed the whole corpus up front')
+    monkeypatch.setattr(manifest, 'scan', scan)
+    assert next(main.find_files(str(tmpdir))).endswith('.nxml')
+
+
+def test_manifest_round_trip(tmpdir):
+    make_tree(tmpdir.join('corpus'))
+    entries = manifest.scan(str(tmpdir.join('corpus')))
+    fn = str(tmpdir.join('manifest.tsv'))
+    manifest.write(entries, fn)
+    assert manifest.read(fn, str(tmpdir.join('corpus'))) == entries
+
+
+def test_shards_cover_corpus_without_overlap_and_balance_bytes():
+    rng = random.Random(0)
+    entries = [manifest.Entry(f'/data/{i}.nxml', f'{i // 100}/{i}.nxml', rng.randint(1000, 200000))
+               for i in range(2000)]
+    shards = [manifest.select(entries, (i, 4)) for i in range(4)]
+
+    assert sorted(e.relpath for shard in shards for e in shard) == sorted(e.relpath for e in entries)
+    sizes = [sum(e.size for e in shard) for shard in shards]
+    assert max(sizes) - min(sizes) <= 2 * max(e.size for e in entries)
+
+    # The same on another host, which listed the files in a different order
+    assert manifest.select(list(reversed(entries)), (2, 4)) == shards[2]
+
+    # New files move only a few of the existing ones
+    grown = entries + [manifest.Entry(f'/data/new{i}.nxml', f'new/{i}.nxml', 50000) for i in range(20)]
+    moved = set(e.relpath for e in shards[1]) - set(e.relpath for e in manifest.select(grown, (1, 4)))
+    assert len(moved) < 40
+
+
+def test_parse_shard():
+    assert manifest.parse_shard('0/4') == (0, 4)
+    assert manifest.parse_shard('3/4') == (3, 4)
+    for value in ['4/4', 'x', '1/', '-1/2']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            manifest.parse_shard(value)
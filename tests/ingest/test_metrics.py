@@ -0,0 +1,47 @@
+"""
+Test run statistics and their export formats
+"""
+import json
+
+from ingest import indexer
+from ingest import metrics
+
+
+def test_slowest_files_and_histograms():
+    stats = metrics.RunStats(top_n=2, progress_interval=0)
+    for i, seconds in enumerate([0.001, 0.3, 0.02, 7.0]):
+        stats.file_parsed(f'file{i}', seconds)
+    stats.bulk_completed(indexer.BatchOutcome(['file0', 'file1'], [], retries=3, requests=2, latency=0.2,
+                                              throttled=True, created=['0', '1'], updated=[],
+                                              types={'article': 1, 'passage': 1}))
+
+    assert stats.slowest_files() == [('file3', 7.0), ('file1', 0.3)]
+    assert stats.counters['files_parsed'] == 4
+    assert stats.counters['docs_indexed'] == 1
+    assert stats.counters['passages_indexed'] == 1
+    assert stats.counters['items_retried'] == 3
+    buckets = dict(stats.histograms['parse_seconds'].cumulative())
+    assert buckets['0.005'] == 1
+    assert buckets['0.5'] == 3
+    assert buckets['+Inf'] == 4
+
+
+def test_write_json_and_prometheus(tmpdir):
+    stats = metrics.RunStats(progress_interval=0)
+    stats.file_parsed('file0', 0.1)
+    path = str(tmpdir.join('run'))
+
+    stats.write(path)
+
+    with open(f'{path}.json') as f:
+        assert json.load(f)['counters']['files_parsed'] == 1
+    with open(f'{path}.prom') as f:
+        prom = f.read()
+    assert 'ingest_files_parsed_total 1\n' in prom
+    assert 'ingest_parse_seconds_bucket{le="+Inf"} 1\n' in prom
+    assert 'ingest_parse_seconds_count 1\n' in prom
+
+
+def test_null_stats_passes_sources_through():
+    sources = ['a', 'b']
+    assert metrics.NULL.track_sources(sources) is sources
@@ -0,0 +1,45 @@
+"""
+Test that pre-encoded bulk lines match what the ES client would send
+"""
+import json
+
+import elasticsearch.serializer
+
+from ingest import config
+from ingest import indexer
+from ingest import ndjson
+from ingest import populate_es
+
+
+def test_encoded_document_matches_client_serialization():
+    doc = {'pmc': '3414848', 'title': 'Café α-helix "quoted"', 'authors': [{'surname': 'X'}],
+           'date': None, 'part': 1}
+    action = next(populate_es.make_bulk_actions([doc]))
+    expected = indexer.serialize_action(elasticsearch.serializer.JSONSerializer(), None, action)
+
+    _id, data = ndjson.encode_document(doc)
+
+    assert _id == expected.id == 'pmc:3414848/1'
+    assert data.endswith(b'\n')
+    assert ([json.loads(line) for line in data.decode('utf-8').splitlines()]
+            == [json.loads(line) for line in expected.data.splitlines()])
+
+
+def test_encoded_passages_match_client_serialization():
+    doc = {'pmc': '7', 'title': 'Passages', 'date': '2011',
+           'passages': [{'section': ['Résumé'], 'ordinal': i, 'text': f'text {i}'} for i in range(3)]}
+    serializer = elasticsearch.serializer.JSONSerializer()
+    expected = [indexer.serialize_action(serializer, None, action) for action in populate_es.make_bulk_actions([doc])]
+
+    encoded = ndjson.encode_documents(doc)
+
+    assert [_id for _id, _ in encoded] == [item.id for item in expected] == ['pmc:7', 'pmc:7#0', 'pmc:7#1', 'pmc:7#2']
+    for (_, data), item in zip(encoded, expected):
+        assert ([json.loads(line) for line in data.decode('utf-8').splitlines()]
+                == [json.loads(line) for line in item.data.splitlines()])
+
+
+def test_client_serializer_passes_bytes_through():
+    serializer = config.Serializer()
+    assert serializer.dumps(b'{"a":1}\n') == b'{"a":1}\n'
+    assert serializer.dumps({'a': 1}) == '{"a": 1}'
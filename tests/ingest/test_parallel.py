@@ -0,0 +1,27 @@
+"""
+Test parallel parsing of many files
+"""
+import os
+import shutil
+
+from ingest import parallel
+
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures/PMC3414848.nxml')
+
+
+def test_parse_sources_reports_failures(tmpdir):
+    good = [str(tmpdir.join(f'{i}.nxml')) for i in range(3)]
+    for fn in good:
+        shutil.copy(FIXTURE, fn)
+    bad = str(tmpdir.join('bad.nxml'))
+    with open(bad, 'w') as f:
+        f.write('<article')
+
+    failures = []
+    results = list(parallel.parse_sources(good + [bad], workers=2, chunk_size=2, failures=failures))
+
+    assert [source for source, _ in results] == good
+    assert all(doc['pmc'] == '3414848' for _, doc in results)
+    assert len(failures) == 1
+    assert failures[0].source == bad
@@ -0,0 +1,184 @@
+"""
+Test index management helpers against a stand-in ES client
+"""
+import pytest
+
+from ingest import populate_es
+
+
+class FakeIndices:
+    def __init__(self, current):
+        self.current = current
+        self.calls = []
+        self.mappings = {}
+
+    def get_settings(self, index, flat_settings):
+        return {index: {'settings': dict(self.current)}}
+
+    def put_settings(self, index, body):
+        self.calls.append(('put_settings', body))
+        self.current.update(body)
+
+    def refresh(self, index):
+        self.calls.append(('refresh',))
+
+    def forcemerge(self, index, max_num_segments, request_timeout):
+        self.calls.append(('forcemerge', max_num_segments))
+
+    def delete(self, index, ignore):
+        self.calls.append(('delete', index))
+
+    def create(self, index, body, ignore):
+        self.calls.append(('create', index, body))
+
+    def put_mapping(self, index, doc_type, body):
+        self.calls.append(('put_mapping', index, body))
+        self.mappings.update(body)
+
+    def get_mapping(self, index, ignore):
+        return {index: {'mappings': dict(self.mappings)}} if self.mappings else {'error': 'index_not_found'}
+
+
+class FakeClient:
+    def __init__(self, current, version='5.2.0'):
+        self.indices = FakeIndices(current)
+        self.version = version
+
+    def info(self):
+        return {'version': {'number': self.version}}
+
+    def delete_by_query(self, index, body, conflicts):
+        self.indices.calls.append(('delete_by_query', index, body))
+        return {'deleted': 0, 'failures': []}
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    client = FakeClient({'index.refresh_interval': '30s', 'index.number_of_replicas': '2'})
+    monkeypatch.setattr(populate_es, 'client', client)
+    return client
+
+
+def test_doc_id_prefers_pmc():
+    assert populate_es.doc_id({'pmc': '3414848', 'pmid': '22839999'}) == 'pmc:3414848'
+    assert populate_es.doc_id({'pmc': None, 'pmid': None, 'doi': '10.1016/x'}) == 'doi:10.1016/x'
+    assert populate_es.doc_id({'pmc': None}) is None
+
+
+def test_bulk_load_restores_settings_on_failure(fake_client):
+    with pytest.raises(RuntimeError):
+        with populate_es.bulk_load(force_merge=True):
+            assert fake_client.indices.current['index.refresh_interval'] == '-1'
+            raise RuntimeError('load failed')
+
+    current = fake_client.indices.current
+    assert current['index.refresh_interval'] == '30s'
+    assert current['index.number_of_replicas'] == '2'
+    assert current['index.translog.durability'] == 'request'
+    # A failed load should not be followed by an (expensive) force-merge
+    assert ('forcemerge', 1) not in fake_client.indices.calls
+
+
+def test_bulk_load_settings_left_by_an_interrupted_load_are_not_restored(fake_client, monkeypatch):
+    # Settings as left by a previous bulk load that was killed
+    fake_client.indices.current.update({'index.refresh_interval': '-1', 'index.number_of_replicas': '0',
+                                        'index.translog.durability': 'async'})
+    monkeypatch.setattr(populate_es, 'settings', populate_es.settings._replace(refresh_interval='1s', replicas=1))
+
+    with populate_es.bulk_load():
+        pass
+
+    current = fake_client.indices.current
+    assert current['index.refresh_interval'] == '1s'
+    assert current['index.number_of_replicas'] == 1
+    assert current['index.translog.durability'] == 'request'
+
+
+def test_bulk_load_force_merges_after_success(fake_client):
+    with populate_es.bulk_load(force_merge=True):
+        pass
+    assert fake_client.indices.calls[-1] == ('forcemerge', 1)
+
+
+def test_lean_mapping_uses_keywords_and_limits_shingles():
+    lean = populate_es.make_mapping('lean')['properties']
+    assert lean['pmc'] == {'type': 'keyword'}
+    assert lean['journal']['fields']['raw'] == {'type': 'keyword'}
+    assert lean['body']['analyzer'] == 'standard'
+    assert lean['title']['fields']['shingles']['analyzer'] == 'sci_text'
+    with pytest.raises(ValueError):
+        populate_es.make_mapping('tiny')
+
+
+@pytest.mark.parametrize('version,sorted_', [('5.2.0', False), ('6.2.4', True)])
+def test_sort_by_date_requires_es6(fake_client, version, sorted_):
+    fake_client.version = version
+    populate_es.setup_index(drop=True, profile='lean', sort_by_date=True)
+
+    _, index, body = next(call for call in fake_client.indices.calls if call[0] == 'create')
+    assert ('sort' in body['settings']) == sorted_
+    assert body['mappings'][populate_es.CONTENT_TYPE]['_all'] == {'enabled': False}
+
+
+ARTICLE_WITH_PASSAGES = {
+    'pmc': '1', 'title': 'T', 'date': '2010-01-01',
+    'passages': [{'section': ['Intro'], 'ordinal': 0, 'text': 'a'}, {'section': [], 'ordinal': 1, 'text': 'b'}],
+}
+
+
+def test_passages_become_child_documents():
+    article, passage = list(populate_es.make_bulk_actions([ARTICLE_WITH_PASSAGES]))[:2]
+    assert article['_id'] == 'pmc:1'
+    assert 'passages' not in article['_source'] and 'body' not in article['_source']
+    assert passage['_type'] == populate_es.PASSAGE_TYPE
+    assert passage['_id'] == 'pmc:1#0'
+    assert passage['_parent'] == 'pmc:1'
+    assert passage['_source'] == {'section': ['Intro'], 'ordinal': 0, 'text': 'a', 'article': 'pmc:1',
+                                  'date': '2010-01-01'}
+
+    # Without an ID, the text can't be attached to the article, so stays in it
+    orphan = dict(ARTICLE_WITH_PASSAGES, pmc=None)
+    assert [a['_source']['body'] for a in populate_es.make_bulk_actions([orphan])] == ['a b']
+
+
+def test_passage_mapping_is_created_with_index(fake_client):
+    populate_es.setup_index(drop=True, passages=True)
+
+    _, index, body = next(call for call in fake_client.indices.calls if call[0] == 'create')
+    assert body['mappings'][populate_es.PASSAGE_TYPE]['_parent'] == {'type': populate_es.CONTENT_TYPE}
+    put = [call[2] for call in fake_client.indices.calls if call[0] == 'put_mapping']
+    assert [list(mapping) for mapping in put] == [[populate_es.CONTENT_TYPE], [populate_es.PASSAGE_TYPE]]
+    assert populate_es.has_passages()
+
+
+def test_index_without_passages(fake_client):
+    assert not populate_es.has_passages()
+    populate_es.setup_index(drop=True)
+    assert not populate_es.has_passages()
+
+
+def test_stale_parts_are_deleted_once_article_is_complete(fake_client):
+    stale = populate_es.StaleDocuments(fake_client, batch_size=1)
+    docs = [{'pmc': '1', 'part': 0}, {'pmc': '1', 'part': 1}, {'pmc': '2'}, {'pmc': '3', 'part': 0}]
+    assert list(stale.track(('a.nxml', doc) for doc in docs)) == [('a.nxml', doc) for doc in docs]
+
+    # pmc:1 (two parts) and pmc:3 (now one part) one request each; pmc:2 was never split
+    calls = [call for call in fake_client.indices.calls if call[0] == 'delete_by_query']
+    assert len(calls) == 2
+    first, second = (call[2]['query']['bool']['should'] for call in calls)
+    assert first[0]['bool']['filter'] == {'prefix': {'_uid': 'article#pmc:1/'}}
+    assert first[0]['bool']['must_not'] == {'ids': {'values': ['pmc:1/1']}}
+    assert second[0]['bool']['must_not'] == {'ids': {'values': []}}
+
+
+def test_passages_beyond_a_shortened_article_are_deleted(fake_client):
+    stale = populate_es.StaleDocuments(fake_client)
+    shortened = dict(ARTICLE_WITH_PASSAGES, passages=ARTICLE_WITH_PASSAGES['passages'][:1])
+    actions = list(populate_es.make_bulk_actions(doc for _, doc in stale.track([('a.nxml', shortened)])))
+    assert [action['_id'] for action in actions] == ['pmc:1', 'pmc:1#0']
+
+    (_, index, body), = [call for call in fake_client.indices.calls if call[0] == 'delete_by_query']
+    assert body['query']['bool']['should'] == [{'bool': {'filter': [
+        {'term': {'article': 'pmc:1'}},
+        {'range': {'ordinal': {'gte': 1}}}
+    ]}}]
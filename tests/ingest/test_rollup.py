@@ -0,0 +1,131 @@
+"""
+Test the rollup writer and query layer against a stand-in ES client that stores documents in memory
+"""
+import json
+
+import elasticsearch.serializer
+
+from ingest import indexer
+from ingest import rollup
+
+
+class FakeTransport:
+    serializer = elasticsearch.serializer.JSONSerializer()
+
+
+class FakeClient:
+    """Applies scripted-upsert bulk requests, and answers the rollup's (filter-only) searches"""
+    transport = FakeTransport()
+
+    def __init__(self, fail=()):
+        self.docs = {}
+        self.searches = 0
+        self.fail = set(fail)  # Document IDs whose updates are rejected
+
+    def bulk(self, body, **params):
+        lines = body.splitlines()
+        items = []
+        for action_line, source_line in zip(lines[::2], lines[1::2]):
+            meta = json.loads(action_line)['update']
+            update = json.loads(source_line)
+            if meta['_id'] in self.fail:
+                items.append({'update': {'_id': meta['_id'], 'status': 503, 'error': 'unavailable'}})
+                continue
+            field = update['script']['inline'].split('ctx._source.')[1].split()[0]
+            if meta['_id'] in self.docs:
+                self.docs[meta['_id']][field] += update['script']['params']['n']
+            else:
+                self.docs[meta['_id']] = dict(update['upsert'])
+            items.append({'update': {'_id': meta['_id'], 'status': 200}})
+        return {'errors': any(item['update']['status'] >= 300 for item in items), 'items': items}
+
+    def get(self, index, doc_type, id, ignore):
+        if id in self.docs:
+            return {'found': True, '_source': self.docs[id]}
+        return {'found': False}
+
+    def search(self, index, doc_type, body):
+        self.searches += 1
+        hits = list(self.docs.values())
+        for f in body['query']['bool']['filter']:
+            (kind, clause), = f.items()
+            (field, value), = clause.items()
+            values = value if kind == 'terms' else [value]
+            hits = [hit for hit in hits if hit.get(field) in values]
+        for sort in reversed(body.get('sort', [])):
+            (field, order), = sort.items()
+            hits.sort(key=lambda hit: hit[field], reverse=order == 'desc')
+
+        response = {'hits': {'hits': [{'_source': hit} for hit in hits[:body['size']]]}}
+        if 'aggregations' in body:
+            sums = {}
+            for hit in hits:
+                sums[hit['term']] = sums.get(hit['term'], 0) + hit['count']
+            buckets = [{'key': key, 'count': {'value': value}} for key, value in sums.items()]
+            response['aggregations'] = {'terms': {'buckets': buckets}}
+        return response
+
+
+def outcome(created=(), updated=()):
+    return indexer.BatchOutcome([], [], 0, 1, 0.1, False, list(created), list(updated), {})
+
+
+def article(pmc, year, keywords, journal='J Test'):
+    return {'pmc': pmc, 'date': f'{year}-01-01', 'keywords': keywords, 'journal': journal}
+
+
+def test_only_new_articles_are_counted():
+    client = FakeClient()
+    summary = rollup.Rollup(client, flush_docs=2)
+    docs = [article('1', 2010, ['a', 'b']), article('2', 2010, ['a']), article('3', 2011, ['a', 'c'])]
+    for doc in docs:
+        summary.add(doc)
+
+    summary.completed(outcome(created=['pmc:1', 'pmc:2'], updated=['pmc:3']))
+    summary.flush()
+
+    assert client.docs['year:2010']['count'] == 2
+    assert client.docs['keyword:2010:a']['count'] == 2
+    assert client.docs['journal:2010:J Test']['count'] == 2
+    assert 'year:2011' not in client.docs
+    assert client.docs[rollup.GENERATION_ID]['generation'] == 1
+
+
+def test_failed_updates_are_sent_again_at_the_next_flush():
+    client = FakeClient(fail=['keyword:2010:a'])
+    summary = rollup.Rollup(client)
+    summary.add(article('1', 2010, ['a', 'b']))
+    summary.completed(outcome(created=['pmc:1']))
+    summary.flush()
+    assert 'keyword:2010:a' not in client.docs
+
+    client.fail.clear()
+    summary.flush()
+    assert client.docs['keyword:2010:a']['count'] == 1
+    assert client.docs['keyword:2010:b']['count'] == 1
+    assert client.docs['year:2010']['count'] == 1
+
+
+def test_queries_are_cached_until_the_generation_changes():
+    client = FakeClient()
+    summary = rollup.Rollup(client)
+    docs = ([article(str(i), 2010, ['common', 'early']) for i in range(3)]
+            + [article(str(i), 2011, ['common', 'late']) for i in range(3, 9)])
+    for doc in docs:
+        summary.add(doc)
+    summary.completed(outcome(created=[f'pmc:{i}' for i in range(9)]))
+    summary.flush()
+
+    queries = rollup.RollupQueries(client, check_interval=0)
+    assert queries.year_counts() == [{'year': 2010, 'count': 3}, {'year': 2011, 'count': 6}]
+    significant = queries.significant_terms(2010, size=2)
+    assert [item['key'] for item in significant] == ['early', 'common']
+
+    searches = client.searches
+    queries.year_counts()
+    assert client.searches == searches
+
+    summary.add(article('100', 2012, ['new']))
+    summary.completed(outcome(created=['pmc:100']))
+    summary.flush()
+    assert queries.year_counts()[-1] == {'year': 2012, 'count': 1}
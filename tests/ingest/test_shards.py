@@ -0,0 +1,41 @@
+"""
+Test writing and reading back parsed documents
+"""
+import gzip
+import os
+
+import pytest
+
+from ingest import shards
+
+
+def test_round_trip_across_shards_and_blocks(tmpdir):
+    dirname = str(tmpdir.join('shards'))
+    docs = [{'pmc': str(i), 'title': f'Article {i} ►'} for i in range(25)]
+
+    count = shards.write_shards(docs, dirname, docs_per_shard=10, docs_per_block=3)
+    assert count == 25
+
+    index = shards.read_index(dirname)
+    assert [shard['count'] for shard in index['shards']] == [10, 10, 5]
+    assert [doc for _, doc in shards.iter_shards(dirname)] == docs
+
+
+def test_shard_is_a_valid_gzip_file(tmpdir):
+    dirname = str(tmpdir)
+    shards.write_shards([{'pmc': '1'}, {'pmc': '2'}], dirname, docs_per_block=1)
+    with gzip.open(os.path.join(dirname, 'shard-00000.jsonl.gz'), 'rt') as f:
+        assert f.read() == '{"pmc": "1"}\n{"pmc": "2"}\n'
+
+
+def test_failed_export_leaves_no_index(tmpdir):
+    dirname = str(tmpdir)
+    shards.write_shards([{'pmc': '1'}], dirname)
+
+    def docs():
+        yield {'pmc': '2'}
+        raise RuntimeError('parse failed')
+
+    with pytest.raises(RuntimeError):
+        shards.write_shards(docs(), dirname)
+    assert not os.path.exists(os.path.join(dirname, shards.INDEX_FILENAME))